@@ -0,0 +1,226 @@
+import os
+import logging
+import json
+import time
+import asyncio
+import tempfile
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from services.text_search import text_service
+from core.cache import CACHE_MODES
+from core.metrics import set_mode
+from core.resilience import deadline_scope, REQUEST_DEADLINE
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# --- Batch Configuration ---
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100000"))
+# Concurrency caps per upstream, shared by every running batch so several
+# batches together still respect the providers' rate limits.
+BATCH_SEARCH_CONCURRENCY = int(os.getenv("BATCH_SEARCH_CONCURRENCY", "8"))
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "4"))
+# Queries in progress per batch; lines are read only as workers free up.
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", str(BATCH_SEARCH_CONCURRENCY + BATCH_LLM_CONCURRENCY)))
+BATCH_SPOOL_MAX_MEMORY = 1024 * 1024  # request bodies beyond this are spooled to disk
+# -----------------------------------
+
+_upstream_limits = {}
+
+
+def _limit(upstream: str) -> asyncio.Semaphore:
+    # Created on first use so the semaphores bind to the serving event loop.
+    if upstream not in _upstream_limits:
+        size = BATCH_SEARCH_CONCURRENCY if upstream == "search" else BATCH_LLM_CONCURRENCY
+        _upstream_limits[upstream] = asyncio.Semaphore(max(1, size))
+    return _upstream_limits[upstream]
+
+
+def _normalise(query: str) -> str:
+    return " ".join(query.split()).lower()
+
+
+def _parse_line(line: str, index: int, default_cache_mode: str) -> dict:
+    """
+    One input line: either a JSON string ("what is jaundice") or an object
+    {"id": ..., "query": ..., "cache_mode": ...}. `text_query` is accepted as an alias.
+    """
+    value = json.loads(line)
+    if isinstance(value, str):
+        value = {"query": value}
+    if not isinstance(value, dict):
+        raise ValueError("expected a JSON string or object")
+    query = value.get("query") or value.get("text_query")
+    if not isinstance(query, str) or not query.strip():
+        raise ValueError("missing 'query'")
+    cache_mode = value.get("cache_mode", default_cache_mode)
+    if cache_mode not in CACHE_MODES:
+        raise ValueError(f"cache_mode must be one of {', '.join(CACHE_MODES)}")
+    return {"index": index, "id": value.get("id", index), "query": query.strip(), "cache_mode": cache_mode}
+
+
+async def _spool_body(request: Request):
+    """
+    JSONL/NDJSON body, or the `file` field of a multipart form, as a file spooled
+    to disk past BATCH_SPOOL_MAX_MEMORY. Read in full before the response starts:
+    once it streams, Starlette's disconnect listener owns `receive`.
+    """
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="Multipart batch requests need a 'file' field.")
+        spool = upload.file
+        spool.seek(0)
+        lines = await asyncio.to_thread(
+            lambda: sum(chunk.count(b"\n") for chunk in iter(lambda: spool.read(64 * 1024), b""))
+        )
+    else:
+        spool = tempfile.SpooledTemporaryFile(max_size=BATCH_SPOOL_MAX_MEMORY)
+        lines = 0
+        async for chunk in request.stream():
+            lines += chunk.count(b"\n")
+            if lines > BATCH_MAX_ITEMS:
+                break  # counted blank lines too; only the cap matters here
+            await asyncio.to_thread(spool.write, chunk)
+    if lines > BATCH_MAX_ITEMS:
+        spool.close()
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {BATCH_MAX_ITEMS} items.")
+    spool.seek(0)
+    return spool
+
+
+async def _iter_lines(spool):
+    """Yields (index, line) for the non-blank lines of the spooled body."""
+    index, rest = 0, b""
+    while True:
+        chunk = await asyncio.to_thread(spool.read, 64 * 1024)
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop() if chunk else b""
+        for line in lines:
+            if line.strip():
+                yield index, line
+            index += 1
+        if not chunk:
+            return
+
+
+async def _run_pipeline(query: str, cache_mode: str) -> dict:
+    """
+    retrieve -> NER -> generate for one unique query, each upstream behind its own cap.
+    Each call gets a fresh deadline once it holds its slot, so time spent queueing
+    behind the cap doesn't count against it.
+    """
+    async with _limit("search"):
+        with deadline_scope(REQUEST_DEADLINE):
+            context_docs = await text_service.retrieve_from_web_async(query)
+    if len(context_docs) == 1 and context_docs[0].startswith("ERROR:"):
+        return {"status": "error", "error": context_docs[0]}
+
+    ner_results = text_service.extract_medical_entities_batch(context_docs)
+
+    async with _limit("llm"):
+        with deadline_scope(REQUEST_DEADLINE):
+            answer = await text_service.generate_answer_async(query, context_docs, cache_mode)
+    if answer.startswith("Answer Generation Failed"):
+        return {"status": "error", "error": answer, "source_documents": context_docs}
+
+    return {
+        "status": "success",
+        "answer": answer,
+        "source_documents": context_docs,
+        "ner_results": ner_results,
+    }
+
+# --- Batch Chat Endpoint ---
+
+@router.post("/batch/chat")
+async def batch_chat(request: Request, cache_mode: str = "use"):
+    """
+    Runs the text RAG pipeline for every query in a JSONL body (or uploaded file)
+    and streams one NDJSON line per input item as soon as it completes, followed
+    by a summary line `{"done": true, ...}`. Lines are read as BATCH_WORKERS
+    workers free up, so memory doesn't grow with the batch. Identical queries
+    (after whitespace/case normalisation) that are queued or running together
+    are computed once; failures are reported per item.
+    """
+    if cache_mode not in CACHE_MODES:
+        raise HTTPException(status_code=400, detail=f"cache_mode must be one of {', '.join(CACHE_MODES)}.")
+    set_mode("batch")
+
+    spool = await _spool_body(request)
+
+    def parse(index: int, line: bytes) -> dict:
+        try:
+            return _parse_line(line.decode("utf-8"), index, cache_mode)
+        except UnicodeDecodeError:
+            raise ValueError("not UTF-8")
+
+    async def results():
+        started = time.perf_counter()
+        counts = {"items": 0, "unique_queries": 0, "errors": 0}
+        pending = {}  # (normalised query, cache_mode) -> items waiting on that query
+        work = asyncio.Queue(maxsize=BATCH_WORKERS)
+        out = asyncio.Queue(maxsize=BATCH_WORKERS)
+
+        async def emit(entry: dict):
+            if entry["status"] != "success":
+                counts["errors"] += 1
+            await out.put(json.dumps(entry, ensure_ascii=False) + "\n")
+
+        async def read():
+            async for index, line in _iter_lines(spool):
+                counts["items"] += 1
+                try:
+                    item = parse(index, line)
+                except ValueError as e:  # json.JSONDecodeError is a ValueError
+                    await emit({"index": index, "id": index, "status": "error", "error": f"Invalid line: {e}"})
+                    continue
+                key = (_normalise(item["query"]), item["cache_mode"])
+                if key in pending:
+                    pending[key].append(item)  # joins the queued or running query
+                    continue
+                pending[key] = [item]
+                counts["unique_queries"] += 1
+                await work.put(key)
+
+        async def run_queries():
+            while True:
+                key = await work.get()
+                items = pending[key]
+                try:
+                    result = await _run_pipeline(items[0]["query"], items[0]["cache_mode"])
+                except Exception as e:
+                    logger.warning("Batch item error: %s", e)
+                    result = {"status": "error", "error": str(e)}
+                # Lines read after this point start the query again (and mostly hit the caches).
+                for item in pending.pop(key):
+                    await emit({"index": item["index"], "id": item["id"], "query": item["query"], **result})
+                work.task_done()
+
+        async def produce():
+            try:
+                await read()
+                await work.join()
+            finally:
+                await out.put(None)
+
+        tasks = [asyncio.create_task(run_queries()) for _ in range(max(1, BATCH_WORKERS))]
+        tasks.append(asyncio.create_task(produce()))
+        try:
+            while (line := await out.get()) is not None:
+                yield line
+        finally:
+            # Client went away (or the batch finished): stop any outstanding work.
+            for task in tasks:
+                task.cancel()
+            spool.close()
+
+        yield json.dumps({
+            "done": True,
+            **counts,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        }) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
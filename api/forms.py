@@ -0,0 +1,137 @@
+import codecs
+from fastapi import HTTPException, Request
+from python_multipart.multipart import MultipartParser, parse_options_header
+from python_multipart.exceptions import MultipartParseError
+from services.blob_store import blob_store, UploadTooLarge, UnsupportedImage
+from core.metrics import timed
+
+FORM_FIELD_MAX_BYTES = 1024 * 1024  # text fields; files are bounded by MAX_UPLOAD_BYTES
+
+
+class _StreamingForm:
+    """
+    Callbacks for python-multipart's push parser. Callbacks can't await, so they
+    queue what they saw; `read_form` applies it (blob writes, `on_field`) after
+    each network chunk, in arrival order.
+    """
+    def __init__(self, charset: str):
+        self.charset = charset
+        self.actions = []
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._content_type = None
+        self._name = None
+        self._filename = None
+        self._data = bytearray()
+
+    def on_part_begin(self):
+        self._disposition = b""
+        self._content_type = None
+        self._data = bytearray()
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        name = self._header_name.lower()
+        if name == b"content-disposition":
+            self._disposition = self._header_value
+        elif name == b"content-type":
+            self._content_type = self._header_value.decode("latin-1")
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        if b"name" not in options:
+            raise HTTPException(status_code=400, detail='Form part without a "name".')
+        self._name = options[b"name"].decode(self.charset, "replace")
+        filename = options.get(b"filename")
+        self._filename = filename.decode(self.charset, "replace") if filename is not None else None
+        if self._filename:
+            self.actions.append(("file_begin", self._name, (self._filename, self._content_type)))
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self._filename:
+            self.actions.append(("file_data", self._name, data[start:end]))
+        elif self._filename is None:
+            self._data += data[start:end]
+            if len(self._data) > FORM_FIELD_MAX_BYTES:
+                raise HTTPException(status_code=400, detail=f"Form field '{self._name}' is too large.")
+        # filename="" is an empty file input: ignored, as if the field were absent
+
+    def on_part_end(self):
+        if self._filename:
+            self.actions.append(("file_end", self._name, None))
+        elif self._filename is None:
+            self.actions.append(("field", self._name, self._data.decode(self.charset, "replace")))
+
+
+async def read_form(request: Request, on_field=None) -> tuple:
+    """
+    Reads a form body as it arrives instead of after it is complete. Text fields
+    are reported to `on_field(name, value)` the moment they end, so work can
+    start while a later file part is still uploading; image parts are streamed
+    straight into the blob store. Returns (fields, uploads): {name: str} and
+    {name: blob dict}. URL-encoded bodies are read whole (they are small).
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data":
+        fields = {k: v for k, v in (await request.form()).items() if isinstance(v, str)}
+        for name, value in fields.items():
+            if on_field is not None:
+                on_field(name, value)
+        return fields, {}
+    if b"boundary" not in params:
+        raise HTTPException(status_code=400, detail="Missing multipart boundary.")
+    charset = params.get(b"charset", b"utf-8").decode("latin-1")
+    try:
+        charset = codecs.lookup(charset).name
+    except LookupError:
+        charset = "latin-1"
+
+    form = _StreamingForm(charset)
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": form.on_part_begin,
+        "on_part_data": form.on_part_data,
+        "on_part_end": form.on_part_end,
+        "on_header_field": form.on_header_field,
+        "on_header_value": form.on_header_value,
+        "on_header_end": form.on_header_end,
+        "on_headers_finished": form.on_headers_finished,
+    })
+    fields, uploads, writers = {}, {}, {}
+    try:
+        with timed("upload"):
+            async for chunk in request.stream():
+                parser.write(chunk)
+                for action, name, value in form.actions:
+                    if action == "field":
+                        fields[name] = value
+                        if on_field is not None:
+                            on_field(name, value)
+                    elif action == "file_begin":
+                        filename, part_type = value
+                        if not (part_type or "").startswith("image/"):
+                            raise HTTPException(status_code=400, detail="Only image files are supported.")
+                        writers[name] = blob_store.writer(filename)
+                    elif action == "file_data":
+                        await writers[name].write(value)
+                    else:  # file_end
+                        uploads[name] = await writers.pop(name).close()
+                form.actions.clear()
+            parser.finalize()
+    except MultipartParseError as e:
+        raise HTTPException(status_code=400, detail=f"Malformed multipart body: {e}")
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UnsupportedImage as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    finally:
+        for writer in writers.values():
+            writer.abort()
+    return fields, uploads
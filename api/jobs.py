@@ -0,0 +1,110 @@
+import hashlib
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from fastapi.responses import JSONResponse
+from api.router import _image_and_text_graph, _image_and_text_result, _validate_cache_mode, _store_upload
+from api.streaming import _sse, _event_stream
+from api.batch import _normalise
+from core.jobs import job_manager, JobQueueFull, COMPLETED, FAILED
+from core.metrics import set_mode
+
+router = APIRouter()
+
+# Stage outputs forwarded in `stage` events (the analysis holds the raw image
+# descriptor, which is neither JSON nor useful to clients).
+PUBLIC_STAGE_OUTPUTS = {"describe", "retrieve", "ner", "image_search", "generate"}
+
+
+def _job_view(job: dict) -> dict:
+    view = {
+        "job_id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "stages": {
+            e["data"]["stage"]: e["data"]["status"] for e in job["events"] if e["event"] == "stage"
+        },
+    }
+    if job["status"] == COMPLETED:
+        view["result"] = job["result"]
+    elif job["status"] == FAILED:
+        view["error"] = job["error"]
+    return view
+
+
+def _image_and_text_job(query: str, blob: dict, filename: str | None, cache_mode: str):
+    async def run_job(progress):
+        def on_stage(name, status, result):
+            data = {"stage": name, "status": status}
+            if name in PUBLIC_STAGE_OUTPUTS and result is not None:
+                data["output"] = result
+            progress("stage", data)
+
+        run = await _image_and_text_graph(query, blob["path"], filename, cache_mode).run(on_stage=on_stage)
+        return {"mode": "image_and_text", **_image_and_text_result(run)}
+    return run_job
+
+# --- Background Jobs (image + text reasoning) ---
+
+@router.post("/jobs", status_code=202)
+async def submit_job(
+    text_query: str = Form(None),
+    file: UploadFile = File(...),
+    cache_mode: str = Form("use"),
+):
+    """
+    Queues image_and_text reasoning and returns a job id right away. Poll
+    `status_url` or follow `events_url` (SSE, one `stage` event per finished stage,
+    then `done`). The same image + question submitted while a job for it is still
+    queued or running returns that job instead of starting another.
+    """
+    _validate_cache_mode(cache_mode)
+    set_mode("job_submit")
+    query = (text_query or "").strip()
+    blob = await _store_upload(file)
+    key = hashlib.sha256(f"image_and_text\0{blob['digest']}\0{_normalise(query)}\0{cache_mode}".encode()).hexdigest()
+
+    try:
+        job, coalesced = await job_manager.submit(
+            "image_and_text", key, _image_and_text_job(query, blob, file.filename, cache_mode)
+        )
+    except JobQueueFull as e:
+        return JSONResponse(
+            status_code=503,
+            content={"detail": f"Too many queued jobs: {e}", "retry_after": 5},
+            headers={"Retry-After": "5"},
+        )
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "coalesced": coalesced,
+        "status_url": f"/jobs/{job['id']}",
+        "events_url": f"/jobs/{job['id']}/events",
+    }
+
+
+@router.get("/jobs/stats")
+async def job_stats():
+    return job_manager.stats()
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+    return _job_view(job)
+
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """SSE: past events are replayed first, so following a finished job also works."""
+    if await job_manager.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+
+    async def events():
+        async for event in job_manager.follow(job_id):
+            yield _sse(event["event"], event["data"])
+
+    return _event_stream(events())
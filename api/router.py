@@ -1,10 +1,21 @@
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Request
-from fastapi.responses import HTMLResponse
+import os
+import httpx
+import asyncio
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Request, Response
+from fastapi.responses import HTMLResponse, FileResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 from services.text_search import text_service
 from services.image_search import image_service
 from api.schemas import TextSearchResult, ImageSearchResult
-from services.image_search import image_service
+from core.pipeline import StageGraph
+from services.blob_store import blob_store, UploadTooLarge, UnsupportedImage, IMAGE_MEDIA_TYPES
+from services.image_proxy import image_proxy, ImageProxyError, IMAGE_PROXY_WIDTHS, IMAGE_PROXY_MAX_AGE
+from services.sessions import session_store, retrieve_for_turn, add_documents, history_messages, record_turn, public_view
+from core.cache import cache_stats, CACHE_MODES
+from core.metrics import render as render_metrics, set_mode
+from core.resilience import UpstreamError
+from core.speculation import speculation_scope, speculative
+from api.forms import read_form
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
@@ -16,6 +27,28 @@ async def serve_root(request: Request):
     """Serves the main unified search page."""
     return templates.TemplateResponse("index.html", {"request": request})
 
+# --- Cache Statistics ---
+
+@router.get("/cache/stats")
+async def cache_stats_endpoint():
+    """Hit/miss/eviction counters for every registered cache."""
+    return cache_stats()
+
+# --- Metrics (Prometheus) ---
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Latency histograms, upstream status counters and payload sizes in Prometheus text format."""
+    # With several workers this reads their published snapshots from disk.
+    return PlainTextResponse(await asyncio.to_thread(render_metrics), media_type="text/plain; version=0.0.4")
+
+def _validate_cache_mode(cache_mode: str):
+    if cache_mode not in CACHE_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"cache_mode must be one of {', '.join(CACHE_MODES)}.",
+        )
+
 # --- Web Image Search Endpoint ---
 
 @router.post("/search_image_web", response_model=ImageSearchResult)
@@ -25,9 +58,11 @@ async def search_image_web_endpoint(query: str = Form(...)):
         raise HTTPException(status_code=400, detail="Please provide a text query for the web image search.")
     
     try:
-        result = image_service.retrieve_image_from_web(query)
+        result = await image_service.retrieve_image_from_web_async(query)
         return result
-        
+
+    except UpstreamError:
+        raise  # 503 + Retry-After (see main.py), not a 500
     except Exception as e:
         print(f"Web Image Search Error: {e}")
         raise HTTPException(status_code=500, detail=f"Web Image Search Error: {e}")
@@ -37,24 +72,24 @@ async def search_image_web_endpoint(query: str = Form(...)):
 @router.post("/chat", response_model=TextSearchResult)
 async def unified_chat(
     text_query: str = Form(...), 
-    image_file: UploadFile = File(None) # File input is ignored
+    image_file: UploadFile = File(None), # File input is ignored
+    cache_mode: str = Form("use"),  # 'use', 'bypass', 'refresh' (answer cache)
 ):
     """Handles text query for Web RAG/NER."""
     if not text_query or not text_query.strip():
         raise HTTPException(status_code=400, detail="Please provide a text query.")
+    _validate_cache_mode(cache_mode)
+    set_mode("chat")
 
     try:
         # 1. RETRIEVE context from the Web
-        context_docs = text_service.retrieve_from_web(text_query)
+        context_docs = await text_service.retrieve_from_web_async(text_query)
         
-        # 2. PERFORM MEDICAL NER (NLP STEP)
-        ner_results = []
-        if context_docs:
-            most_relevant_doc = context_docs[0] 
-            ner_results = text_service.extract_medical_entities(most_relevant_doc)
+        # 2. PERFORM MEDICAL NER (NLP STEP) over every retrieved document
+        ner_results = text_service.extract_medical_entities_batch(context_docs)
         
         # 3. GENERATE answer (RAG Step)
-        generated_answer = text_service.generate_answer(text_query, context_docs)
+        generated_answer = await text_service.generate_answer_async(text_query, context_docs, cache_mode)
         
         # 4. Return the complete result
         return {
@@ -64,6 +99,8 @@ async def unified_chat(
             "ner_results": ner_results,
         }
 
+    except UpstreamError:
+        raise  # 503 + Retry-After (see main.py), not a 500
     except Exception as e:
         print(f"Web RAG/NLP Error: {e}")
         raise HTTPException(status_code=500, detail=f"Web RAG/NLP Error: {e}")
@@ -76,12 +113,172 @@ async def upload_image(file: UploadFile = File(...)):
     if file is None:
         raise HTTPException(status_code=400, detail="No file uploaded.")
 
-    if not file.content_type.startswith("image/"):
+    blob = await _store_upload(file)
+    result = await image_service.handle_uploaded_image_async(blob)
+    return result
+
+async def _store_upload(file: UploadFile) -> dict:
+    """Streams an image upload into the blob store, enforcing type and size limits."""
+    if not (file.content_type or "").startswith("image/"):
         raise HTTPException(status_code=400, detail="Only image files are supported.")
+    try:
+        return await image_service.store_upload_async(file)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UnsupportedImage as e:
+        raise HTTPException(status_code=415, detail=str(e))
+
+# --- Blob (upload) Routes ---
+
+def _blob_response(
+    request: Request, path: str, digest: str, media_type: str | None,
+    cache_control: str = "public, max-age=31536000, immutable",
+):
+    # Content-addressed: the URL can never point at different bytes, so cache forever.
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control, "X-Content-Type-Options": "nosniff"}
+    if media_type not in IMAGE_MEDIA_TYPES.values():
+        # Never render anything but known raster images inline from our origin.
+        media_type = "application/octet-stream"
+        headers["Content-Disposition"] = "attachment"
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+@router.get("/blobs/{digest}")
+async def get_blob(digest: str, request: Request):
+    """Original uploaded bytes."""
+    if not blob_store.exists(digest):
+        raise HTTPException(status_code=404, detail="Blob not found.")
+    media_type = blob_store.metadata(digest).get("content_type") or "application/octet-stream"
+    return _blob_response(request, blob_store.path_for(digest), digest, media_type)
+
+@router.get("/blobs/{digest}/preview")
+async def get_blob_preview(digest: str, request: Request):
+    """Downscaled WebP preview, rendered on first request and cached on disk."""
+    if not blob_store.exists(digest):
+        raise HTTPException(status_code=404, detail="Blob not found.")
+    preview_path = await blob_store.ensure_preview(digest)
+    if preview_path is None:
+        raise HTTPException(status_code=415, detail="Preview could not be generated for this file.")
+    return _blob_response(request, preview_path, f"{digest}-preview", "image/webp")
+
+# --- Image Proxy Route ---
+
+@router.get("/image-proxy")
+async def get_proxied_image(request: Request, u: str, w: int, s: str):
+    """Resized WebP copy of a (signed) third-party search result image."""
+    if w not in IMAGE_PROXY_WIDTHS or not image_proxy.verify(u, w, s):
+        raise HTTPException(status_code=403, detail="Invalid image proxy URL.")
+    try:
+        path, key = await image_proxy.fetch(u, w)
+    except (ImageProxyError, httpx.HTTPError) as e:
+        print(f"Image Proxy Error for {u}: {e}")
+        raise HTTPException(status_code=502, detail="Upstream image unavailable.")
+    return _blob_response(request, path, key, "image/webp", f"public, max-age={IMAGE_PROXY_MAX_AGE}")
+
+# --- Multimodal Stage Graphs ---
+# Per-stage budgets; a slow stage only drops its own output (and its dependents).
+SEARCH_STAGE_TIMEOUT = float(os.getenv("SEARCH_STAGE_TIMEOUT", "15"))
+LLM_STAGE_TIMEOUT = float(os.getenv("LLM_STAGE_TIMEOUT", "45"))
+STAGE_UNAVAILABLE_ANSWER = (
+    "The answer could not be generated in time. "
+    "Showing the retrieved sources and images only."
+)
+
+
+def _text_to_image_graph(query: str, cache_mode: str = "use") -> StageGraph:
+    """Image search and text retrieval are independent; only generation waits on retrieval."""
+    explain_prompt = (
+        f"Describe what a typical image illustrating '{query}' would look like. "
+        "Answer in 2 complete sentences. Make sure the final sentence is complete "
+        "and does not end abruptly."
+    )
+    graph = StageGraph()
+    graph.add_stage(
+        "image_search",
+        lambda r: speculative("image_search", query, lambda: image_service.retrieve_image_from_web_async(query)),
+        timeout=SEARCH_STAGE_TIMEOUT,
+    )
+    graph.add_stage(
+        "retrieve",
+        lambda r: speculative("retrieve", query, lambda: text_service.retrieve_from_web_async(query)),
+        timeout=SEARCH_STAGE_TIMEOUT,
+    )
+    graph.add_stage(
+        "generate",
+        lambda r: text_service.generate_answer_async(explain_prompt, r["retrieve"], cache_mode),
+        depends_on=["retrieve"],
+        timeout=LLM_STAGE_TIMEOUT,
+    )
+    return graph
+
+
+def _image_and_text_graph(
+    query: str, image_path: str, filename: str | None, cache_mode: str = "use"
+) -> StageGraph:
+    """
+    analyze -> (describe -> generate, NER) and analyze -> similar images; retrieval runs
+    on the user's query alone, in parallel with analysis. The image description is a
+    poor search query but still steers generation and context packing.
+    """
+    filename_base = (filename or "medical image").rsplit(".", 1)[0]
+
+    async def analyze(r):
+        return await image_service.analyze_uploaded_image_async(image_path)
+
+    async def describe(r):
+        img_description = image_service.describe_uploaded_image(r["analyze"])
+        return f"{query}\n\nImage description: {img_description}"
+
+    async def ner(r):
+        return text_service.extract_medical_entities(r["describe"])
+
+    graph = StageGraph()
+    graph.add_stage("analyze", analyze)
+    graph.add_stage("describe", describe, depends_on=["analyze"])
+    graph.add_stage(
+        "image_search",
+        lambda r: image_service.find_similar_images_async(r["analyze"], query or filename_base),
+        depends_on=["analyze"],
+        timeout=SEARCH_STAGE_TIMEOUT,
+    )
+    graph.add_stage(
+        "retrieve",
+        lambda r: speculative("retrieve", query, lambda: text_service.retrieve_from_web_async(query)),
+        timeout=SEARCH_STAGE_TIMEOUT,
+    )
+    graph.add_stage("ner", ner, depends_on=["describe"])
+    graph.add_stage(
+        "generate",
+        lambda r: text_service.generate_answer_async(r["describe"], r["retrieve"], cache_mode),
+        depends_on=["describe", "retrieve"],
+        timeout=LLM_STAGE_TIMEOUT,
+    )
+    return graph
+
+
+def _image_and_text_result(run) -> dict:
+    """Response fields of a finished image_and_text graph (shared with /jobs)."""
+    stages = run.summary()
+    message = "Combined text + image reasoning completed."
+    if stages["failed"] or stages["skipped"]:
+        message = "Combined text + image reasoning partially completed."
+    image_search = run.get("image_search") or {}
+    if image_search.get("source") == "web_search":
+        message = f"{message} {image_search.get('message', '')}".strip()
+    return {
+        "answer": run.get("generate") if run.ok("generate") else STAGE_UNAVAILABLE_ANSWER,
+        "images": image_search.get("results", []),
+        "ner_results": run.get("ner", []),
+        "source_documents": run.get("retrieve", []),
+        "message": message,
+        "stages": stages,
+    }
+
+
+IMAGE_REQUEST_KEYWORDS = ("image", "picture", "photo", "show me", "see")
 
-    file_bytes = await file.read()
-    result = image_service.handle_uploaded_image(file_bytes, file.content_type)
-    return result
 
 def _resolve_mode_auto(text_query: str, has_image: bool) -> str:
     """
@@ -94,45 +291,126 @@ def _resolve_mode_auto(text_query: str, has_image: bool) -> str:
         return "image_and_text"      # combined
     if has_text:
         lower = text_query.lower()
-        if any(k in lower for k in ["image", "picture", "photo", "show me", "see"]):
+        if any(k in lower for k in IMAGE_REQUEST_KEYWORDS):
             return "text_to_image"   # 'show me an image of X'
         return "text_to_text"        # normal RAG question
     return "text_to_text"
 
+# --- Speculative Prefetch ---
+# Searches each mode will run with the user's query; anything else started early is cancelled.
+SPECULATIVE_SEARCHES = {
+    "text_to_text": ("retrieve",),
+    "text_to_image": ("retrieve", "image_search"),
+    "image_and_text": ("retrieve",),
+    "image_to_text": (),
+}
 
-@router.post("/multimodal_chat")
-async def multimodal_chat(
-    text_query: str = Form(None),
-    mode: str = Form("auto"),  # 'auto', 'text_to_text', 'text_to_image', 'image_to_text', 'image_and_text'
-    file: UploadFile = File(None),
-):
+
+def _speculate(speculation, fields: dict):
+    """
+    Called as each form field arrives, usually before the upload has been read.
+    The mode is not known yet, so start the searches the likely modes share:
+    retrieval for any text query, and the (cheap, cached) image search when
+    the text asks for pictures.
+    """
+    query = (fields.get("text_query") or "").strip()
+    mode = fields.get("mode", "auto")
+    if not query:
+        return
+    candidates = SPECULATIVE_SEARCHES.keys() if mode == "auto" else [mode]
+    if any("retrieve" in SPECULATIVE_SEARCHES.get(m, ()) for m in candidates):
+        speculation.start("retrieve", query, lambda: text_service.retrieve_from_web_async(query))
+    else:
+        speculation.cancel("retrieve")
+    if mode == "text_to_image" or (mode == "auto" and _resolve_mode_auto(query, False) == "text_to_image"):
+        speculation.start("image_search", query, lambda: image_service.retrieve_image_from_web_async(query))
+    else:
+        speculation.cancel("image_search")
+
+
+MULTIMODAL_CHAT_FORM = {
+    "requestBody": {
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "text_query": {"type": "string"},
+                        "mode": {"type": "string", "default": "auto", "enum": ["auto", *SPECULATIVE_SEARCHES]},
+                        "file": {"type": "string", "format": "binary"},
+                        "cache_mode": {"type": "string", "default": "use", "enum": list(CACHE_MODES)},
+                        "session_id": {"type": "string"},
+                    },
+                }
+            }
+        },
+    }
+}
+
+
+@router.post("/multimodal_chat", openapi_extra=MULTIMODAL_CHAT_FORM)
+async def multimodal_chat(request: Request):
     """
     Unified multimodal chat endpoint.
     - text only -> text-to-text (RAG)
     - text mentioning 'image/picture/...' -> text-to-image
     - image only -> image-to-text (+ similar images)
-    - image + text -> combined reasoning (stubbed)
+    - image + text -> image analysis, description and similar images alongside
+      retrieval on the query, then a grounded answer (StageGraph pipeline)
+    Multi-stage modes run through a StageGraph and report per-stage outcomes in `stages`.
+    Every response carries a `session_id`; sending it back makes the next call a
+    follow-up turn that reuses the session's documents and history.
+    The form is read as it streams in: retrieval for `text_query` starts as soon
+    as that field arrives, overlapping the image upload (send it before `file`).
     """
-    has_image = file is not None
-    resolved_mode = _resolve_mode_auto(text_query, has_image) if mode == "auto" else mode
+    with speculation_scope() as speculation:
+        seen = {}
+
+        def on_field(name: str, value: str):
+            seen[name] = value
+            _speculate(speculation, seen)
+
+        fields, uploads = await read_form(request, on_field)
+        text_query = fields.get("text_query")
+        mode = fields.get("mode", "auto")
+        cache_mode = fields.get("cache_mode", "use")
+        blob = uploads.get("file")
+
+        _validate_cache_mode(cache_mode)
+        resolved_mode = _resolve_mode_auto(text_query, blob is not None) if mode == "auto" else mode
+        set_mode(resolved_mode)
+        for kind in ("retrieve", "image_search"):
+            if kind not in SPECULATIVE_SEARCHES.get(resolved_mode, ()):
+                speculation.cancel(kind)
+
+        # Normalise query
+        query = (text_query or "").strip()
+
+        async with session_store.turn(fields.get("session_id")) as session:
+            result = await _multimodal_turn(resolved_mode, query, blob, cache_mode, session)
+        result["session_id"] = session["id"] if session else None
+        return result
 
-    # Normalise query
-    query = (text_query or "").strip()
 
+async def _multimodal_turn(resolved_mode: str, query: str, blob: dict | None, cache_mode: str, session) -> dict:
+    has_image = blob is not None
     answer = None
     images = []
     ner_results = []
     source_documents = []
     message = ""
+    stages = None
     
     # --- TEXT → TEXT (RAG) ---
     if resolved_mode == "text_to_text":
         if not query:
             raise HTTPException(status_code=400, detail="text_query is required for text_to_text mode.")
 
-        source_documents = text_service.retrieve_from_web(query)
         ner_results = text_service.extract_medical_entities(query)
-        answer = text_service.generate_answer(query, source_documents)
+        source_documents, _ = await retrieve_for_turn(session, query, ner_results)
+        answer = await text_service.generate_answer_async(
+            query, source_documents, cache_mode, history_messages(session)
+        )
         message = "RAG/NLP text answer generated."
 
     # --- TEXT → IMAGE ---
@@ -140,70 +418,46 @@ async def multimodal_chat(
         if not query:
             raise HTTPException(status_code=400, detail="text_query is required for text_to_image mode.")
 
-        img_result = image_service.retrieve_image_from_web(query)
+        run = await _text_to_image_graph(query, cache_mode).run()
+        stages = run.summary()
+
+        img_result = run.get("image_search") or {}
         images = img_result.get("results", [])
         message = img_result.get("message", "Text-to-image web search complete.")
-
-        # Optional: also generate a short text explanation based on snippets
-        source_documents = text_service.retrieve_from_web(query)
-        answer = text_service.generate_answer(
-    (
-        f"Describe what a typical image illustrating '{query}' would look like. "
-        "Answer in 2 complete sentences. Make sure the final sentence is complete "
-        "and does not end abruptly."
-    ),
-    source_documents
-)
-
+        source_documents = run.get("retrieve", [])
+        answer = run.get("generate") if run.ok("generate") else STAGE_UNAVAILABLE_ANSWER
 
     # --- IMAGE → TEXT (and IMAGE → IMAGE) ---
     elif resolved_mode == "image_to_text":
         if not has_image:
             raise HTTPException(status_code=400, detail="Image file is required for image_to_text mode.")
 
-        file_bytes = await file.read()
-
-        # Preview (data URL) if you want to show uploaded image
-        preview_data = image_service.handle_uploaded_image(file_bytes, file.content_type)
-        # text explanation
-        answer = image_service.describe_uploaded_image(file_bytes)
-
-        # For image→image, we can use filename (without extension) as a loose query
-        filename_base = (file.filename or "medical image").rsplit(".", 1)[0]
-        img_result = image_service.retrieve_image_from_web(filename_base)
-        images = img_result.get("results", [])
-        message = "Image uploaded and described. Retrieved similar web images."
-
-        # You can also call text_service here if you want RAG over some concept
-        source_documents = []  # or some RAG based on filename_base if you want
-
-        # Optionally include preview
-        preview = preview_data.get("preview")
-        if preview:
-            images = [preview] + images
+        explained = await image_service.explain_upload_async(blob, blob["filename"], cache_mode)
+        answer = explained["answer"]
+        images = explained["images"]
+        message = explained["message"]
 
     # --- IMAGE + TEXT combined ---
     elif resolved_mode == "image_and_text":
         if not has_image:
             raise HTTPException(status_code=400, detail="Image file is required for image_and_text mode.")
-        file_bytes = await file.read()
-
-        # Basic description
-        img_description = image_service.describe_uploaded_image(file_bytes)
-        combined_query = f"{query}\n\nImage description: {img_description}"
 
-        source_documents = text_service.retrieve_from_web(combined_query)
-        ner_results = text_service.extract_medical_entities(combined_query)
-        answer = text_service.generate_answer(combined_query, source_documents)
-
-        filename_base = (file.filename or "medical image").rsplit(".", 1)[0]
-        img_result = image_service.retrieve_image_from_web(filename_base)
-        images = img_result.get("results", [])
-        message = "Combined text + image reasoning completed."
+        run = await _image_and_text_graph(query, blob["path"], blob["filename"], cache_mode).run()
+        combined = _image_and_text_result(run)
+        stages = combined["stages"]
+        source_documents = combined["source_documents"]
+        ner_results = combined["ner_results"]
+        answer = combined["answer"]
+        images = combined["images"]
+        message = combined["message"]
 
     else:
         raise HTTPException(status_code=400, detail=f"Unknown mode: {resolved_mode}")
 
+    if resolved_mode != "text_to_text":
+        add_documents(session, source_documents)
+    record_turn(session, query or f"[image: {blob['filename']}]", answer, ner_results)
+
     return {
         "mode": resolved_mode,
         "answer": answer,
@@ -211,4 +465,21 @@ async def multimodal_chat(
         "ner_results": ner_results,
         "source_documents": source_documents,
         "message": message,
-    }
\ No newline at end of file
+        "stages": stages,
+    }
+
+# --- Conversation Sessions ---
+
+@router.get("/sessions/{session_id}")
+async def get_session(session_id: str):
+    """Prior turns and entities of a conversation (e.g. to restore a chat after reload)."""
+    session = await session_store.load(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired.")
+    return public_view(session)
+
+
+@router.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    await session_store.delete(session_id)
+    return {"status": "success", "session_id": session_id}
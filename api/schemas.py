@@ -1,11 +1,15 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 # --- NER Entity ---
 class NEREntity(BaseModel):
     entity_group: str
     score: float
     word: str
+    concept_id: Optional[str] = None
+    start: Optional[int] = None  # character offsets within the tagged text
+    end: Optional[int] = None
+    doc_index: Optional[int] = None  # which source document, for batch tagging
     
 # --- Search Results ---
 class TextSearchResult(BaseModel):
@@ -16,5 +20,5 @@ class TextSearchResult(BaseModel):
 
 class ImageSearchResult(BaseModel):
     status: str
-    results: List[str] # List of Base64 Data URLs
+    results: List[str] # Image URLs; web results point at /image-proxy (resized, cached)
     message: str | None = None
\ No newline at end of file
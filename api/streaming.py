@@ -0,0 +1,220 @@
+import json
+import logging
+import asyncio
+from fastapi import APIRouter, Form, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from services.text_search import text_service
+from services.image_search import image_service
+from api.router import (
+    _resolve_mode_auto, _validate_cache_mode, _speculate, SPECULATIVE_SEARCHES, MULTIMODAL_CHAT_FORM,
+)
+from api.forms import read_form
+from core.metrics import set_mode
+from core.speculation import Speculation, speculation_scope, speculative
+from services.sessions import session_store, retrieve_for_turn, add_documents, history_messages, record_turn
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# --- Server-Sent Events helpers ---
+# Event order per request: meta -> sources / ner / images (as soon as known)
+# -> token* -> done. Failures are reported as an `error` event, not an HTTP 500,
+# because the status line has already been sent by then.
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # disable proxy buffering (nginx)
+}
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _stream_tokens(query: str, source_documents: list, cache_mode: str, history: list = None, on_done=None):
+    answer_parts = []
+    async for text in text_service.stream_answer_async(query, source_documents, cache_mode, history):
+        answer_parts.append(text)
+        yield _sse("token", {"text": text})
+    answer = "".join(answer_parts)
+    if on_done is not None:
+        on_done(answer)
+    yield _sse("done", {"answer": answer})
+
+
+def _event_stream(events):
+    async def guarded():
+        try:
+            async for chunk in events:
+                yield chunk
+        except Exception as e:
+            logger.exception("Streaming error")
+            yield _sse("error", {"detail": f"Streaming Error: {e}"})
+    return StreamingResponse(guarded(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+# --- Streaming Text Chat (Web RAG/NER) ---
+
+@router.post("/chat/stream")
+async def unified_chat_stream(
+    text_query: str = Form(...),
+    cache_mode: str = Form("use"),
+):
+    """SSE variant of /chat: sources and NER first, then the answer token by token."""
+    if not text_query or not text_query.strip():
+        raise HTTPException(status_code=400, detail="Please provide a text query.")
+    _validate_cache_mode(cache_mode)
+    set_mode("chat_stream")
+
+    async def events():
+        context_docs = await text_service.retrieve_from_web_async(text_query)
+        yield _sse("sources", {"source_documents": context_docs})
+
+        ner_results = text_service.extract_medical_entities_batch(context_docs)
+        yield _sse("ner", {"ner_results": ner_results})
+
+        async for chunk in _stream_tokens(text_query, context_docs, cache_mode):
+            yield chunk
+
+    return _event_stream(events())
+
+# --- Streaming Multimodal Chat ---
+
+@router.post("/multimodal_chat/stream", openapi_extra=MULTIMODAL_CHAT_FORM)
+async def multimodal_chat_stream(request: Request):
+    """
+    SSE variant of /multimodal_chat. Retrieval results, NER and images are sent
+    as soon as they are available; the LLM answer follows as `token` events.
+    The `meta` event carries the `session_id` to send with the next turn.
+    Like /multimodal_chat, retrieval starts as soon as `text_query` arrives,
+    while the image is still uploading.
+    """
+    # Outlives this handler: the event stream below takes the prefetched searches.
+    speculation = Speculation()
+    seen = {}
+
+    def on_field(name: str, value: str):
+        seen[name] = value
+        _speculate(speculation, seen)
+
+    try:
+        # Uploads are stored while the form is read; the body is gone once streaming starts.
+        fields, uploads = await read_form(request, on_field)
+        text_query = fields.get("text_query")
+        mode = fields.get("mode", "auto")
+        cache_mode = fields.get("cache_mode", "use")
+        session_id = fields.get("session_id")
+        blob = uploads.get("file")
+
+        _validate_cache_mode(cache_mode)
+        has_image = blob is not None
+        resolved_mode = _resolve_mode_auto(text_query, has_image) if mode == "auto" else mode
+        set_mode(f"{resolved_mode}_stream")
+        query = (text_query or "").strip()
+
+        if resolved_mode not in ("text_to_text", "text_to_image", "image_to_text", "image_and_text"):
+            raise HTTPException(status_code=400, detail=f"Unknown mode: {resolved_mode}")
+        if resolved_mode in ("text_to_text", "text_to_image") and not query:
+            raise HTTPException(status_code=400, detail=f"text_query is required for {resolved_mode} mode.")
+        if resolved_mode in ("image_to_text", "image_and_text") and not has_image:
+            raise HTTPException(status_code=400, detail=f"Image file is required for {resolved_mode} mode.")
+    except BaseException:
+        speculation.close()
+        raise
+    for kind in ("retrieve", "image_search"):
+        if kind not in SPECULATIVE_SEARCHES.get(resolved_mode, ()):
+            speculation.cancel(kind)
+    filename = blob["filename"] if has_image else None
+    filename_base = (filename or "medical image").rsplit(".", 1)[0]
+
+    async def events():
+        with speculation_scope(speculation):
+            async for chunk in turn_events():
+                yield chunk
+
+    async def turn_events():
+        async with session_store.turn(session_id) as session:
+            yield _sse("meta", {"mode": resolved_mode, "session_id": session["id"] if session else None})
+            async for chunk in mode_events(session):
+                yield chunk
+
+    async def mode_events(session):
+        if resolved_mode == "text_to_text":
+            ner_results = text_service.extract_medical_entities(query)
+            source_documents, _ = await retrieve_for_turn(session, query, ner_results)
+            yield _sse("sources", {"source_documents": source_documents})
+            yield _sse("ner", {"ner_results": ner_results})
+            async for chunk in _stream_tokens(
+                query, source_documents, cache_mode, history_messages(session),
+                on_done=lambda answer: record_turn(session, query, answer, ner_results),
+            ):
+                yield chunk
+
+        elif resolved_mode == "text_to_image":
+            image_task = asyncio.create_task(speculative(
+                "image_search", query, lambda: image_service.retrieve_image_from_web_async(query)
+            ))
+            try:
+                source_documents = await speculative(
+                    "retrieve", query, lambda: text_service.retrieve_from_web_async(query)
+                )
+                yield _sse("sources", {"source_documents": source_documents})
+                img_result = await image_task
+            finally:
+                image_task.cancel()
+            yield _sse("images", {"images": img_result.get("results", []), "message": img_result.get("message")})
+            add_documents(session, source_documents)
+            explain_prompt = (
+                f"Describe what a typical image illustrating '{query}' would look like. "
+                "Answer in 2 complete sentences. Make sure the final sentence is complete "
+                "and does not end abruptly."
+            )
+            async for chunk in _stream_tokens(
+                explain_prompt, source_documents, cache_mode,
+                on_done=lambda answer: record_turn(session, query, answer),
+            ):
+                yield chunk
+
+        elif resolved_mode == "image_to_text":
+            explained = await image_service.explain_upload_async(blob, filename, cache_mode)
+            yield _sse("images", {"images": explained["images"], "message": explained["message"]})
+            answer = explained["answer"]
+            record_turn(session, query or f"[image: {filename}]", answer)
+            yield _sse("token", {"text": answer})
+            yield _sse("done", {"answer": answer})
+
+        else:  # image_and_text
+            # Retrieval uses the user's query alone, so it overlaps with image analysis.
+            retrieve_task = asyncio.create_task(
+                speculative("retrieve", query, lambda: text_service.retrieve_from_web_async(query))
+            )
+            image_task = None
+            try:
+                analysis = await image_service.analyze_uploaded_image_async(blob["path"])
+                image_task = asyncio.create_task(
+                    image_service.find_similar_images_async(analysis, query or filename_base)
+                )
+                img_description = image_service.describe_uploaded_image(analysis)
+                combined_query = f"{query}\n\nImage description: {img_description}"
+                source_documents = await retrieve_task
+                yield _sse("sources", {"source_documents": source_documents})
+                ner_results = text_service.extract_medical_entities(combined_query)
+                yield _sse("ner", {"ner_results": ner_results})
+                img_result = await image_task
+            finally:
+                retrieve_task.cancel()
+                if image_task is not None:
+                    image_task.cancel()
+            yield _sse("images", {
+                "images": img_result.get("results", []),
+                "message": img_result.get("message"),
+                "source": img_result.get("source"),
+            })
+            add_documents(session, source_documents)
+            async for chunk in _stream_tokens(
+                combined_query, source_documents, cache_mode,
+                on_done=lambda answer: record_turn(session, query, answer, ner_results),
+            ):
+                yield chunk
+
+    return _event_stream(events())
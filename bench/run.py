@@ -0,0 +1,331 @@
+"""
+Load-test harness: runs the app against local stub upstreams (bench/stubs.py)
+at fixed concurrency levels per mode and writes a JSON report.
+
+    python -m bench.run                                   # all modes, default levels
+    python -m bench.run --modes text_to_text --concurrency 1,16 --duration 20
+    python -m bench.run --save-baseline                   # store bench/baseline.json
+    python -m bench.run --baseline bench/baseline.json    # compare; exit 1 on regression
+
+Queries are made unique per request so the search/answer caches don't hide
+upstream cost; pass --cache to measure the warm-cache path instead.
+"""
+import io
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import subprocess
+import tempfile
+import httpx
+from PIL import Image
+from bench.stubs import DEFAULT_STUB_CONFIG
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+MODES = ("text_to_text", "text_to_image", "image_to_text", "image_and_text")
+MODE_QUERIES = {
+    "text_to_text": "what are the symptoms of jaundice",
+    "text_to_image": "show me an image of psoriasis",
+    "image_to_text": "",
+    "image_and_text": "is this rash serious",
+}
+LAG_METRIC = "event_loop_lag_distribution_seconds"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_server(target: str, port: int, env: dict, log_path: str) -> subprocess.Popen:
+    # Server output (the app prints per request) goes to a log file, not the report.
+    with open(log_path, "ab") as log:
+        return subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", target, "--host", "127.0.0.1", "--port", str(port),
+             "--log-level", "warning", "--no-access-log"],
+            cwd=REPO_DIR, env={**os.environ, **env}, stdout=log, stderr=subprocess.STDOUT,
+        )
+
+
+async def _wait_ready(url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+
+def _rss_kb(pid: int) -> dict:
+    """Current and peak resident set size from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return {"rss_kb": int(fields["VmRSS"].split()[0]), "peak_rss_kb": int(fields["VmHWM"].split()[0])}
+    except (OSError, KeyError, ValueError):
+        return {"rss_kb": None, "peak_rss_kb": None}
+
+
+def _test_image(width: int, height: int) -> bytes:
+    buf = io.BytesIO()
+    Image.effect_noise((width, height), 48).convert("RGB").save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+
+def _percentile(sorted_values: list, q: float):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(q / 100.0 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+# --- App metrics (from /metrics) ---
+
+def _metric_value(metrics_text: str, name: str):
+    for line in metrics_text.splitlines():
+        if line.startswith(name + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+def _lag_histogram(metrics_text: str) -> dict:
+    buckets, total, count = {}, 0.0, 0
+    for line in metrics_text.splitlines():
+        if line.startswith(f"{LAG_METRIC}_bucket"):
+            le = line.split('le="', 1)[1].split('"', 1)[0]
+            buckets[float("inf") if le == "+Inf" else float(le)] = int(float(line.rsplit(" ", 1)[1]))
+        elif line.startswith(f"{LAG_METRIC}_sum"):
+            total = float(line.rsplit(" ", 1)[1])
+        elif line.startswith(f"{LAG_METRIC}_count"):
+            count = int(float(line.rsplit(" ", 1)[1]))
+    return {"buckets": buckets, "sum": total, "count": count}
+
+
+def _lag_summary(before: dict, after: dict) -> dict:
+    count = after["count"] - before["count"]
+    if count <= 0:
+        return {"loop_lag_mean_ms": None, "loop_lag_p99_ms": None}
+    p99 = None
+    for bound in sorted(after["buckets"]):
+        if after["buckets"][bound] - before["buckets"].get(bound, 0) >= 0.99 * count:
+            p99 = bound
+            break
+    return {
+        "loop_lag_mean_ms": round((after["sum"] - before["sum"]) / count * 1000, 2),
+        # Upper bound of the histogram bucket holding the 99th percentile.
+        "loop_lag_p99_ms": None if p99 in (None, float("inf")) else round(p99 * 1000, 2),
+    }
+
+# --- Load generation ---
+
+async def _run_level(client, base_url: str, mode: str, concurrency: int, duration: float,
+                     image_bytes: bytes, use_cache: bool) -> dict:
+    latencies, errors, degraded, statuses = [], 0, 0, {}
+    counter = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors, degraded, counter
+        while time.perf_counter() < deadline:
+            counter += 1
+            data = {"mode": mode, "cache_mode": "use" if use_cache else "bypass"}
+            query = MODE_QUERIES[mode]
+            if query:
+                data["text_query"] = query if use_cache else f"{query} #{counter}"
+            files = {"file": (f"upload{'' if use_cache else counter}.jpg", image_bytes, "image/jpeg")} \
+                if mode.startswith("image_") else None
+            started = time.perf_counter()
+            try:
+                response = await client.post(f"{base_url}/multimodal_chat", data=data, files=files)
+                status = response.status_code
+                # Upstream failures are folded into a 200 answer; count them separately.
+                if status == 200 and "Answer Generation Failed" in response.text:
+                    degraded += 1
+            except httpx.HTTPError:
+                status = "transport_error"
+            elapsed = time.perf_counter() - started
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status == 200:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    wall = time.perf_counter() - started
+    latencies.sort()
+    ms = lambda v: None if v is None else round(v * 1000, 1)
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "degraded": degraded,
+        "statuses": statuses,
+        "throughput_rps": round(len(latencies) / wall, 2),
+        "p50_ms": ms(_percentile(latencies, 50)),
+        "p95_ms": ms(_percentile(latencies, 95)),
+        "p99_ms": ms(_percentile(latencies, 99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+    }
+
+
+async def run_benchmark(args) -> dict:
+    stub_config = {**DEFAULT_STUB_CONFIG, **json.loads(args.stub_config or "{}")}
+    for key in ("search_latency_ms", "llm_latency_ms", "search_error_rate", "llm_error_rate"):
+        value = getattr(args, key)
+        if value is not None:
+            stub_config[key] = value
+
+    stub_port, app_port = _free_port(), _free_port()
+    stub_url, app_url = f"http://127.0.0.1:{stub_port}", f"http://127.0.0.1:{app_port}"
+    # The app's data dir is scratch; server logs go next to the report so they outlive it.
+    data_dir = tempfile.TemporaryDirectory(prefix="bench-data-")
+    log_path = f"{os.path.splitext(args.output)[0]}.servers.log"
+    os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+    open(log_path, "wb").close()
+    print(f"Server logs: {log_path}")
+    stubs = _start_server("bench.stubs:app", stub_port, {"BENCH_STUB_CONFIG": json.dumps(stub_config)}, log_path)
+    app = _start_server("main:app", app_port, {
+        "SERPAPI_API_KEY": "bench",
+        "HUGGINGFACE_API_KEY": "bench",
+        "SERPAPI_SEARCH_URL": f"{stub_url}/search.json",
+        "HUGGINGFACE_RAG_API_URL": f"{stub_url}/v1/chat/completions",
+        "SEARCH_BACKEND": "serpapi",
+        "DATA_DIR": data_dir.name,
+        "EVENT_LOOP_LAG_INTERVAL": "0.05",
+    }, log_path)
+    report = {
+        "meta": {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "cache": args.cache,
+            "stub_config": stub_config,
+        },
+        "results": {},
+    }
+    try:
+        await _wait_ready(f"{stub_url}/docs")
+        await _wait_ready(f"{app_url}/metrics")
+        async with httpx.AsyncClient() as client:
+            cold_start = _metric_value((await client.get(f"{app_url}/metrics")).text, "worker_cold_start_seconds")
+        report["meta"]["worker_cold_start_s"] = cold_start
+        print(f"App worker cold start: {cold_start}s")
+        image_bytes = _test_image(*args.image_size)
+        limits = httpx.Limits(max_connections=max(args.concurrency) + 8)
+        async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+            for mode in args.modes:
+                report["results"][mode] = {}
+                for concurrency in args.concurrency:
+                    if args.warmup > 0:
+                        await _run_level(client, app_url, mode, concurrency, args.warmup, image_bytes, args.cache)
+                    lag_before = _lag_histogram((await client.get(f"{app_url}/metrics")).text)
+                    result = await _run_level(
+                        client, app_url, mode, concurrency, args.duration, image_bytes, args.cache
+                    )
+                    lag_after = _lag_histogram((await client.get(f"{app_url}/metrics")).text)
+                    result.update(_lag_summary(lag_before, lag_after))
+                    result.update(_rss_kb(app.pid))
+                    report["results"][mode][str(concurrency)] = result
+                    print(f"{mode:15s} c={concurrency:<4d} {result['throughput_rps']:8.2f} rps  "
+                          f"p50={result['p50_ms']}ms p95={result['p95_ms']}ms p99={result['p99_ms']}ms  "
+                          f"errors={result['errors']} degraded={result['degraded']} lag_p99={result['loop_lag_p99_ms']}ms rss={result['rss_kb']}kB")
+    finally:
+        for process in (app, stubs):
+            process.terminate()
+        for process in (app, stubs):
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        data_dir.cleanup()
+    return report
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# --- Baseline comparison ---
+
+def compare(report: dict, baseline: dict, max_regression: float) -> list:
+    """Rows of (mode, concurrency, metric, baseline, current, change); flags regressions."""
+    rows, regressions = [], []
+    for mode, levels in report["results"].items():
+        for concurrency, current in levels.items():
+            base = baseline.get("results", {}).get(mode, {}).get(concurrency)
+            if not base:
+                continue
+            for metric, higher_is_better in (("throughput_rps", True), ("p95_ms", False), ("p99_ms", False)):
+                old, new = base.get(metric), current.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                regressed = (-change if higher_is_better else change) > max_regression
+                rows.append((mode, concurrency, metric, old, new, change, regressed))
+                if regressed:
+                    regressions.append(f"{mode} c={concurrency} {metric}: {old} -> {new} ({change:+.1%})")
+    for mode, concurrency, metric, old, new, change, regressed in rows:
+        print(f"{mode:15s} c={concurrency:<4s} {metric:15s} {old:>10} -> {new:>10} {change:+7.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the chatbot API against local stub upstreams.")
+    parser.add_argument("--modes", type=lambda s: s.split(","), default=list(MODES))
+    parser.add_argument("--concurrency", type=lambda s: [int(c) for c in s.split(",")], default=[1, 8, 32])
+    parser.add_argument("--duration", type=float, default=15.0, help="seconds measured per level")
+    parser.add_argument("--warmup", type=float, default=3.0, help="seconds discarded before each level")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--cache", action="store_true", help="repeat identical queries (warm caches)")
+    parser.add_argument("--image-size", type=lambda s: [int(v) for v in s.split("x")], default=[1600, 1200])
+    parser.add_argument("--search-latency-ms", type=float)
+    parser.add_argument("--llm-latency-ms", type=float)
+    parser.add_argument("--search-error-rate", type=float)
+    parser.add_argument("--llm-error-rate", type=float)
+    parser.add_argument("--stub-config", help="JSON overrides for bench/stubs.py (see DEFAULT_STUB_CONFIG)")
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results", "latest.json"))
+    parser.add_argument("--baseline", help="compare against this report; exit 1 on regression")
+    parser.add_argument("--save-baseline", action="store_true", help="also write bench/baseline.json")
+    parser.add_argument("--max-regression", type=float, default=0.10, help="allowed relative change")
+    args = parser.parse_args(argv)
+    unknown = set(args.modes) - set(MODES)
+    if unknown:
+        parser.error(f"unknown mode(s): {', '.join(sorted(unknown))}")
+
+    report = asyncio.run(run_benchmark(args))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+    if args.save_baseline:
+        with open(os.path.join(BENCH_DIR, "baseline.json"), "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import io
+import os
+import json
+import math
+import random
+import asyncio
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from PIL import Image
+
+# --- Stub Upstream Configuration ---
+# Passed as JSON by bench/run.py; every key can be overridden from its CLI.
+DEFAULT_STUB_CONFIG = {
+    "search_latency_ms": 300.0,      # median; lognormal around it
+    "search_latency_sigma": 0.5,
+    "search_error_rate": 0.0,
+    "search_results": 3,
+    "snippet_chars": 300,
+    "image_results": 4,
+    "llm_latency_ms": 800.0,         # time to first byte / full JSON answer
+    "llm_latency_sigma": 0.4,
+    "llm_error_rate": 0.0,
+    "answer_tokens": 120,
+    "token_interval_ms": 15.0,       # streaming only
+    "image_latency_ms": 80.0,
+    "image_size": [1600, 1200],
+    "seed": 0,
+}
+STUB_CONFIG = {**DEFAULT_STUB_CONFIG, **json.loads(os.getenv("BENCH_STUB_CONFIG", "{}"))}
+# -----------------------------------
+
+app = FastAPI(title="Benchmark stub upstreams (SerpApi + HF router)")
+_rng = random.Random(STUB_CONFIG["seed"])
+_WORDS = ("fever", "symptom", "treatment", "patient", "clinical", "chronic", "acute", "liver",
+          "infection", "diagnosis", "therapy", "dose", "risk", "blood", "skin", "pain")
+
+
+def _sample_latency(prefix: str) -> float:
+    median = STUB_CONFIG[f"{prefix}_latency_ms"] / 1000.0
+    sigma = STUB_CONFIG.get(f"{prefix}_latency_sigma", 0.0)
+    if median <= 0:
+        return 0.0
+    return _rng.lognormvariate(math.log(median), sigma) if sigma > 0 else median
+
+
+def _failed(prefix: str) -> bool:
+    return _rng.random() < STUB_CONFIG[f"{prefix}_error_rate"]
+
+
+def _text(chars: int) -> str:
+    words = []
+    while sum(len(w) + 1 for w in words) < chars:
+        words.append(_rng.choice(_WORDS))
+    return " ".join(words)[:chars]
+
+
+def _render_image() -> bytes:
+    width, height = STUB_CONFIG["image_size"]
+    img = Image.effect_noise((width, height), 64).convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+
+_IMAGE_BYTES = _render_image()
+
+# --- SerpApi (search.json) ---
+
+@app.get("/search.json")
+async def serpapi_search(request: Request):
+    await asyncio.sleep(_sample_latency("search"))
+    if _failed("search"):
+        return JSONResponse({"error": "stub: injected failure"}, status_code=503)
+    if request.query_params.get("tbm") == "isch":
+        base = str(request.base_url).rstrip("/")
+        return {"images_results": [
+            {"original": f"{base}/img/{_rng.randrange(10**9)}.jpg", "thumbnail": f"{base}/img/thumb.jpg"}
+            for _ in range(STUB_CONFIG["image_results"])
+        ]}
+    return {"organic_results": [
+        {"title": f"Result {i}", "snippet": _text(STUB_CONFIG["snippet_chars"])}
+        for i in range(STUB_CONFIG["search_results"])
+    ]}
+
+# --- HF router (OpenAI-compatible chat completions) ---
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    await asyncio.sleep(_sample_latency("llm"))
+    if _failed("llm"):
+        return JSONResponse({"error": "stub: injected failure"}, status_code=503)
+
+    tokens = [_rng.choice(_WORDS) + " " for _ in range(STUB_CONFIG["answer_tokens"])]
+    if not body.get("stream"):
+        return {"choices": [{"message": {"role": "assistant", "content": "".join(tokens).strip() + "."}}]}
+
+    async def events():
+        for token in tokens:
+            yield f"data: {json.dumps({'choices': [{'delta': {'content': token}}]})}\n\n"
+            await asyncio.sleep(STUB_CONFIG["token_interval_ms"] / 1000.0)
+        yield "data: [DONE]\n\n"
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+# --- Result images (for the image proxy) ---
+
+@app.get("/img/{name}")
+async def result_image(name: str):
+    await asyncio.sleep(_sample_latency("image"))
+    return Response(_IMAGE_BYTES, media_type="image/jpeg")
@@ -2,6 +2,9 @@ import React, { useState, useRef } from 'react';
 import styled from 'styled-components';
 import { API_BASE_URL } from '../config';
 
+// Uploads come back as server-relative URLs (/blobs/...); resolve them against the API.
+const resolveImageUrl = (src) => (typeof src === 'string' && src.startsWith('/') ? `${API_BASE_URL}${src}` : src);
+
 // --- Styled Components (Minimal set for visibility, based on static/style.css) ---
 const Container = styled.div`
   background-color: #ffffff;
@@ -135,6 +138,10 @@ const UnifiedChat = () => {
   const [selectedFile, setSelectedFile] = useState(null);
   const [uploadedImagePreview, setUploadedImagePreview] = useState(null);
 
+  // Server-side conversation: follow-up questions reuse earlier sources and context.
+  const [sessionId, setSessionId] = useState(null);
+  const [turnCount, setTurnCount] = useState(0);
+
   const getEntityColor = (group) => {
     switch (group) {
       case 'DISEASE': return '#ff6384';
@@ -160,7 +167,36 @@ const UnifiedChat = () => {
     setTextQuery(e.target.value);
   };
 
-  // --- Single unified multimodal handler ---
+  // --- Read a Server-Sent Events response, calling onEvent(name, data) per event ---
+  const readEventStream = async (response, onEvent) => {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      let boundary;
+      while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        const rawEvent = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+
+        let eventName = 'message';
+        const dataLines = [];
+        rawEvent.split('\n').forEach((line) => {
+          if (line.startsWith('event:')) eventName = line.slice(6).trim();
+          else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+        });
+        if (dataLines.length > 0) {
+          onEvent(eventName, JSON.parse(dataLines.join('\n')));
+        }
+      }
+    }
+  };
+
+  // --- Single unified multimodal handler (streams the answer as it is generated) ---
   const handleMultimodalChat = async () => {
   if (!textQuery.trim() && !selectedFile) {
     setStatus('Please enter a question or upload an image.');
@@ -176,24 +212,67 @@ const UnifiedChat = () => {
   if (textQuery.trim()) formData.append('text_query', textQuery.trim());
   formData.append('mode', 'auto');
   if (selectedFile) formData.append('file', selectedFile);
+  if (sessionId) formData.append('session_id', sessionId);
 
   try {
-    const response = await fetch(`${API_BASE_URL}/multimodal_chat`, {
+    const response = await fetch(`${API_BASE_URL}/multimodal_chat/stream`, {
       method: 'POST',
       body: formData,
     });
 
-    const data = await response.json();
-
     if (!response.ok) {
+      const data = await response.json().catch(() => ({}));
       throw new Error(data.detail || data.message || `HTTP error! Status: ${response.status}`);
     }
 
-    setResults(data);
-    setStatus(data.message || `Mode: ${data.mode}`);
+    let streamError = null;
+    const streamed = { answer: '', images: [], ner_results: [], source_documents: [] };
+    const update = (fields) => {
+      Object.assign(streamed, fields);
+      setResults({ ...streamed });
+    };
+    update({});
+
+    await readEventStream(response, (event, data) => {
+      switch (event) {
+        case 'meta':
+          if (data.session_id) setSessionId(data.session_id);
+          update({ mode: data.mode });
+          setStatus(`Mode: ${data.mode} — retrieving...`);
+          break;
+        case 'sources':
+          update({ source_documents: data.source_documents });
+          break;
+        case 'ner':
+          update({ ner_results: data.ner_results });
+          break;
+        case 'images':
+          update({ images: (data.images || []).map(resolveImageUrl) });
+          if (data.message) setStatus(data.message);
+          break;
+        case 'token':
+          update({ answer: streamed.answer + data.text });
+          setStatus('Generating answer...');
+          break;
+        case 'done':
+          update({ answer: data.answer });
+          setStatus(streamed.images.length > 0 ? `Mode: ${streamed.mode}` : 'Answer complete.');
+          break;
+        case 'error':
+          streamError = data.detail;
+          break;
+        default:
+          break;
+      }
+    });
+
+    if (streamError) {
+      throw new Error(streamError);
+    }
+    setTurnCount((count) => count + 1);
 
-    if (data.images && data.images.length > 0 && data.mode && data.mode.startsWith('image_')) {
-      setUploadedImagePreview(data.images[0]);
+    if (streamed.images.length > 0 && streamed.mode && streamed.mode.startsWith('image_')) {
+      setUploadedImagePreview(streamed.images[0]);
     }
 
     // 🔹 Clear query & file after a successful run
@@ -210,6 +289,19 @@ const UnifiedChat = () => {
   }
 };
 
+  // --- Start a new conversation (drops the server-side session) ---
+  const handleNewConversation = async () => {
+    if (sessionId) {
+      fetch(`${API_BASE_URL}/sessions/${encodeURIComponent(sessionId)}`, { method: 'DELETE' })
+        .catch((err) => console.error('Session Delete Error:', err));
+    }
+    setSessionId(null);
+    setTurnCount(0);
+    setResults(null);
+    setUploadedImagePreview(null);
+    setStatus('New conversation started. Type a question and/or upload an image.');
+  };
+
   const renderResults = () => {
     if (!results) return null;
 
@@ -354,7 +446,10 @@ const UnifiedChat = () => {
 
         <InputGroup>
           <Button primary onClick={handleMultimodalChat} disabled={isLoading}>
-            {isLoading ? 'Thinking...' : 'Ask Chatbot'}
+            {isLoading ? 'Thinking...' : turnCount > 0 ? 'Ask Follow-up' : 'Ask Chatbot'}
+          </Button>
+          <Button onClick={handleNewConversation} disabled={isLoading || turnCount === 0}>
+            New Conversation
           </Button>
         </InputGroup>
       </SearchArea>
@@ -0,0 +1,227 @@
+import os
+import json
+import math
+import time
+import heapq
+import asyncio
+import itertools
+import contextvars
+from contextlib import contextmanager
+from core.metrics import Counter, Gauge, Histogram
+
+# --- Admission Control Configuration ---
+# Interactive POST requests processed at once; the rest wait in a bounded queue.
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "64"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "256"))
+# Long-running bulk routes: not held to a request slot, and their upstream
+# calls queue behind interactive ones.
+ADMISSION_BATCH_PREFIXES = tuple(
+    p for p in os.getenv("ADMISSION_BATCH_PREFIXES", "/batch/,/jobs").split(",") if p
+)
+# -----------------------------------
+
+INTERACTIVE, BATCH = 0, 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+HOLD_TIME_SMOOTHING = 0.2  # EWMA weight of the newest slot hold time
+
+ADMISSION_QUEUE_DEPTH = Gauge("admission_queue_depth", "Callers waiting for a slot.", ("gate",))
+ADMISSION_IN_FLIGHT = Gauge("admission_in_flight", "Slots currently held.", ("gate",))
+ADMISSION_QUEUE_WAIT = Histogram("admission_queue_wait_seconds", "Time spent waiting for a slot.", ("gate", "priority"))
+ADMISSION_SHED = Counter("admission_shed_total", "Callers turned away instead of queued.", ("gate", "priority", "reason"))
+
+_priority = contextvars.ContextVar("admission_priority", default=INTERACTIVE)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+@contextmanager
+def priority_scope(priority: int):
+    """Runs the enclosed work (and tasks it creates) at `priority`, e.g. background jobs."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class Overloaded(Exception):
+    def __init__(self, gate: str, retry_after: float, reason: str):
+        super().__init__(f"{gate} is overloaded ({reason}); retry in {retry_after:.0f}s.")
+        self.gate = gate
+        self.retry_after = retry_after
+        self.reason = reason
+
+# --- Admission Gate ---
+
+class AdmissionGate:
+    """
+    Concurrency limit plus optional token-bucket rate limit, with a bounded
+    priority queue in front: waiters are served by (priority, arrival), so
+    interactive calls overtake queued batch work. A caller is shed up front when
+    the queue is full or its estimated wait exceeds the time it has left.
+    """
+    def __init__(self, name: str, max_concurrency: int, rate: float = 0.0, burst: float | None = None,
+                 max_queue: int = ADMISSION_MAX_QUEUE):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.rate = rate  # tokens per second; 0 disables rate limiting
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.max_queue = max_queue
+        self.tokens = self.burst
+        self.active = 0
+        self.hold_time = None  # EWMA of how long a slot is held
+        self._refilled_at = time.monotonic()
+        self._queue = []  # heap of [priority, seq, future]
+        self._seq = itertools.count()
+        self._timer = None
+
+    def _refill(self):
+        if self.rate > 0:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+
+    def _can_start(self) -> bool:
+        return self.active < self.max_concurrency and (self.rate <= 0 or self.tokens >= 1)
+
+    def _start(self):
+        self.active += 1
+        if self.rate > 0:
+            self.tokens -= 1
+        ADMISSION_IN_FLIGHT.set(self.active, gate=self.name)
+
+    def _dispatch(self):
+        self._refill()
+        while self._queue and self._can_start():
+            _, _, future = heapq.heappop(self._queue)
+            self._start()
+            future.set_result(None)
+        if self._queue and self.rate > 0 and self.active < self.max_concurrency and self._timer is None:
+            # Slots are free but the bucket is empty: wake up when the next token arrives.
+            delay = (1 - self.tokens) / self.rate
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+        ADMISSION_QUEUE_DEPTH.set(len(self._queue), gate=self.name)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def estimated_wait(self, priority: int) -> float:
+        """Seconds a new caller at `priority` would likely queue (0 while there is no history)."""
+        ahead = sum(1 for entry in self._queue if entry[0] <= priority)
+        wait = 0.0
+        if self.active >= self.max_concurrency and self.hold_time is not None:
+            wait = (ahead + 1) * self.hold_time / self.max_concurrency
+        if self.rate > 0:
+            wait = max(wait, (ahead + 1 - self.tokens) / self.rate)
+        return wait
+
+    def _shed(self, priority: int, reason: str, retry_after: float):
+        ADMISSION_SHED.inc(gate=self.name, priority=PRIORITY_NAMES[priority], reason=reason)
+        return Overloaded(self.name, max(1.0, math.ceil(retry_after)), reason)
+
+    async def acquire(self, priority: int = INTERACTIVE, budget: float | None = None):
+        """
+        Waits for a slot. `budget` is the caller's remaining deadline: callers that
+        would not get a slot in time are rejected with `Overloaded` right away.
+        """
+        self._refill()
+        if not self._queue and self._can_start():
+            self._start()
+            ADMISSION_QUEUE_WAIT.observe(0.0, gate=self.name, priority=PRIORITY_NAMES[priority])
+            return
+
+        estimate = self.estimated_wait(priority)
+        if len(self._queue) >= self.max_queue:
+            raise self._shed(priority, "queue_full", estimate or 1.0)
+        if budget is not None and estimate > budget:
+            raise self._shed(priority, "deadline", estimate)
+
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._seq), future]
+        heapq.heappush(self._queue, entry)
+        self._dispatch()
+        try:
+            done, _ = await asyncio.wait({future}, timeout=None if budget is None else max(0.0, budget))
+        except asyncio.CancelledError:
+            self._abandon(entry)
+            raise
+        if not done:
+            self._abandon(entry)
+            raise self._shed(priority, "deadline", self.estimated_wait(priority))
+        ADMISSION_QUEUE_WAIT.observe(time.perf_counter() - started, gate=self.name, priority=PRIORITY_NAMES[priority])
+
+    def _abandon(self, entry: list):
+        future = entry[2]
+        if future.done() and not future.cancelled():
+            self.release()  # granted just as we gave up; pass it on
+            return
+        future.cancel()
+        if entry in self._queue:
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+        ADMISSION_QUEUE_DEPTH.set(len(self._queue), gate=self.name)
+
+    def release(self, held: float | None = None):
+        self.active -= 1
+        ADMISSION_IN_FLIGHT.set(self.active, gate=self.name)
+        if held is not None:
+            self.hold_time = held if self.hold_time is None else (
+                HOLD_TIME_SMOOTHING * held + (1 - HOLD_TIME_SMOOTHING) * self.hold_time
+            )
+        self._dispatch()
+
+# --- Request Admission Middleware ---
+
+REQUEST_GATE = AdmissionGate("requests", ADMISSION_MAX_CONCURRENT)
+
+
+class AdmissionMiddleware:
+    """
+    Pure ASGI middleware: interactive POST requests take a slot from REQUEST_GATE
+    (waiting in its queue if needed) and are turned away with 503 + Retry-After
+    when they could not start before their deadline. Requests under
+    ADMISSION_BATCH_PREFIXES skip the slot but run at batch priority. `budget`
+    returns the request's remaining seconds (see core.resilience.remaining).
+    """
+    def __init__(self, app, budget=lambda: None, gate: AdmissionGate = REQUEST_GATE):
+        self.app = app
+        self.budget = budget
+        self.gate = gate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+        if scope["path"].startswith(ADMISSION_BATCH_PREFIXES):
+            with priority_scope(BATCH):
+                await self.app(scope, receive, send)
+            return
+
+        try:
+            await self.gate.acquire(INTERACTIVE, self.budget())
+        except Overloaded as e:
+            await _send_overloaded(send, e)
+            return
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.gate.release(time.perf_counter() - started)
+
+
+async def _send_overloaded(send, error: Overloaded):
+    body = json.dumps({"detail": "The server is busy. Please retry shortly.", "retry_after": error.retry_after}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": 503,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(int(error.retry_after)).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
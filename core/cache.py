@@ -0,0 +1,313 @@
+import os
+import logging
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from core.config import DATA_DIR
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# --- Search Cache Configuration ---
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "3600"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "2048"))
+SEARCH_CACHE_MAX_BYTES = int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Set to an empty string to disable the persistent tier.
+SEARCH_CACHE_DB = os.getenv("SEARCH_CACHE_DB", os.path.join(DATA_DIR, "search_cache.sqlite3"))
+
+# --- Answer (LLM generation) Cache Configuration ---
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "4096"))
+ANSWER_CACHE_MAX_BYTES = int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+# Persistent tier is opt-in for answers, e.g. ANSWER_CACHE_DB=data/answer_cache.sqlite3
+ANSWER_CACHE_DB = os.getenv("ANSWER_CACHE_DB", "")
+# -----------------------------------
+
+# Per-request cache behaviour: read+write, skip entirely, or recompute and overwrite.
+CACHE_MODES = ("use", "bypass", "refresh")
+
+MISSING = object()
+
+
+def make_key(*parts) -> str:
+    """Stable cache key for any JSON-serialisable combination of parts."""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class TTLCache:
+    """In-process LRU with per-entry TTL, bounded by entry count and approximate bytes."""
+    def __init__(self, max_entries: int = 1024, max_bytes: int | None = None, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def get(self, key: str):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        expires_at, _, value = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value, size: int | None = None, ttl: float | None = None):
+        if size is None:
+            size = len(json.dumps(value, ensure_ascii=False, default=str)) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return  # would evict everything else; not worth keeping
+        if key in self._data:
+            self._remove(key)
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, size, value)
+        self._bytes += size
+        while len(self._data) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes):
+            oldest = next(iter(self._data))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def delete(self, key: str):
+        if key in self._data:
+            self._remove(key)
+
+    def clear(self):
+        self._data.clear()
+        self._bytes = 0
+
+    def _remove(self, key: str):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+
+class SqliteCache:
+    """
+    Persistent key/value tier with TTL. WAL mode lets several worker processes
+    share one file; values are stored as JSON. Calls block, so async callers
+    should go through `asyncio.to_thread` (TieredCache does).
+    """
+    def __init__(self, path: str, ttl: float = 3600.0, max_entries: int = 100_000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._local = threading.local()
+        self._inherited = []  # parent connections seen after a fork; kept open, see _connect
+        self._writes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        This thread's connection, opened on first use. Connections are never
+        shared across a fork: one inherited from a preloading parent is
+        replaced by a fresh one in the worker, and never closed there (closing
+        it could checkpoint and remove the WAL the parent still uses).
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            if conn is not None:
+                self._inherited.append(conn)
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS cache ("
+                    " key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires_at)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str):
+        row = self._connect().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return MISSING if row is None else json.loads(row[0])
+
+    def set(self, key: str, value, ttl: float | None = None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at),
+            )
+        self._writes += 1
+        if self._writes % 256 == 0:
+            self.prune()
+
+    def add(self, key: str, value, ttl: float | None = None) -> bool:
+        """Sets `key` only if it has no live value; True if this call set it."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache WHERE key = ? AND expires_at <= ?", (key, now))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now + (self.ttl if ttl is None else ttl)),
+            )
+        return cursor.rowcount == 1
+
+    def delete(self, key: str, value=MISSING):
+        """Removes `key`; with `value`, only while it still holds that value."""
+        with self._connect() as conn:
+            if value is MISSING:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            else:
+                conn.execute(
+                    "DELETE FROM cache WHERE key = ? AND value = ?",
+                    (key, json.dumps(value, ensure_ascii=False)),
+                )
+
+    def prune(self):
+        """Drops expired rows, then the soonest-to-expire rows beyond `max_entries`."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+            (count,) = conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+            overflow = count - self.max_entries
+            if overflow > 0:
+                conn.execute(
+                    "DELETE FROM cache WHERE key IN "
+                    "(SELECT key FROM cache ORDER BY expires_at LIMIT ?)",
+                    (overflow,),
+                )
+                self.evictions += overflow
+
+
+class TieredCache:
+    """
+    Memory LRU in front of an optional SQLite tier, with single-flight coalescing:
+    N concurrent `get_or_compute` calls for the same key share one upstream call.
+    """
+    def __init__(self, name: str, memory: TTLCache, disk: SqliteCache | None = None):
+        self.name = name
+        self.memory = memory
+        self.disk = disk
+        self.disk_hits = 0
+        self.coalesced = 0
+        self._inflight = {}
+        CACHE_REGISTRY[name] = self
+
+    async def get(self, key: str):
+        value = self.memory.get(key)
+        if value is not MISSING or self.disk is None:
+            return value
+        try:
+            value = await asyncio.to_thread(self.disk.get, key)
+        except sqlite3.Error as e:
+            logger.warning("Cache %r disk read error: %s", self.name, e)
+            return MISSING
+        if value is not MISSING:
+            self.disk_hits += 1
+            self.memory.set(key, value)
+        return value
+
+    async def set(self, key: str, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            try:
+                await asyncio.to_thread(self.disk.set, key, value)
+            except sqlite3.Error as e:
+                logger.warning("Cache %r disk write error: %s", self.name, e)
+
+    async def invalidate(self, key: str):
+        self.memory.delete(key)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.delete, key)
+
+    async def get_or_compute(self, key: str, compute, should_cache=None):
+        """
+        Returns the cached value for `key`, or awaits `compute()` once and caches it.
+        Exceptions are propagated to every coalesced waiter and never cached.
+        """
+        value = await self.get(key)
+        if value is not MISSING:
+            return value
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise  # we were cancelled ourselves
+                # The leading caller went away mid-flight; compute on our own.
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await compute()
+            if should_cache is None or should_cache(value):
+                await self.set(key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved so lone failures aren't logged as unhandled
+            raise
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.memory.hits + self.disk_hits,
+            "memory_hits": self.memory.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.memory.misses - self.disk_hits,
+            "evictions": self.memory.evictions + (self.disk.evictions if self.disk else 0),
+            "expirations": self.memory.expirations,
+            "coalesced": self.coalesced,
+            "entries": len(self.memory),
+            "bytes": self.memory.size_bytes,
+            "inflight": len(self._inflight),
+        }
+
+
+CACHE_REGISTRY = {}
+
+
+def cache_stats() -> dict:
+    return {name: cache.stats() for name, cache in CACHE_REGISTRY.items()}
+
+
+# Shared by web (text) and image search; keys are namespaced by caller.
+search_cache = TieredCache(
+    "search",
+    TTLCache(max_entries=SEARCH_CACHE_MAX_ENTRIES, max_bytes=SEARCH_CACHE_MAX_BYTES, ttl=SEARCH_CACHE_TTL),
+    SqliteCache(SEARCH_CACHE_DB, ttl=SEARCH_CACHE_TTL) if SEARCH_CACHE_DB else None,
+)
+
+answer_cache = TieredCache(
+    "answer",
+    TTLCache(max_entries=ANSWER_CACHE_MAX_ENTRIES, max_bytes=ANSWER_CACHE_MAX_BYTES, ttl=ANSWER_CACHE_TTL),
+    SqliteCache(ANSWER_CACHE_DB, ttl=ANSWER_CACHE_TTL) if ANSWER_CACHE_DB else None,
+)
@@ -6,4 +6,8 @@ STATIC_DIR = os.path.join(BASE_DIR, 'static')
 TEMPLATES_DIR = os.path.join(BASE_DIR, 'templates')
 
 os.makedirs(STATIC_DIR, exist_ok=True)
-os.makedirs(TEMPLATES_DIR, exist_ok=True)
\ No newline at end of file
+os.makedirs(TEMPLATES_DIR, exist_ok=True)
+
+# Runtime state (caches, indexes, uploads). Not checked in.
+DATA_DIR = os.getenv("DATA_DIR", os.path.join(BASE_DIR, 'data'))
+os.makedirs(DATA_DIR, exist_ok=True)
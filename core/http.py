@@ -0,0 +1,82 @@
+import os
+import time
+import httpx
+from core.metrics import UPSTREAM_REQUESTS, UPSTREAM_SECONDS, UPSTREAM_BYTES
+
+# --- Connection Pool Configuration ---
+# Read lazily in `_build_client` so values from `.env` are honoured no matter
+# which module happens to import this one first.
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 20
+DEFAULT_KEEPALIVE_EXPIRY = 30.0
+DEFAULT_TIMEOUT = 30.0
+# -----------------------------------
+
+
+def _upstream_label(host: str) -> str:
+    # Bounded label set: image-proxy fetches hit arbitrary hosts.
+    if "serpapi" in host:
+        return "serpapi"
+    if "huggingface" in host:
+        return "huggingface"
+    return "other"
+
+
+async def _on_request(request: httpx.Request):
+    request.extensions["started_at"] = time.perf_counter()
+
+
+async def _on_response(response: httpx.Response):
+    upstream = _upstream_label(response.request.url.host)
+    UPSTREAM_REQUESTS.inc(upstream=upstream, status=response.status_code)
+    started = response.request.extensions.get("started_at")
+    if started is not None:
+        UPSTREAM_SECONDS.observe(time.perf_counter() - started, upstream=upstream)
+    size = response.headers.get("content-length")
+    if size and size.isdigit():
+        UPSTREAM_BYTES.observe(int(size), upstream=upstream)
+
+
+class HttpClientPool:
+    """
+    Owns the single pooled keep-alive `httpx.AsyncClient` shared by every service.
+    Opened and closed with the FastAPI app lifespan (see main.py), so concurrent
+    requests reuse upstream connections instead of paying a TCP/TLS handshake each.
+    """
+    def __init__(self):
+        self._client = None
+
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(
+            max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", DEFAULT_MAX_CONNECTIONS)),
+            max_keepalive_connections=int(
+                os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", DEFAULT_MAX_KEEPALIVE_CONNECTIONS)
+            ),
+            keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", DEFAULT_KEEPALIVE_EXPIRY)),
+        )
+        timeout = httpx.Timeout(float(os.getenv("HTTP_DEFAULT_TIMEOUT", DEFAULT_TIMEOUT)))
+        return httpx.AsyncClient(
+            limits=limits,
+            timeout=timeout,
+            follow_redirects=True,
+            event_hooks={"request": [_on_request], "response": [_on_response]},
+        )
+
+    async def startup(self):
+        if self._client is None or self._client.is_closed:
+            self._client = self._build_client()
+
+    async def shutdown(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Lazily open when used outside the app lifespan (scripts, REPL).
+        if self._client is None or self._client.is_closed:
+            self._client = self._build_client()
+        return self._client
+
+
+http_pool = HttpClientPool()
@@ -0,0 +1,298 @@
+import os
+import logging
+import time
+import asyncio
+import secrets
+import sqlite3
+from dotenv import load_dotenv
+from core.config import DATA_DIR
+from core.cache import TTLCache, SqliteCache, MISSING
+from core.metrics import Counter, Gauge, Histogram, background_metrics
+from core.resilience import deadline_scope
+from core.admission import priority_scope, BATCH
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# --- Background Job Configuration ---
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "4"))            # jobs running at once
+JOBS_MAX_PENDING = int(os.getenv("JOBS_MAX_PENDING", "64"))   # queued beyond that -> 503
+JOB_DEADLINE = float(os.getenv("JOB_DEADLINE", "120"))        # per job, replaces the request deadline
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "3600"))
+JOB_MAX_ENTRIES = int(os.getenv("JOB_MAX_ENTRIES", "2000"))
+JOB_MAX_BYTES = int(os.getenv("JOB_MAX_BYTES", str(64 * 1024 * 1024)))
+# Job snapshots and coalescing keys shared by all workers, so any of them can
+# answer /jobs/{id}. Set to an empty string to keep jobs in the submitting
+# worker only (single worker deployments).
+JOB_DB = os.getenv("JOB_DB", os.path.join(DATA_DIR, "jobs.sqlite3"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.25"))  # following another worker's job
+# -----------------------------------
+
+QUEUED, RUNNING, COMPLETED, FAILED = "queued", "running", "completed", "failed"
+
+JOBS_SUBMITTED = Counter("jobs_submitted_total", "Job submissions by outcome.", ("kind", "outcome"))
+JOBS_PENDING = Gauge("jobs_pending", "Jobs waiting for a worker.")
+JOBS_RUNNING = Gauge("jobs_running", "Jobs currently executing.")
+JOB_SECONDS = Histogram("job_duration_seconds", "Job run time (excluding queueing).", ("kind", "status"))
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def _lost(job: dict) -> dict:
+    """
+    A snapshot still queued or running long after it must have finished: the
+    worker holding it is gone, so report it failed.
+    """
+    now = time.time()
+    max_wait = (JOBS_MAX_PENDING // max(1, JOBS_WORKERS) + 1) * JOB_DEADLINE
+    if (job["status"] == RUNNING and now - job["started_at"] > JOB_DEADLINE + 30) or \
+            (job["status"] == QUEUED and now - job["created_at"] > max_wait + 30):
+        error = "Job lost (the worker running it stopped)."
+        done = {"event": "done", "data": {"status": FAILED, "result": None, "error": error}}
+        return {**job, "status": FAILED, "error": error, "events": job["events"] + [done]}
+    return job
+
+
+class JobManager:
+    """
+    Runs expensive pipelines in a bounded pool of background workers, independent
+    of the HTTP request that submitted them. Submissions with the same key while
+    one is queued or running share that job. Finished jobs (result or error,
+    plus their progress events) are kept in a TTL/LRU store for polling.
+
+    With a SQLite store every event also writes the job's snapshot there, and
+    coalescing keys are claimed there: a job submitted to one server worker can
+    be polled, followed and joined from any other.
+    """
+    def __init__(self, workers: int = JOBS_WORKERS, max_pending: int = JOBS_MAX_PENDING,
+                 store: SqliteCache | None = None):
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.finished = TTLCache(max_entries=JOB_MAX_ENTRIES, max_bytes=JOB_MAX_BYTES, ttl=JOB_RESULT_TTL)
+        self.store = store
+        self._active = {}     # job id -> job (queued or running)
+        self._by_key = {}     # coalescing key -> job id
+        self._changed = {}    # job id -> asyncio.Event, set (and replaced) on every event
+        self._funcs = {}      # job id -> (key, coroutine function(progress))
+        self._dirty = {}      # job id -> snapshot not yet written to the store
+        self._flush_wanted = None
+        self._queue = None
+        self._tasks = []
+        self._flusher = None
+        self.running = 0
+        self.coalesced = 0
+
+    async def startup(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._flush_wanted = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.store is not None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+            await self._flush()  # the "cancelled" snapshots of interrupted jobs
+
+    # --- Shared store ---
+
+    async def _store_call(self, method: str, *args):
+        if self.store is None:
+            return MISSING
+        try:
+            return await asyncio.to_thread(getattr(self.store, method), *args)
+        except sqlite3.Error as e:
+            logger.warning("Job store %s error: %s", method, e)
+            return MISSING
+
+    def _persist(self, job: dict):
+        """Queues the job's current state for the store (latest snapshot wins)."""
+        if self.store is not None:
+            self._dirty[job["id"]] = {**job, "events": list(job["events"])}
+            self._flush_wanted.set()
+
+    async def _flush(self):
+        while self._dirty:
+            job_id = next(iter(self._dirty))
+            await self._store_call("set", f"job:{job_id}", self._dirty.pop(job_id))
+
+    async def _flush_loop(self):
+        while True:
+            await self._flush_wanted.wait()
+            self._flush_wanted.clear()
+            await self._flush()
+
+    async def _load(self, job_id: str) -> dict | None:
+        job = await self._store_call("get", f"job:{job_id}")
+        return None if job is MISSING else _lost(job)
+
+    async def _claim_key(self, key: str, job: dict) -> dict | None:
+        """
+        Claims `key` for `job` (its snapshot is written first, so a claim never
+        points at a job others can't see). Returns the job already holding the
+        key instead, if that one is still queued or running.
+        """
+        if self.store is None:
+            return None
+        await self._store_call("set", f"job:{job['id']}", job)
+        while not await self._store_call("add", f"key:{key}", job["id"], JOB_RESULT_TTL):
+            other_id = await self._store_call("get", f"key:{key}")
+            if other_id is MISSING:
+                continue  # released meanwhile; claim again
+            other = await self.get(other_id)
+            if other is not None and other["status"] in (QUEUED, RUNNING):
+                await self._store_call("delete", f"job:{job['id']}")
+                return other
+            await self._store_call("delete", f"key:{key}", other_id)  # finished or lost
+        return None
+
+    # --- Submission / lookup ---
+
+    async def submit(self, kind: str, key: str, func) -> tuple:
+        """
+        Queues `func(progress)` and returns (job, coalesced). `progress(event, data)`
+        appends an event that pollers and SSE followers see immediately.
+        """
+        job_id = self._by_key.get(key)
+        if job_id in self._active:
+            self.coalesced += 1
+            JOBS_SUBMITTED.inc(kind=kind, outcome="coalesced")
+            return self._active[job_id], True
+        if self._queue is None:
+            raise RuntimeError("JobManager.startup() has not run.")
+        if self._queue.qsize() >= self.max_pending:
+            JOBS_SUBMITTED.inc(kind=kind, outcome="rejected")
+            raise JobQueueFull(f"{self._queue.qsize()} jobs are already waiting.")
+
+        job = {
+            "id": secrets.token_urlsafe(12),
+            "kind": kind,
+            "status": QUEUED,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "events": [],
+            "result": None,
+            "error": None,
+        }
+        other = await self._claim_key(key, job)
+        if other is not None:
+            self.coalesced += 1
+            JOBS_SUBMITTED.inc(kind=kind, outcome="coalesced")
+            return other, True
+        self._active[job["id"]] = job
+        self._by_key[key] = job["id"]
+        self._funcs[job["id"]] = (key, func)
+        self._changed[job["id"]] = asyncio.Event()
+        self._queue.put_nowait(job["id"])
+        JOBS_SUBMITTED.inc(kind=kind, outcome="queued")
+        JOBS_PENDING.set(self._queue.qsize())
+        return job, False
+
+    async def get(self, job_id: str) -> dict | None:
+        """The job from this worker, else its latest snapshot in the shared store."""
+        job = self._active.get(job_id)
+        if job is not None:
+            return job
+        job = self.finished.get(job_id)
+        if job is not MISSING:
+            return job
+        return await self._load(job_id)
+
+    async def follow(self, job_id: str):
+        """
+        Yields the job's events (past ones first) until it finishes. Jobs of this
+        worker wake the follower on every event; others are polled in the store.
+        """
+        index = 0
+        while True:
+            job = await self.get(job_id)
+            if job is None:
+                return
+            while index < len(job["events"]):
+                yield job["events"][index]
+                index += 1
+            if job["status"] not in (QUEUED, RUNNING):
+                return  # finished; its "done" event was the last one yielded
+            changed = self._changed.get(job_id)
+            if changed is not None:
+                await changed.wait()
+            else:
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    # --- Execution ---
+
+    def _emit(self, job: dict, event: str, data: dict):
+        job["events"].append({"event": event, "data": data})
+        self._persist(job)
+        changed = self._changed.get(job["id"])
+        if changed is not None:
+            # Wake current followers; later waits use a fresh event.
+            self._changed[job["id"]] = asyncio.Event()
+            changed.set()
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            JOBS_PENDING.set(self._queue.qsize())
+            try:
+                await self._run(self._active[job_id])
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: dict):
+        key, func = self._funcs.pop(job["id"])
+        job["status"] = RUNNING
+        job["started_at"] = time.time()
+        self._emit(job, "status", {"status": RUNNING})
+        self.running += 1
+        JOBS_RUNNING.set(self.running)
+        started = time.perf_counter()
+        try:
+            # Jobs queue behind interactive traffic at the upstreams and get their own deadline.
+            with priority_scope(BATCH), deadline_scope(JOB_DEADLINE), background_metrics(f"job_{job['kind']}"):
+                job["result"] = await func(lambda event, data: self._emit(job, event, data))
+            job["status"] = COMPLETED
+        except asyncio.CancelledError:
+            job["status"] = FAILED
+            job["error"] = "Job cancelled (server shutting down)."
+            raise
+        except Exception as e:
+            logger.exception("Job %s (%s) failed", job["id"], job["kind"])
+            job["status"] = FAILED
+            job["error"] = str(e)
+        finally:
+            self.running -= 1
+            JOBS_RUNNING.set(self.running)
+            JOB_SECONDS.observe(time.perf_counter() - started, kind=job["kind"], status=job["status"])
+            job["finished_at"] = time.time()
+            self._emit(job, "done", {"status": job["status"], "result": job["result"], "error": job["error"]})
+            self.finished.set(job["id"], job)
+            self._active.pop(job["id"], None)
+            if self._by_key.get(key) == job["id"]:
+                del self._by_key[key]  # the store's claim is dropped by the next submit
+            self._changed.pop(job["id"]).set()
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._queue.qsize() if self._queue is not None else 0,
+            "running": self.running,
+            "finished": len(self.finished),
+            "coalesced": self.coalesced,
+            "workers": self.workers,
+            "shared": self.store is not None,
+        }
+
+
+job_manager = JobManager(store=SqliteCache(JOB_DB, ttl=JOB_RESULT_TTL) if JOB_DB else None)
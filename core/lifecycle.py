@@ -0,0 +1,105 @@
+import os
+import logging
+import gc
+import time
+import threading
+from core.metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+SERVICE_INIT_SECONDS = Gauge("service_init_seconds", "Time spent building each service in this process.", ("service",))
+WORKER_COLD_START = Gauge("worker_cold_start_seconds", "Worker process start (or fork) until it accepts requests.")
+WORKER_PRELOADED = Gauge("worker_preloaded", "1 if services were built in the parent before fork (copy-on-write).")
+
+_imported_at = time.monotonic()
+_preloaded_pid = None
+
+
+def _process_age() -> float:
+    """
+    Seconds since this process was created (exec or fork, so imports count), from
+    /proc; off Linux, since this module was imported.
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])  # field 22: starttime
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _imported_at
+
+# --- Lazy Services ---
+
+SERVICES = {}  # name -> LazyService, in registration order
+
+
+class LazyService:
+    """
+    Module-level handle for a service that is built on first use instead of at
+    import time. Attribute access is forwarded, so `text_service.retrieve(...)`
+    call sites don't change; the app lifespan (or `preload`) builds it up front.
+    Constructors load their heavy read-only state (vocabularies, index metadata),
+    so a preloading parent hands it to its workers copy-on-write.
+    """
+    def __init__(self, name: str, factory):
+        self.name = name
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+        SERVICES[name] = self
+
+    @property
+    def loaded(self) -> bool:
+        return self._instance is not None
+
+    def get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    started = time.perf_counter()
+                    instance = self._factory()
+                    SERVICE_INIT_SECONDS.set(time.perf_counter() - started, service=self.name)
+                    self._instance = instance
+        return self._instance
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+
+def load_services() -> dict:
+    """Builds every registered service; returns {name: seconds} for the ones built now."""
+    timings = {}
+    for name, service in SERVICES.items():
+        if not service.loaded:
+            started = time.perf_counter()
+            service.get()
+            timings[name] = round(time.perf_counter() - started, 3)
+    return timings
+
+
+def preload():
+    """
+    Runs in the parent before forking workers (see serve.py). Builds the services,
+    then moves everything allocated so far out of the GC's reach: collections
+    would otherwise touch every object header and un-share the pages.
+    """
+    global _preloaded_pid
+    timings = load_services()
+    gc.collect()
+    gc.freeze()
+    _preloaded_pid = os.getpid()
+    logger.info("Preloaded services before fork: %s", timings)
+
+
+def worker_ready():
+    """Called at the end of the lifespan startup; records and logs the cold start."""
+    timings = load_services()
+    cold_start = _process_age()
+    preloaded = _preloaded_pid is not None and _preloaded_pid != os.getpid()
+    WORKER_COLD_START.set(cold_start)
+    WORKER_PRELOADED.set(1 if preloaded else 0)
+    logger.info(
+        "Worker %d ready in %.2fs (%s).",
+        os.getpid(), cold_start, "preloaded" if preloaded else f"built services: {timings}",
+    )
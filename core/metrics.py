@@ -0,0 +1,429 @@
+import os
+import logging
+import sys
+import json
+import time
+import bisect
+import asyncio
+import inspect
+import functools
+import threading
+import contextvars
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from core.config import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+# --- Metrics Configuration ---
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+# Per-request sampling profiler, triggered by an `X-Profile: 1` request header.
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(DATA_DIR, "profiles"))
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.5"))
+# Set by serve.py when it starts several workers: each publishes its metrics
+# there and /metrics merges all of them, whichever worker answers the scrape.
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_PUBLISH_INTERVAL = float(os.getenv("METRICS_PUBLISH_INTERVAL", "5"))
+# -----------------------------------
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+REGISTRY = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()  # observations also come from worker threads
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def snapshot(self) -> list:
+        """[[label values, value], ...], JSON-serialisable for other workers."""
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def merge(self, snapshots: list) -> tuple:
+        """
+        (items, labelnames) for every worker's snapshot, given as [(pid, alive,
+        snapshot)]. Counts are summed, including those of workers that have exited.
+        """
+        totals = {}
+        for _, _, values in snapshots:
+            for key, value in values:
+                totals[tuple(key)] = totals.get(tuple(key), 0) + value
+        return list(totals.items()), self.labelnames
+
+    def render(self, items: list | None = None, labelnames: tuple | None = None) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if items is None:
+            with self._lock:
+                items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(labelnames or self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def merge(self, snapshots: list) -> tuple:
+        """Gauges don't add up across workers: one series per live worker, labelled `pid`."""
+        items = [
+            (tuple(key) + (str(pid),), value)
+            for pid, alive, values in snapshots if alive
+            for key, value in values
+        ]
+        return items, self.labelnames + ("pid",)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [[list(key), [list(counts), total, count]] for key, (counts, total, count) in self._values.items()]
+
+    def merge(self, snapshots: list) -> tuple:
+        totals = {}
+        for _, _, values in snapshots:
+            for key, (counts, total, count) in values:
+                state = totals.setdefault(tuple(key), [[0] * len(counts), 0.0, 0])
+                state[0] = [a + b for a, b in zip(state[0], counts)]
+                state[1] += total
+                state[2] += count
+        return list(totals.items()), self.labelnames
+
+    def render(self, items: list | None = None, labelnames: tuple | None = None) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if items is None:
+            with self._lock:
+                items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        labelnames = labelnames or self.labelnames
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = _format_labels(labelnames, key, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            labels = _format_labels(labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render() -> str:
+    """
+    Every registered metric in the Prometheus text exposition format: this
+    process's, or with METRICS_DIR, all workers' merged.
+    """
+    if METRICS_DIR:
+        return _render_merged()
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+# --- Multi-worker Aggregation ---
+
+def publish():
+    """Writes this worker's metrics to METRICS_DIR/<pid>.json (atomically)."""
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    with open(f"{path}.tmp", "w") as f:
+        json.dump({metric.name: metric.snapshot() for metric in REGISTRY}, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _render_merged() -> str:
+    publish()  # this worker's numbers are current; the others' at most one interval old
+    snapshots = []
+    for name in os.listdir(METRICS_DIR):
+        if not name.endswith(".json"):
+            continue
+        pid = int(name[:-5])
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snapshots.append((pid, pid == os.getpid() or _alive(pid), json.load(f)))
+        except (OSError, ValueError):
+            continue
+    lines = []
+    for metric in REGISTRY:
+        items, labelnames = metric.merge([(pid, alive, data.get(metric.name, [])) for pid, alive, data in snapshots])
+        lines.extend(metric.render(items, labelnames))
+    return "\n".join(lines) + "\n"
+
+
+async def publish_metrics(interval: float = METRICS_PUBLISH_INTERVAL):
+    """Publishes this worker's metrics periodically (see METRICS_DIR); runs for the app lifetime."""
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(publish)
+
+# --- Metric Definitions ---
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time until the last response byte was sent.", ("route", "method", "status")
+)
+REQUEST_BYTES = Histogram("http_request_size_bytes", "Request body size (Content-Length).", ("route",), SIZE_BUCKETS)
+RESPONSE_BYTES = Histogram("http_response_size_bytes", "Response body size.", ("route",), SIZE_BUCKETS)
+STAGE_SECONDS = Histogram("stage_duration_seconds", "Pipeline stage / service call latency.", ("mode", "stage"))
+STAGE_ERRORS = Counter("stage_errors_total", "Pipeline stages that raised.", ("mode", "stage"))
+UPSTREAM_REQUESTS = Counter("upstream_requests_total", "Outbound HTTP responses by status.", ("upstream", "status"))
+UPSTREAM_SECONDS = Histogram("upstream_response_seconds", "Outbound HTTP time to response headers.", ("upstream",))
+UPSTREAM_BYTES = Histogram(
+    "upstream_response_size_bytes", "Outbound HTTP response size (Content-Length).", ("upstream",), SIZE_BUCKETS
+)
+EVENT_LOOP_LAG = Gauge("event_loop_lag_seconds", "Most recent event-loop scheduling delay.")
+EVENT_LOOP_LAG_HISTOGRAM = Histogram(
+    "event_loop_lag_distribution_seconds", "Event-loop scheduling delay samples.",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
+# --- Per-request Timing (Server-Timing) ---
+
+class RequestMetrics:
+    """Mutable per-request state shared by the middleware and everything the request awaits."""
+    __slots__ = ("mode", "timings")
+
+    def __init__(self):
+        self.mode = "none"
+        self.timings = []
+
+
+_current_request = contextvars.ContextVar("current_request_metrics", default=None)
+
+
+def set_mode(mode: str):
+    """Labels the current request's stage metrics (e.g. with the resolved chat mode)."""
+    state = _current_request.get()
+    if state is not None:
+        state.mode = mode
+
+
+@contextmanager
+def background_metrics(mode: str):
+    """Per-task metrics state for work that runs outside an HTTP request (background jobs)."""
+    state = RequestMetrics()
+    state.mode = mode
+    token = _current_request.set(state)
+    try:
+        yield state
+    finally:
+        _current_request.reset(token)
+
+
+@contextmanager
+def timed(stage: str):
+    """Records the enclosed block in `stage_duration_seconds` and the Server-Timing header."""
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    state = _current_request.get()
+    mode = state.mode if state is not None else "none"
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(mode=mode, stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, mode=mode, stage=stage)
+        if state is not None:
+            state.timings.append((stage, elapsed))
+
+
+def instrumented(stage: str):
+    """Decorator form of `timed` for sync, async and async-generator functions."""
+    def decorate(func):
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def agen_wrapper(*args, **kwargs):
+                with timed(stage):
+                    async for item in func(*args, **kwargs):
+                        yield item
+            return agen_wrapper
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timed(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _server_timing(state: RequestMetrics, total: float) -> str:
+    entries = [f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in state.timings]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+# --- Sampling Profiler ---
+
+class SamplingProfiler:
+    """
+    Samples the event-loop thread's Python stack every `interval` seconds from a
+    helper thread and writes collapsed stacks (flamegraph.pl / speedscope input).
+    The loop thread is shared, so concurrent requests show up in the profile too.
+    """
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.profile_id = f"{int(time.time() * 1000)}-{os.getpid()}"
+        self.samples = _Tally()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> str:
+        self._stop.set()
+        self._thread.join()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{self.profile_id}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info("Profile written to %s (%d samples)", path, sum(self.samples.values()))
+        return path
+
+# --- ASGI Middleware ---
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware (no BaseHTTPMiddleware task/stream overhead): records
+    request latency and payload sizes per route template and adds a
+    `Server-Timing` header with every stage timed before the headers went out.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        state = RequestMetrics()
+        token = _current_request.set(state)
+        started = time.perf_counter()
+        status = 500
+        response_bytes = 0
+        headers = dict(scope.get("headers") or [])
+        profiler = None
+        if PROFILING_ENABLED and headers.get(b"x-profile") == b"1":
+            profiler = SamplingProfiler()
+            profiler.start()
+
+        async def send_with_timing(message):
+            nonlocal status, response_bytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                extra = [(b"server-timing", _server_timing(state, time.perf_counter() - started).encode())]
+                if profiler is not None:
+                    extra.append((b"x-profile-id", profiler.profile_id.encode()))
+                message = {**message, "headers": [*message.get("headers", []), *extra]}
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=scope["method"], status=status)
+            RESPONSE_BYTES.observe(response_bytes, route=route)
+            content_length = headers.get(b"content-length")
+            if content_length and content_length.isdigit():
+                REQUEST_BYTES.observe(int(content_length), route=route)
+            if profiler is not None:
+                profiler.stop()
+            _current_request.reset(token)
+
+# --- Event Loop Lag ---
+
+async def monitor_event_loop_lag(interval: float = EVENT_LOOP_LAG_INTERVAL):
+    """Measures how late a sleep wakes up; anything blocking the loop shows up here."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        EVENT_LOOP_LAG.set(lag)
+        EVENT_LOOP_LAG_HISTOGRAM.observe(lag)
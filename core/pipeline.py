@@ -0,0 +1,119 @@
+import logging
+import asyncio
+from core.resilience import remaining
+
+logger = logging.getLogger(__name__)
+
+# --- Stage Outcomes ---
+COMPLETED = "completed"
+FAILED = "failed"
+TIMEOUT = "timeout"
+SKIPPED = "skipped"
+# -----------------------------------
+
+
+class Stage:
+    """One named unit of work. `func` receives the results of finished stages as a dict."""
+    def __init__(self, name: str, func, depends_on=(), timeout: float | None = None):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+        self.timeout = timeout
+
+
+class StageGraphResult:
+    def __init__(self):
+        self.results = {}
+        self.status = {}
+        self.errors = {}
+
+    def get(self, name: str, default=None):
+        return self.results.get(name, default)
+
+    def ok(self, name: str) -> bool:
+        return self.status.get(name) == COMPLETED
+
+    def summary(self) -> dict:
+        """Compact report of which stages completed, for inclusion in API responses."""
+        return {
+            "completed": [n for n, s in self.status.items() if s == COMPLETED],
+            "failed": {n: self.errors.get(n, s) for n, s in self.status.items() if s in (FAILED, TIMEOUT)},
+            "skipped": [n for n, s in self.status.items() if s == SKIPPED],
+        }
+
+
+class StageGraph:
+    """
+    Small dependency-graph executor for request pipelines.
+    Every stage starts as soon as its dependencies have completed, so independent
+    upstream calls overlap and end-to-end latency is the longest path, not the sum.
+    A stage that fails or times out only skips its dependents; everything else
+    still returns (partial results).
+    """
+    def __init__(self, default_timeout: float | None = None):
+        self.default_timeout = default_timeout
+        self._stages = {}
+
+    def add_stage(self, name: str, func, depends_on=(), timeout: float | None = None):
+        for dep in depends_on:
+            if dep not in self._stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dep}'.")
+        self._stages[name] = Stage(name, func, depends_on, timeout)
+        return self
+
+    async def _run_stage(self, stage: Stage, results: dict):
+        timeout = stage.timeout if stage.timeout is not None else self.default_timeout
+        left = remaining()  # never run past the request's overall deadline
+        if left is not None:
+            timeout = left if timeout is None else min(timeout, left)
+        return await asyncio.wait_for(stage.func(results), timeout)
+
+    async def run(self, on_stage=None) -> StageGraphResult:
+        """`on_stage(name, status, result)` is called as each stage finishes or is skipped."""
+        outcome = StageGraphResult()
+
+        def report(name: str):
+            if on_stage is not None:
+                on_stage(name, outcome.status[name], outcome.results.get(name))
+        waiting = dict(self._stages)
+        running = {}
+
+        def launch_ready():
+            changed = True
+            while changed:
+                changed = False
+                for name, stage in list(waiting.items()):
+                    dep_status = [outcome.status.get(d) for d in stage.depends_on]
+                    if any(s in (FAILED, TIMEOUT, SKIPPED) for s in dep_status):
+                        outcome.status[name] = SKIPPED
+                        del waiting[name]
+                        report(name)
+                        changed = True
+                    elif all(s == COMPLETED for s in dep_status):
+                        del waiting[name]
+                        task = asyncio.ensure_future(self._run_stage(stage, outcome.results))
+                        running[task] = name
+
+        launch_ready()
+        try:
+            while running:
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    try:
+                        outcome.results[name] = task.result()
+                        outcome.status[name] = COMPLETED
+                    except asyncio.TimeoutError:
+                        outcome.status[name] = TIMEOUT
+                        outcome.errors[name] = "timeout"
+                    except Exception as e:
+                        logger.warning("Pipeline stage %r failed: %s", name, e)
+                        outcome.status[name] = FAILED
+                        outcome.errors[name] = str(e)
+                    report(name)
+                launch_ready()
+        finally:
+            # Caller was cancelled (e.g. client disconnect): don't leak upstream calls.
+            for task in running:
+                task.cancel()
+        return outcome
@@ -0,0 +1,330 @@
+import os
+import logging
+import time
+import asyncio
+import contextvars
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+import httpx
+from core.metrics import Counter, Gauge
+from core.admission import AdmissionGate, Overloaded, current_priority
+
+logger = logging.getLogger(__name__)
+
+# --- Resilience Configuration ---
+# Overall budget per incoming request; clients may ask for less via `X-Request-Timeout`.
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "45"))
+UPSTREAM_TIMEOUT_MIN = float(os.getenv("UPSTREAM_TIMEOUT_MIN", "1.0"))
+# Adaptive timeout = observed p99 x this multiplier, clamped to [min, upstream max].
+UPSTREAM_TIMEOUT_MULTIPLIER = float(os.getenv("UPSTREAM_TIMEOUT_MULTIPLIER", "3.0"))
+UPSTREAM_LATENCY_WINDOW = int(os.getenv("UPSTREAM_LATENCY_WINDOW", "256"))
+UPSTREAM_MIN_SAMPLES = int(os.getenv("UPSTREAM_MIN_SAMPLES", "20"))
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))  # at most 10% extra requests
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+SERPAPI_TIMEOUT_MAX = float(os.getenv("SERPAPI_TIMEOUT_MAX", "10"))
+HUGGINGFACE_TIMEOUT_MAX = float(os.getenv("HUGGINGFACE_TIMEOUT_MAX", "60"))
+# Per-upstream admission: concurrent calls, and a token bucket (requests/second,
+# burst) matching the provider's rate limit. A rate of 0 disables the bucket.
+SERPAPI_CONCURRENCY = int(os.getenv("SERPAPI_CONCURRENCY", "16"))
+SERPAPI_RATE_LIMIT = float(os.getenv("SERPAPI_RATE_LIMIT", "0"))
+SERPAPI_RATE_BURST = float(os.getenv("SERPAPI_RATE_BURST", "0")) or None
+HUGGINGFACE_CONCURRENCY = int(os.getenv("HUGGINGFACE_CONCURRENCY", "16"))
+HUGGINGFACE_RATE_LIMIT = float(os.getenv("HUGGINGFACE_RATE_LIMIT", "0"))
+HUGGINGFACE_RATE_BURST = float(os.getenv("HUGGINGFACE_RATE_BURST", "0")) or None
+# -----------------------------------
+
+CIRCUIT_STATE = Gauge("upstream_circuit_state", "Circuit breaker state (0 closed, 1 half-open, 2 open).", ("upstream",))
+UPSTREAM_FAILURES = Counter("upstream_failures_total", "Upstream calls that failed, by kind.", ("upstream", "kind"))
+UPSTREAM_REJECTED = Counter("upstream_rejected_total", "Calls rejected by an open circuit or spent deadline.", ("upstream", "reason"))
+UPSTREAM_HEDGES = Counter("upstream_hedged_total", "Hedge requests sent after the latency threshold.", ("upstream",))
+UPSTREAM_TIMEOUT = Gauge("upstream_timeout_seconds", "Current adaptive timeout (before deadline clamping).", ("upstream",))
+
+
+class UpstreamError(Exception):
+    """Base for resilience failures; callers degrade on it like on `httpx.HTTPError`."""
+
+
+class DeadlineExceeded(UpstreamError):
+    pass
+
+
+class UpstreamTimeout(UpstreamError):
+    pass
+
+
+class CircuitOpenError(UpstreamError):
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{upstream} is temporarily unavailable (circuit open, retry in {retry_after:.0f}s).")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class UpstreamOverloaded(UpstreamError):
+    """Our own limit for the upstream is saturated; the call was not sent."""
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{upstream} is at its concurrency/rate limit (retry in {retry_after:.0f}s).")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+# --- Request Deadline ---
+
+_deadline = contextvars.ContextVar("request_deadline", default=None)  # time.monotonic() value
+
+
+def remaining() -> float | None:
+    """Seconds left in the current request's budget, or None outside a deadline scope."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+@contextmanager
+def deadline_scope(seconds: float):
+    """Gives the enclosed work its own budget (e.g. one batch item or background job)."""
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+class DeadlineMiddleware:
+    """Pure ASGI middleware: starts the per-request deadline every upstream call draws from."""
+    def __init__(self, app, default: float = REQUEST_DEADLINE):
+        self.app = app
+        self.default = default
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        budget = self.default
+        requested = dict(scope.get("headers") or []).get(b"x-request-timeout")
+        if requested:
+            try:
+                budget = min(budget, max(0.0, float(requested)))
+            except ValueError:
+                pass
+        with deadline_scope(budget):
+            await self.app(scope, receive, send)
+
+# --- Circuit Breaker ---
+
+class CircuitBreaker:
+    """
+    Consecutive-failure breaker. After `failure_threshold` failures the circuit
+    opens and calls fail fast for `reset_timeout` seconds; then one probe call is
+    let through (half-open) and its outcome closes or re-opens the circuit.
+    """
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        CIRCUIT_STATE.set(self.state, upstream=name)
+
+    def _set_state(self, state: int):
+        self.state = state
+        CIRCUIT_STATE.set(state, upstream=self.name)
+
+    def before_call(self):
+        if self.state == self.OPEN:
+            waited = time.monotonic() - self.opened_at
+            if waited < self.reset_timeout:
+                UPSTREAM_REJECTED.inc(upstream=self.name, reason="circuit_open")
+                raise CircuitOpenError(self.name, self.reset_timeout - waited)
+            self._set_state(self.HALF_OPEN)
+            self._probing = False
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                UPSTREAM_REJECTED.inc(upstream=self.name, reason="circuit_open")
+                raise CircuitOpenError(self.name, self.reset_timeout)
+            self._probing = True
+
+    def record_success(self):
+        self.failures = 0
+        self._probing = False
+        if self.state != self.CLOSED:
+            logger.info("Circuit for %s closed.", self.name)
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning("Circuit for %s opened after %d failure(s).", self.name, self.failures)
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+    def release(self):
+        """Call ended without a verdict (cancelled); let another probe through."""
+        self._probing = False
+
+
+def _failure_kind(exc: BaseException) -> str | None:
+    """What counts against an upstream's health; None for caller-side outcomes."""
+    if isinstance(exc, (asyncio.TimeoutError, httpx.TimeoutException, UpstreamTimeout)):
+        return "timeout"
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return "status" if status >= 500 or status == 429 else None
+    if isinstance(exc, httpx.TransportError):
+        return "transport"
+    return None
+
+# --- Upstream Guard ---
+
+class Upstream:
+    """
+    Per-upstream policy: an admission gate (concurrency + rate limit, priority
+    queue), adaptive timeouts from a sliding window of observed latencies
+    (clamped by the request deadline), a circuit breaker, and optional hedging
+    for idempotent calls.
+    """
+    def __init__(self, name: str, max_timeout: float, gate: AdmissionGate, min_timeout: float = UPSTREAM_TIMEOUT_MIN):
+        self.name = name
+        self.max_timeout = max_timeout
+        self.gate = gate
+        self.min_timeout = min_timeout
+        self.latencies = deque(maxlen=UPSTREAM_LATENCY_WINDOW)
+        self.breaker = CircuitBreaker(name)
+        self.calls = 0
+        self.hedges = 0
+
+    def percentile(self, q: float) -> float | None:
+        if len(self.latencies) < UPSTREAM_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q / 100.0 * len(ordered)))]
+
+    def adaptive_timeout(self) -> float:
+        p99 = self.percentile(99)
+        if p99 is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, p99 * UPSTREAM_TIMEOUT_MULTIPLIER))
+
+    def timeout(self) -> float:
+        """Budget for the next call: adaptive timeout, never past the request deadline."""
+        timeout = self.adaptive_timeout()
+        UPSTREAM_TIMEOUT.set(timeout, upstream=self.name)
+        left = remaining()
+        if left is not None:
+            if left <= 0:
+                UPSTREAM_REJECTED.inc(upstream=self.name, reason="deadline")
+                raise DeadlineExceeded(f"Request deadline exceeded before calling {self.name}.")
+            timeout = min(timeout, left)
+        return timeout
+
+    @asynccontextmanager
+    async def guard(self, record_latency: bool = True):
+        """
+        Wraps one upstream call: waits for an admission slot, checks the breaker,
+        yields the timeout to use and records the outcome. Use `record_latency=False`
+        for streams, whose duration is not a response time.
+        """
+        try:
+            await self.gate.acquire(current_priority(), remaining())
+        except Overloaded as e:
+            raise UpstreamOverloaded(self.name, e.retry_after) from e
+        admitted = time.perf_counter()
+        try:
+            async with self._guarded(record_latency) as timeout:
+                yield timeout
+        finally:
+            self.gate.release(time.perf_counter() - admitted)
+
+    @asynccontextmanager
+    async def _guarded(self, record_latency: bool):
+        self.breaker.before_call()
+        try:
+            timeout = self.timeout()
+        except DeadlineExceeded:
+            self.breaker.release()
+            raise
+        self.calls += 1
+        started = time.perf_counter()
+        # A timeout cut short by the caller's deadline says nothing about the upstream.
+        clamped = timeout < self.adaptive_timeout()
+        try:
+            yield timeout
+        except BaseException as e:
+            kind = _failure_kind(e)
+            if kind == "timeout" and clamped:
+                self.breaker.release()
+            elif kind is not None:
+                UPSTREAM_FAILURES.inc(upstream=self.name, kind=kind)
+                self.breaker.record_failure()
+            elif isinstance(e, Exception):
+                self.breaker.record_success()  # e.g. a 4xx: the upstream itself is healthy
+            else:
+                self.breaker.release()  # cancelled (hedge loser, client gone)
+            raise
+        else:
+            self.breaker.record_success()
+            if record_latency:
+                self.latencies.append(time.perf_counter() - started)
+
+    async def call(self, func, hedge: bool = False):
+        """
+        Runs `func(timeout)` (a coroutine factory) under this upstream's policy.
+        With `hedge=True` (idempotent calls only) a second identical request is sent
+        once the first has been outstanding longer than the observed p95; the first
+        success wins and the other is cancelled.
+        """
+        if hedge:
+            return await self._hedged(func)
+        try:
+            async with self.guard() as timeout:
+                return await asyncio.wait_for(func(timeout), timeout)
+        except asyncio.TimeoutError:
+            raise UpstreamTimeout(f"{self.name} did not respond in time.")
+
+    async def _hedged(self, func):
+        delay = self.percentile(HEDGE_PERCENTILE)
+        if delay is None:
+            return await self.call(func)
+
+        first = asyncio.ensure_future(self.call(func))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            # Budget checked when the hedge would fire, so bursts can't all hedge at once.
+            if not done and self.hedges < HEDGE_MAX_RATIO * self.calls:
+                self.hedges += 1
+                UPSTREAM_HEDGES.inc(upstream=self.name)
+                tasks.add(asyncio.ensure_future(self.call(func)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+UPSTREAMS = {
+    "serpapi": Upstream(
+        "serpapi", SERPAPI_TIMEOUT_MAX,
+        AdmissionGate("serpapi", SERPAPI_CONCURRENCY, SERPAPI_RATE_LIMIT, SERPAPI_RATE_BURST),
+    ),
+    "huggingface": Upstream(
+        "huggingface", HUGGINGFACE_TIMEOUT_MAX,
+        AdmissionGate("huggingface", HUGGINGFACE_CONCURRENCY, HUGGINGFACE_RATE_LIMIT, HUGGINGFACE_RATE_BURST),
+    ),
+}
+
+
+def upstream(name: str) -> Upstream:
+    return UPSTREAMS[name]
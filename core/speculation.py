@@ -0,0 +1,89 @@
+import os
+import asyncio
+import contextvars
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from core.metrics import Counter, Gauge
+
+load_dotenv()
+
+# --- Speculative Execution Configuration ---
+SPECULATION_ENABLED = os.getenv("SPECULATION_ENABLED", "true").lower() == "true"
+# -----------------------------------
+
+SPECULATIONS = Counter(
+    "speculations_total",
+    "Speculative prefetches by outcome: used, or unused (cancelled, or finished but never needed).",
+    ("kind", "outcome"),
+)
+SPECULATION_HIT_RATIO = Gauge("speculation_hit_ratio", "Share of speculative prefetches that were used.", ("kind",))
+
+_outcomes = {}  # kind -> [used, unused], for the hit ratio
+_current = contextvars.ContextVar("speculation", default=None)
+
+
+def _record(kind: str, outcome: str):
+    counts = _outcomes.setdefault(kind, [0, 0])
+    counts[0 if outcome == "used" else 1] += 1
+    SPECULATIONS.inc(kind=kind, outcome=outcome)
+    SPECULATION_HIT_RATIO.set(counts[0] / (counts[0] + counts[1]), kind=kind)
+
+
+class Speculation:
+    """
+    Short-lived buffer of work a request started before knowing it needs it
+    (e.g. retrieval while the upload is still arriving), keyed by (kind, key).
+    `speculative()` call sites take a matching result instead of repeating the
+    call; `close()` cancels whatever was never taken.
+    """
+    def __init__(self):
+        self._tasks = {}
+
+    def start(self, kind: str, key: str, factory):
+        """Runs `factory()` in the background unless the same work is already buffered."""
+        if not SPECULATION_ENABLED or (kind, key) in self._tasks:
+            return
+        self._tasks[(kind, key)] = asyncio.create_task(factory())
+
+    def cancel(self, kind: str):
+        """Drops buffered work of `kind` once it is known not to be needed."""
+        for kind_key in [k for k in self._tasks if k[0] == kind]:
+            task = self._tasks.pop(kind_key)
+            if task.done() and not task.cancelled():
+                task.exception()  # retrieved, so a failed prefetch isn't logged as unhandled
+            task.cancel()
+            _record(kind, "unused")
+
+    def take(self, kind: str, key: str):
+        task = self._tasks.pop((kind, key), None)
+        if task is not None:
+            _record(kind, "used")
+        return task
+
+    def close(self):
+        for kind, _ in list(self._tasks):
+            self.cancel(kind)
+
+
+@contextmanager
+def speculation_scope(speculation: Speculation | None = None):
+    """
+    Makes `speculation` (a fresh one by default) current for the enclosed code;
+    cancels leftovers on exit.
+    """
+    speculation = speculation or Speculation()
+    token = _current.set(speculation)
+    try:
+        yield speculation
+    finally:
+        _current.reset(token)
+        speculation.close()
+
+
+async def speculative(kind: str, key: str, factory):
+    """`await factory()`, or the result of identical work this request already started."""
+    speculation = _current.get()
+    task = speculation.take(kind, key) if speculation is not None else None
+    if task is None:
+        return await factory()
+    return await task
@@ -0,0 +1,217 @@
+import io
+import os
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+
+# --- Descriptor Layout ---
+# Every image is reduced to at most WORK_SIZE px before any pixel math, so cost
+# per image is roughly constant regardless of the upload's resolution.
+WORK_SIZE = 64
+COLOR_BINS = 4                     # per channel -> 4*4*4 joint RGB histogram
+INTENSITY_BINS = 32
+HASH_SIZE = 8                      # dHash on a 9x8 grid -> 64 bits
+GRADIENT_SIZE = 32
+GRADIENT_GRID = 4                  # 4x4 cells
+GRADIENT_ORIENTATIONS = 8          # unsigned orientation bins per cell
+
+COLOR_DIM = COLOR_BINS ** 3
+HASH_DIM = HASH_SIZE * HASH_SIZE
+GRADIENT_DIM = GRADIENT_GRID * GRADIENT_GRID * GRADIENT_ORIENTATIONS
+DESCRIPTOR_DIM = COLOR_DIM + INTENSITY_BINS + HASH_DIM + GRADIENT_DIM
+
+FEATURE_WORKERS = int(os.getenv("FEATURE_WORKERS", str(min(4, os.cpu_count() or 1))))
+FEATURE_CHUNK_SIZE = int(os.getenv("FEATURE_CHUNK_SIZE", "64"))
+# -----------------------------------
+
+_LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+_HASH_WEIGHTS = (1 << np.arange(HASH_DIM - 1, -1, -1, dtype=np.uint64)).astype(np.uint64)
+_EXIF_ORIENTATION = 0x0112
+_EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def _open_reduced(source):
+    """
+    Opens bytes or a path and decodes at reduced resolution. JPEGs honour
+    `draft()` and are DCT-scaled during decode (up to 1/8), so full-size
+    pixels are never materialised; other formats use Pillow's fast `reduce`.
+    """
+    with Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source) as src:
+        original_size = src.size
+        original_format = src.format
+        orientation = src.getexif().get(_EXIF_ORIENTATION, 1)
+        src.draft("RGB", (WORK_SIZE, WORK_SIZE))
+        img = src.convert("RGB") if src.mode != "RGB" else src
+        img.thumbnail((WORK_SIZE, WORK_SIZE), Image.Resampling.BILINEAR, reducing_gap=2.0)
+        # Rotate the small image rather than the decoded original.
+        transpose = _EXIF_TRANSPOSE.get(orientation)
+        if transpose is not None:
+            img = img.transpose(transpose)
+        elif img is src:
+            img = img.copy()  # `src` is closed on exit; the thumbnail is small
+    return img, original_size, original_format
+
+
+def _dhash_bits(gray_img: Image.Image) -> np.ndarray:
+    small = np.asarray(gray_img.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BILINEAR), dtype=np.int16)
+    return (small[:, 1:] > small[:, :-1]).reshape(-1)
+
+
+def _gradient_histogram(gray_img: Image.Image) -> np.ndarray:
+    g = np.asarray(gray_img.resize((GRADIENT_SIZE, GRADIENT_SIZE), Image.Resampling.BILINEAR), dtype=np.float32)
+    gx = np.zeros_like(g)
+    gy = np.zeros_like(g)
+    gx[:, 1:-1] = g[:, 2:] - g[:, :-2]
+    gy[1:-1, :] = g[2:, :] - g[:-2, :]
+    magnitude = np.hypot(gx, gy)
+    orientation = np.mod(np.arctan2(gy, gx), np.pi)  # unsigned, [0, pi)
+    bins = np.minimum((orientation / np.pi * GRADIENT_ORIENTATIONS).astype(np.int64), GRADIENT_ORIENTATIONS - 1)
+
+    cell = GRADIENT_SIZE // GRADIENT_GRID
+    rows, cols = np.indices((GRADIENT_SIZE, GRADIENT_SIZE))
+    cell_index = (rows // cell) * GRADIENT_GRID + (cols // cell)
+    flat = (cell_index * GRADIENT_ORIENTATIONS + bins).reshape(-1)
+    return np.bincount(flat, weights=magnitude.reshape(-1), minlength=GRADIENT_DIM).astype(np.float32)
+
+
+def _unit(v: np.ndarray) -> np.ndarray:
+    norm = float(np.linalg.norm(v))
+    return v / norm if norm > 0 else v
+
+
+def extract_features(source):
+    """
+    Computes one image's descriptor.
+    Returns (descriptor float32[DESCRIPTOR_DIM], dhash uint64, info dict).
+    Each block (colour, intensity, hash, gradients) is unit-normalised and weighted
+    equally, so the full descriptor is unit length and dot product = cosine similarity.
+    """
+    img, (width, height), fmt = _open_reduced(source)
+    rgb = np.asarray(img, dtype=np.uint8)
+    pixels = rgb.reshape(-1, 3)
+
+    quantised = (pixels.astype(np.uint16) * COLOR_BINS) >> 8
+    color_idx = (quantised[:, 0] * COLOR_BINS + quantised[:, 1]) * COLOR_BINS + quantised[:, 2]
+    color_hist = np.bincount(color_idx, minlength=COLOR_DIM).astype(np.float32)
+
+    intensity = pixels.astype(np.float32) @ _LUMA
+    intensity_hist = np.bincount(
+        np.minimum((intensity * INTENSITY_BINS / 256).astype(np.int64), INTENSITY_BINS - 1),
+        minlength=INTENSITY_BINS,
+    ).astype(np.float32)
+
+    gray_img = img.convert("L")
+    hash_bits = _dhash_bits(gray_img)
+    gradients = _gradient_histogram(gray_img)
+
+    blocks = [
+        _unit(np.sqrt(color_hist)),          # Hellinger-style for histograms
+        _unit(np.sqrt(intensity_hist)),
+        _unit(np.where(hash_bits, 1.0, -1.0).astype(np.float32)),
+        _unit(np.sqrt(gradients)),
+    ]
+    descriptor = (np.concatenate(blocks) / np.sqrt(len(blocks))).astype(np.float32)
+    dhash = np.uint64((hash_bits.astype(np.uint64) * _HASH_WEIGHTS).sum())
+
+    channel_spread = float(np.abs(pixels.astype(np.int16) - pixels.mean(axis=1, keepdims=True)).mean())
+    info = {
+        "width": width,
+        "height": height,
+        "format": fmt,
+        "mean_intensity": round(float(intensity.mean()) / 255.0, 4),
+        "contrast": round(float(intensity.std()) / 255.0, 4),
+        "grayscale": channel_spread < 3.0,
+    }
+    return descriptor, dhash, info
+
+
+def extract_batch(sources: list) -> dict:
+    """
+    Descriptors for many images as stacked arrays:
+    {"descriptors": (n, DESCRIPTOR_DIM) float32, "hashes": (n,) uint64, "info": [dict]}.
+    Undecodable images get an all-zero row and an `error` entry in their info.
+    """
+    descriptors = np.zeros((len(sources), DESCRIPTOR_DIM), dtype=np.float32)
+    hashes = np.zeros(len(sources), dtype=np.uint64)
+    infos = []
+    for i, source in enumerate(sources):
+        try:
+            descriptors[i], hashes[i], info = extract_features(source)
+        except Exception as e:
+            info = {"error": str(e)}
+        infos.append(info)
+    return {"descriptors": descriptors, "hashes": hashes, "info": infos}
+
+
+class FeatureExtractor:
+    """
+    Runs `extract_batch` on a process pool so pixel work never touches the event
+    loop (or the GIL of the serving process). Batches are split into chunks and
+    spread across workers; results come back as stacked NumPy arrays.
+    """
+    def __init__(self, max_workers: int = FEATURE_WORKERS, chunk_size: int = FEATURE_CHUNK_SIZE):
+        self.max_workers = max_workers
+        self.chunk_size = max(1, chunk_size)
+        self._pool = None
+
+    def _executor(self):
+        if self.max_workers <= 0:
+            return None  # default thread pool; handy for development
+        if self._pool is None:
+            # 'spawn' avoids forking a process that already runs an event loop and threads.
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    async def extract_batch_async(self, sources: list) -> dict:
+        if not sources:
+            return extract_batch([])
+        loop = asyncio.get_running_loop()
+        executor = self._executor()
+        chunks = [sources[i:i + self.chunk_size] for i in range(0, len(sources), self.chunk_size)]
+        parts = await asyncio.gather(*[loop.run_in_executor(executor, extract_batch, c) for c in chunks])
+        return {
+            "descriptors": np.concatenate([p["descriptors"] for p in parts]),
+            "hashes": np.concatenate([p["hashes"] for p in parts]),
+            "info": [info for p in parts for info in p["info"]],
+        }
+
+    async def extract_async(self, source):
+        """Single-image convenience wrapper: (descriptor, dhash, info)."""
+        batch = await self.extract_batch_async([source])
+        return batch["descriptors"][0], batch["hashes"][0], batch["info"][0]
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+feature_extractor = FeatureExtractor()
+
+
+if __name__ == "__main__":
+    # Throughput check: python feature_extractor.py <image files...>
+    import sys
+    import time
+
+    paths = sys.argv[1:]
+    if not paths:
+        sys.exit("usage: python feature_extractor.py <image files...>")
+    started = time.perf_counter()
+    result = asyncio.run(feature_extractor.extract_batch_async(paths))
+    elapsed = time.perf_counter() - started
+    feature_extractor.shutdown()
+    print(f"{len(paths)} images -> {result['descriptors'].shape} in {elapsed:.2f}s "
+          f"({len(paths) / elapsed:.0f} img/s)")
@@ -1,36 +1,97 @@
 import os
-from fastapi import FastAPI
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 from api.router import router
+from api.streaming import router as streaming_router
+from api.batch import router as batch_router
+from api.jobs import router as jobs_router
 from core.config import STATIC_DIR
+from core.http import http_pool
+from core.metrics import MetricsMiddleware, monitor_event_loop_lag, publish_metrics, publish, METRICS_DIR
+from core.resilience import DeadlineMiddleware, UpstreamError, remaining
+from core.admission import AdmissionMiddleware
+from core.lifecycle import worker_ready
+from core.jobs import job_manager
+from feature_extractor import feature_extractor
 
 load_dotenv() 
 
+# --- Logging (core/, api/ and the newer services log through `logging`) ---
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s",
+)
+logging.getLogger("httpx").setLevel(logging.WARNING)  # one INFO line per upstream call otherwise
+
+# --- App Lifespan (services, shared outbound connection pool, feature-extractor processes) ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Services are built here (or already in the parent, see serve.py), not at import time.
+    worker_ready()
+    await http_pool.startup()
+    await job_manager.startup()
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    metrics_publisher = asyncio.create_task(publish_metrics()) if METRICS_DIR else None
+    yield
+    lag_monitor.cancel()
+    if metrics_publisher is not None:
+        metrics_publisher.cancel()
+        publish()  # final counts of this worker stay in the merged totals
+    await job_manager.shutdown()
+    await http_pool.shutdown()
+    feature_extractor.shutdown()
+
 # --- FastAPI App Setup ---
 app = FastAPI(
     title="Web-Based Multimodal AI Chatbot",
     version="1.0.0",
     description="Uses external APIs for all data retrieval (Web RAG, NER, Web Image Search).",
+    lifespan=lifespan,
 )
 
+# --- Error Handlers ---
+@app.exception_handler(UpstreamError)
+async def upstream_error_handler(request: Request, exc: UpstreamError):
+    """Overload, open circuits and spent deadlines are temporary: 503, never a bare 500."""
+    retry_after = max(1, round(getattr(exc, "retry_after", 1)))
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc), "retry_after": retry_after},
+        headers={"Retry-After": str(retry_after)},
+    )
+
 # --- Middleware ---
+# Innermost: queues or sheds requests once the deadline below is known, and its
+# 503s still pass through CORS.
+app.add_middleware(AdmissionMiddleware, budget=remaining)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], 
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "Retry-After"],
 )
+app.add_middleware(DeadlineMiddleware)
+# Outermost, so latency and Server-Timing cover everything below it.
+app.add_middleware(MetricsMiddleware)
 
 # --- Mount Static Files ---
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
 # --- Include API Routes ---
 app.include_router(router)
+app.include_router(streaming_router)
+app.include_router(batch_router)
+app.include_router(jobs_router)
 
-# --- Uvicorn Execution ---
+# --- Uvicorn Execution (development; use serve.py in production) ---
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
@@ -0,0 +1,135 @@
+"""
+Production entry point:  python serve.py [--workers N] [--host H] [--port P]
+
+With gunicorn installed (it is in requirements.txt), the app and its services (entity vocabulary, index
+metadata) are loaded once in the master and forked into uvicorn workers, which
+share that memory copy-on-write. Without gunicorn, uvicorn's own supervisor is
+used; its workers are spawned and each builds its services itself.
+Both use uvloop + httptools when available (installed with uvicorn[standard]).
+"""
+import os
+import shutil
+import argparse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Server Configuration ---
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+# One worker by default. Jobs and sessions are shared through their SQLite
+# stores (JOB_DB, SESSION_DB), but admission and upstream concurrency limits
+# (core/admission.py) apply per worker: divide them when raising this.
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+SERVER_KEEPALIVE = int(os.getenv("SERVER_KEEPALIVE", "5"))
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", "2048"))
+# Recycle workers after this many requests (0 = never); jitter avoids restarting all at once.
+SERVER_MAX_REQUESTS = int(os.getenv("SERVER_MAX_REQUESTS", "0"))
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "30"))
+# -----------------------------------
+
+
+def _fast_loop() -> str:
+    try:
+        import uvloop  # noqa: F401
+        return "uvloop"
+    except ImportError:
+        return "asyncio"
+
+
+def _fast_http() -> str:
+    try:
+        import httptools  # noqa: F401
+        return "httptools"
+    except ImportError:
+        return "h11"
+
+
+def _uvicorn_worker_class() -> str:
+    try:
+        import uvicorn_worker  # noqa: F401
+        return "uvicorn_worker.UvicornWorker"
+    except ImportError:
+        return "uvicorn.workers.UvicornWorker"  # deprecated location, same worker
+
+
+def run_gunicorn(host: str, port: int, workers: int):
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            settings = {
+                "bind": f"{host}:{port}",
+                "workers": workers,
+                "worker_class": _uvicorn_worker_class(),  # picks uvloop/httptools itself
+                "preload_app": True,
+                "keepalive": SERVER_KEEPALIVE,
+                "backlog": SERVER_BACKLOG,
+                "graceful_timeout": SERVER_GRACEFUL_TIMEOUT,
+                "max_requests": SERVER_MAX_REQUESTS,
+                "max_requests_jitter": SERVER_MAX_REQUESTS // 10,
+            }
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Runs once in the master because of preload_app.
+            from core.lifecycle import preload
+            from main import app
+            preload()
+            return app
+
+    Server().run()
+
+
+def run_uvicorn(host: str, port: int, workers: int):
+    import uvicorn
+
+    options = {
+        "host": host,
+        "port": port,
+        "loop": _fast_loop(),
+        "http": _fast_http(),
+        "timeout_keep_alive": SERVER_KEEPALIVE,
+        "backlog": SERVER_BACKLOG,
+        "timeout_graceful_shutdown": SERVER_GRACEFUL_TIMEOUT,
+        "limit_max_requests": SERVER_MAX_REQUESTS or None,
+    }
+    if workers > 1:
+        uvicorn.run("main:app", workers=workers, **options)
+    else:
+        from main import app
+        uvicorn.run(app, **options)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the chatbot API with multiple workers.")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS)
+    parser.add_argument("--server", choices=("auto", "gunicorn", "uvicorn"), default="auto")
+    args = parser.parse_args(argv)
+
+    server = args.server
+    if server == "auto":
+        try:
+            import gunicorn  # noqa: F401
+            server = "gunicorn"
+        except ImportError:
+            server = "uvicorn"
+    if args.workers > 1:
+        # Each worker publishes its metrics here and /metrics merges them; files
+        # of a previous run would count twice, so every start begins empty.
+        from core.config import DATA_DIR
+        metrics_dir = os.environ.setdefault("METRICS_DIR", os.path.join(DATA_DIR, "metrics"))
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+    print(f"Starting {args.workers} {server} worker(s) on {args.host}:{args.port} "
+          f"(loop={_fast_loop()}, http={_fast_http()}).")
+    if server == "gunicorn":
+        run_gunicorn(args.host, args.port, max(1, args.workers))
+    else:
+        run_uvicorn(args.host, args.port, max(1, args.workers))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import os
+import logging
+import re
+import json
+import uuid
+import asyncio
+import hashlib
+from PIL import Image
+from dotenv import load_dotenv
+from core.config import DATA_DIR
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# --- Blob Store Configuration ---
+BLOB_DIR = os.getenv("BLOB_DIR", os.path.join(DATA_DIR, "blobs"))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(256 * 1024)))
+PREVIEW_MAX_SIZE = int(os.getenv("PREVIEW_MAX_SIZE", "512"))
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", "80"))
+# -----------------------------------
+
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+# Raster formats accepted for upload, by what Pillow detects in the bytes. The
+# client's Content-Type is never stored: blobs are served from our own origin,
+# and e.g. image/svg+xml would make them executable.
+IMAGE_MEDIA_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp", "GIF": "image/gif"}
+
+
+class UploadTooLarge(Exception):
+    """Raised while streaming once an upload exceeds the configured limit."""
+    def __init__(self, limit: int):
+        super().__init__(f"Upload exceeds the {limit / (1024 * 1024):.0f} MB limit.")
+        self.limit = limit
+
+
+class UnsupportedImage(Exception):
+    """Raised when an upload's bytes are not one of IMAGE_MEDIA_TYPES."""
+    def __init__(self):
+        super().__init__("Only PNG, JPEG, WebP and GIF images are supported.")
+
+
+def detect_media_type(path: str) -> str | None:
+    """Media type from the file's own header (Pillow reads only the first bytes), or None."""
+    try:
+        with Image.open(path) as img:
+            return IMAGE_MEDIA_TYPES.get(img.format)
+    except Exception:
+        return None
+
+
+def render_webp(source, dst_path: str, max_size: int, quality: int):
+    """Downscales `source` (path or file object) to fit max_size and writes WebP atomically."""
+    with Image.open(source) as img:
+        img.draft("RGB", (max_size, max_size))  # JPEG: decode at reduced scale
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "transparency" in img.info or img.mode in ("LA", "PA") else "RGB")
+        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        tmp_path = f"{dst_path}.{uuid.uuid4().hex}.tmp"
+        img.save(tmp_path, "WEBP", quality=quality, method=4)
+    os.replace(tmp_path, dst_path)
+
+
+class BlobStore:
+    """
+    Content-addressed store for uploads: files live at <root>/<aa>/<sha256>.
+    Uploads are streamed in fixed-size chunks (hashing as they go), so memory per
+    upload is bounded by the chunk size and identical uploads are stored once.
+    Previews are rendered once per blob and served by URL with immutable caching.
+    """
+    def __init__(self, root: str = BLOB_DIR):
+        self.root = root
+        self._preview_locks = {}
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+
+    # --- Paths ---
+
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def preview_path_for(self, digest: str) -> str:
+        return self.path_for(digest) + ".preview.webp"
+
+    def meta_path_for(self, digest: str) -> str:
+        return self.path_for(digest) + ".json"
+
+    def exists(self, digest: str) -> bool:
+        return bool(DIGEST_RE.match(digest)) and os.path.exists(self.path_for(digest))
+
+    def metadata(self, digest: str) -> dict:
+        try:
+            with open(self.meta_path_for(digest), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def url_for(digest: str) -> str:
+        return f"/blobs/{digest}"
+
+    @staticmethod
+    def preview_url_for(digest: str) -> str:
+        return f"/blobs/{digest}/preview"
+
+    # --- Writing ---
+
+    def writer(self, filename: str | None = None, max_bytes: int = MAX_UPLOAD_BYTES) -> "BlobWriter":
+        """Push-style upload, for callers that receive the bytes piecewise (streaming form parser)."""
+        return BlobWriter(self, filename, max_bytes)
+
+    async def save_upload(self, upload, max_bytes: int = MAX_UPLOAD_BYTES, chunk_size: int = UPLOAD_CHUNK_SIZE) -> dict:
+        """
+        Streams an UploadFile (anything with `async read(n)`) into the store.
+        Raises UploadTooLarge as soon as `max_bytes` is exceeded, UnsupportedImage
+        if the bytes aren't an accepted raster image.
+        Returns {"digest", "size", "content_type", "filename", "path"}.
+        """
+        writer = self.writer(getattr(upload, "filename", None), max_bytes)
+        try:
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                await writer.write(chunk)
+            return await writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+
+    async def ensure_preview(self, digest: str) -> str | None:
+        """Renders the downscaled WebP preview once; concurrent callers share the work."""
+        preview_path = self.preview_path_for(digest)
+        if os.path.exists(preview_path):
+            return preview_path
+        lock = self._preview_locks.setdefault(digest, asyncio.Lock())
+        try:
+            async with lock:
+                if not os.path.exists(preview_path):
+                    try:
+                        await asyncio.to_thread(
+                            render_webp, self.path_for(digest), preview_path, PREVIEW_MAX_SIZE, PREVIEW_QUALITY
+                        )
+                    except Exception as e:
+                        logger.warning("Preview generation error for %s: %s", digest, e)
+                        return None
+        finally:
+            # Waiters already hold the lock object; later callers find the file.
+            if self._preview_locks.get(digest) is lock:
+                del self._preview_locks[digest]
+        return preview_path
+
+
+class BlobWriter:
+    """
+    One upload in progress: chunks are hashed as they arrive and spooled to a temp
+    file in UPLOAD_CHUNK_SIZE writes; `close` checks the format and moves it to
+    its content address.
+    """
+    def __init__(self, store: BlobStore, filename: str | None, max_bytes: int):
+        self.store = store
+        self.content_type = None  # detected on close
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._hasher = hashlib.sha256()
+        self._pending = bytearray()
+        self._tmp_path = os.path.join(store.root, "tmp", uuid.uuid4().hex)
+        self._file = open(self._tmp_path, "wb")
+
+    async def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise UploadTooLarge(self.max_bytes)
+        self._hasher.update(chunk)
+        self._pending += chunk
+        if len(self._pending) >= UPLOAD_CHUNK_SIZE:
+            await self._flush()
+
+    async def _flush(self):
+        if self._pending:
+            data, self._pending = bytes(self._pending), bytearray()
+            await asyncio.to_thread(self._file.write, data)
+
+    async def close(self) -> dict:
+        """Returns {"digest", "size", "content_type", "filename", "path"}; raises UnsupportedImage."""
+        await self._flush()
+        self._file.close()
+        self.content_type = await asyncio.to_thread(detect_media_type, self._tmp_path)
+        if self.content_type is None:
+            os.remove(self._tmp_path)
+            raise UnsupportedImage()
+        digest = self._hasher.hexdigest()
+        final_path = self.store.path_for(digest)
+        if os.path.exists(final_path):
+            os.remove(self._tmp_path)  # already stored; content-addressed dedup
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(self._tmp_path, final_path)
+        # Rewritten for existing blobs too, replacing any client-supplied type stored before.
+        with open(self.store.meta_path_for(digest), "w", encoding="utf-8") as f:
+            json.dump({"content_type": self.content_type, "size": self.size}, f)
+        return {
+            "digest": digest,
+            "size": self.size,
+            "content_type": self.content_type,
+            "filename": self.filename,
+            "path": final_path,
+        }
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+blob_store = BlobStore()
@@ -0,0 +1,132 @@
+import os
+import re
+import zlib
+import numpy as np
+from dotenv import load_dotenv
+from core.metrics import Counter, Histogram
+from services.local_index import tokenize
+
+load_dotenv()
+
+# --- Context Packing Configuration ---
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "900"))
+CONTEXT_CHARS_PER_TOKEN = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", "4"))
+# Estimated Jaccard similarity above which two snippets count as the same passage.
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.7"))
+# A document that doesn't fit is truncated only if at least this many tokens remain.
+CONTEXT_MIN_CHUNK_TOKENS = int(os.getenv("CONTEXT_MIN_CHUNK_TOKENS", "40"))
+# -----------------------------------
+
+SHINGLE_SIZE = 3
+NUM_PERMUTATIONS = 64
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_rng = np.random.default_rng(1)
+_PERM_A = _rng.integers(1, 1 << 31, size=NUM_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _rng.integers(0, 1 << 31, size=NUM_PERMUTATIONS, dtype=np.uint64)
+_WORD_RE = re.compile(r"\w+")
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s")
+
+CONTEXT_TOKENS = Histogram(
+    "context_tokens", "Estimated prompt context tokens after packing.",
+    buckets=(100, 200, 400, 600, 800, 1000, 1500, 2000, 4000),
+)
+CONTEXT_DROPPED = Counter("context_documents_dropped_total", "Retrieved snippets left out of the prompt.", ("reason",))
+
+
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / CONTEXT_CHARS_PER_TOKEN) + 1
+
+
+def _minhash(text: str) -> np.ndarray | None:
+    words = _WORD_RE.findall(text.lower())
+    if not words:
+        return None
+    shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1))}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    # (a*h + b) mod p for every permutation x shingle, minimum per permutation.
+    return ((_PERM_A[:, None] * hashes[None, :] + _PERM_B[:, None]) % _MERSENNE_PRIME).min(axis=1)
+
+
+def _tfidf_scores(question: str, docs: list) -> np.ndarray:
+    """Cosine similarity between the question and each doc in a TF-IDF space built from the docs."""
+    doc_tokens = [tokenize(d) for d in docs]
+    vocab = {}
+    for tokens in doc_tokens:
+        for t in tokens:
+            vocab.setdefault(t, len(vocab))
+    query_ids = [vocab[t] for t in tokenize(question) if t in vocab]
+    if not vocab or not query_ids:
+        return np.zeros(len(docs), dtype=np.float32)
+
+    counts = np.zeros((len(docs), len(vocab)), dtype=np.float32)
+    for row, tokens in enumerate(doc_tokens):
+        np.add.at(counts[row], [vocab[t] for t in tokens], 1.0)
+    df = np.count_nonzero(counts, axis=0)
+    idf = np.log((1.0 + len(docs)) / (1.0 + df)) + 1.0
+    doc_vectors = np.log1p(counts) * idf  # sublinear tf
+    query_vector = np.bincount(query_ids, minlength=len(vocab)).astype(np.float32)
+    query_vector = np.log1p(query_vector) * idf
+
+    norms = np.linalg.norm(doc_vectors, axis=1) * np.linalg.norm(query_vector)
+    return np.divide(doc_vectors @ query_vector, norms, out=np.zeros(len(docs), dtype=np.float32), where=norms > 0)
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """Cuts at the last sentence (else word) boundary that fits `max_tokens`."""
+    limit = int(max_tokens * CONTEXT_CHARS_PER_TOKEN)
+    cut = text[:limit]
+    sentence_ends = [m.start() for m in _SENTENCE_END_RE.finditer(cut)]
+    if sentence_ends and sentence_ends[-1] > limit // 2:
+        return cut[:sentence_ends[-1]]
+    return cut.rsplit(" ", 1)[0] + " ..."
+
+
+class ContextPacker:
+    """
+    Turns retrieved snippets into a prompt context of bounded size:
+    drop near-duplicates (MinHash over word shingles), rank by TF-IDF cosine
+    similarity to the question, then greedily pack the best into the token budget.
+    """
+    def __init__(self, token_budget: int = CONTEXT_TOKEN_BUDGET, dedup_threshold: float = CONTEXT_DEDUP_THRESHOLD):
+        self.token_budget = token_budget
+        self.dedup_threshold = dedup_threshold
+
+    def pack(self, question: str, docs: list) -> list:
+        """Selected documents, most relevant first."""
+        docs = [d.strip() for d in docs if d and d.strip()]
+        if not docs:
+            return []
+
+        scores = _tfidf_scores(question, docs)
+        # Stable sort: equal scores keep the retrieval order.
+        order = np.argsort(-scores, kind="stable")
+
+        kept_signatures = []
+        packed = []
+        budget = self.token_budget
+        for i in order:
+            signature = _minhash(docs[i])
+            if signature is not None and any(
+                float(np.mean(signature == other)) >= self.dedup_threshold for other in kept_signatures
+            ):
+                CONTEXT_DROPPED.inc(reason="duplicate")
+                continue
+
+            cost = estimate_tokens(docs[i])
+            if cost <= budget:
+                packed.append(docs[i])
+            elif budget >= CONTEXT_MIN_CHUNK_TOKENS:
+                packed.append(_truncate(docs[i], budget))
+                cost = budget
+            else:
+                CONTEXT_DROPPED.inc(reason="budget")
+                continue
+            budget -= cost
+            if signature is not None:
+                kept_signatures.append(signature)
+
+        CONTEXT_TOKENS.observe(self.token_budget - budget)
+        return packed
+
+
+context_packer = ContextPacker()
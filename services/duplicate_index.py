@@ -0,0 +1,148 @@
+import os
+import time
+import threading
+import numpy as np
+from dotenv import load_dotenv
+from core.cache import CACHE_REGISTRY
+from core.metrics import Counter
+from feature_extractor import DESCRIPTOR_DIM, HASH_DIM
+
+load_dotenv()
+
+# --- Near-Duplicate Upload Configuration ---
+DUPLICATE_LOOKUP_ENABLED = os.getenv("DUPLICATE_LOOKUP_ENABLED", "true").lower() == "true"
+# Max differing dHash bits (of 64) for two uploads to count as the same image.
+DUPLICATE_MAX_DISTANCE = int(os.getenv("DUPLICATE_MAX_DISTANCE", "6"))
+# Candidates must also agree on the full descriptor (cosine), so structurally
+# similar but different images don't share a description.
+DUPLICATE_MIN_SIMILARITY = float(os.getenv("DUPLICATE_MIN_SIMILARITY", "0.9"))
+DUPLICATE_TABLE_SIZE = int(os.getenv("DUPLICATE_TABLE_SIZE", "4096"))
+DUPLICATE_TTL = float(os.getenv("DUPLICATE_TTL", "3600"))
+# -----------------------------------
+
+DUPLICATE_LOOKUPS = Counter(
+    "duplicate_lookups_total",
+    "Image uploads checked against earlier ones (exact, near, miss).",
+    ("outcome",),
+)
+
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    """Set bits per uint64."""
+    return np.unpackbits(values.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+class DuplicateIndex:
+    """
+    Fixed-capacity ring of recent uploads: their 64-bit dHash, descriptor and
+    computed result, held in flat NumPy arrays. Lookup is multi-index hashing:
+    the hash is cut into `max_distance + 1` bands, each with its own
+    band value -> slots table. Two hashes within `max_distance` bits agree
+    exactly on at least one band (pigeonhole), so probing one bucket per band
+    finds every candidate without scanning the table; candidates are then
+    checked by Hamming distance and descriptor similarity.
+    """
+    def __init__(self, capacity: int = DUPLICATE_TABLE_SIZE, max_distance: int = DUPLICATE_MAX_DISTANCE,
+                 min_similarity: float = DUPLICATE_MIN_SIMILARITY, ttl: float = DUPLICATE_TTL,
+                 dim: int = DESCRIPTOR_DIM):
+        self.capacity = max(1, capacity)
+        self.max_distance = min(max(0, max_distance), HASH_DIM - 1)
+        self.min_similarity = min_similarity
+        self.ttl = ttl
+        n_bands = self.max_distance + 1
+        edges = np.linspace(0, HASH_DIM, n_bands + 1).astype(int)
+        self._bands = [(int(lo), (1 << int(hi - lo)) - 1) for lo, hi in zip(edges[:-1], edges[1:])]
+
+        self._hashes = np.zeros(self.capacity, dtype=np.uint64)
+        self._descriptors = np.zeros((self.capacity, dim), dtype=np.float32)
+        self._stored_at = np.full(self.capacity, -np.inf)
+        self._digests = [None] * self.capacity
+        self._results = [None] * self.capacity
+        self._buckets = [{} for _ in self._bands]  # per band: band value -> [slot, ...]
+        self._by_digest = {}
+        self._next = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        CACHE_REGISTRY["duplicates"] = self
+
+    def __len__(self):
+        return len(self._by_digest)
+
+    def _band_values(self, dhash: int):
+        return [(dhash >> shift) & mask for shift, mask in self._bands]
+
+    def _live(self, slot: int) -> bool:
+        return self._results[slot] is not None and time.time() - self._stored_at[slot] < self.ttl
+
+    def get(self, digest: str) -> dict | None:
+        """Result stored for byte-identical content, without decoding the image."""
+        slot = self._by_digest.get(digest)
+        if slot is not None and self._live(slot):
+            self.hits += 1
+            DUPLICATE_LOOKUPS.inc(outcome="exact")
+            return self._results[slot]
+        return None
+
+    def search(self, analysis: dict) -> dict | None:
+        """Result of the closest earlier upload within the distance and similarity limits."""
+        dhash = int(analysis["hash"])
+        candidates = set()
+        for bucket, value in zip(self._buckets, self._band_values(dhash)):
+            candidates.update(bucket.get(value, ()))
+        candidates = np.fromiter((s for s in candidates if self._live(s)), dtype=np.int64)
+        if len(candidates):
+            distances = _popcount(self._hashes[candidates] ^ np.uint64(dhash))
+            similarities = self._descriptors[candidates] @ np.asarray(analysis["descriptor"], dtype=np.float32)
+            ok = (distances <= self.max_distance) & (similarities >= self.min_similarity)
+            if ok.any():
+                best = np.lexsort((-similarities[ok], distances[ok]))[0]
+                self.near_hits += 1
+                DUPLICATE_LOOKUPS.inc(outcome="near")
+                return self._results[int(candidates[ok][best])]
+        self.misses += 1
+        DUPLICATE_LOOKUPS.inc(outcome="miss")
+        return None
+
+    def add(self, digest: str, analysis: dict, result: dict):
+        """Remembers `result` for this upload, overwriting the oldest slot when full."""
+        if "error" in analysis["info"]:
+            return
+        dhash = int(analysis["hash"])
+        with self._lock:
+            slot = self._next
+            self._next = (slot + 1) % self.capacity
+            if self._digests[slot] is not None:
+                old_hash = int(self._hashes[slot])
+                for bucket, value in zip(self._buckets, self._band_values(old_hash)):
+                    slots = bucket.get(value)
+                    if slots is not None and slot in slots:
+                        slots.remove(slot)
+                        if not slots:
+                            del bucket[value]
+                if self._by_digest.get(self._digests[slot]) == slot:
+                    del self._by_digest[self._digests[slot]]
+
+            self._hashes[slot] = np.uint64(dhash)
+            self._descriptors[slot] = analysis["descriptor"]
+            self._stored_at[slot] = time.time()
+            self._digests[slot] = digest
+            self._results[slot] = result
+            for bucket, value in zip(self._buckets, self._band_values(dhash)):
+                bucket.setdefault(value, []).append(slot)
+            self._by_digest[digest] = slot
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits + self.near_hits,
+            "exact_hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "entries": len(self),
+            "capacity": self.capacity,
+            "max_distance": self.max_distance,
+        }
+
+
+duplicate_index = DuplicateIndex()
@@ -0,0 +1,340 @@
+import os
+import logging
+import sys
+import mmap
+import struct
+from array import array
+from dotenv import load_dotenv
+from core.config import BASE_DIR, DATA_DIR
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# --- Vocabulary Configuration ---
+# TSV, one surface form per line: term <TAB> concept_id [<TAB> entity_group]
+# Synonyms share a concept_id; the first term listed for a concept is its canonical name.
+MEDICAL_VOCAB_PATH = os.getenv(
+    "MEDICAL_VOCAB_PATH", os.path.join(BASE_DIR, "resources", "medical_vocabulary.tsv")
+)
+MEDICAL_VOCAB_COMPILED = os.getenv(
+    "MEDICAL_VOCAB_COMPILED", os.path.join(DATA_DIR, "medical_vocabulary.bin")
+)
+# -----------------------------------
+
+COMPILED_FORMAT_VERSION = 2
+_MAGIC = b"MEDVOCAC"
+# magic, version, states, edges, outputs, terms, concepts, concept text bytes
+_HEADER = struct.Struct("<8s7I")
+_UINT32 = "I"
+_UTF32 = "utf-32-le" if sys.byteorder == "little" else "utf-32-be"
+_ARRAYS = (
+    "edge_offsets", "edge_chars", "edge_targets", "fail",
+    "output_offsets", "output_ids", "term_lengths", "term_concepts", "concept_offsets",
+)
+_WHITESPACE_TO_SPACE = str.maketrans({"\t": " ", "\n": " ", "\r": " ", "\f": " ", "\v": " "})
+
+
+def _normalize(text: str) -> str:
+    """Lowercases and maps every whitespace char to ' ' without changing offsets."""
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        # A few code points expand when lowercased; keep offsets aligned.
+        lowered = "".join(ch.lower()[0] for ch in text)
+    return lowered.translate(_WHITESPACE_TO_SPACE)
+
+
+class MedicalEntityMatcher:
+    """
+    Aho-Corasick automaton over a medical vocabulary. Built once, then every text
+    is scanned in a single pass regardless of vocabulary size. Matches respect word
+    boundaries and overlapping hits resolve to the leftmost-longest term, so
+    "chest pain" wins over "pain".
+
+    The automaton is held as flat uint32 arrays rather than a dict per node, so a
+    compiled file is mmapped and shared between worker processes instead of being
+    unpickled into each of them:
+      - edge_offsets[n]:edge_offsets[n + 1] is node n's slice of edge_chars
+        (sorted code points) and edge_targets (the next node for each)
+      - fail[n] is node n's failure link
+      - output_offsets[n]:output_offsets[n + 1] is node n's slice of output_ids
+        (term ids ending at n, including those inherited via failure links)
+      - concept c's (concept_id, canonical_name, entity_group) are the UTF-8
+        strings between concept_offsets[3c:3c + 4] in concept_text
+    """
+    def __init__(self):
+        # Node 0 is the root.
+        self.edge_offsets = array(_UINT32, [0, 0])
+        self.edge_chars = array(_UINT32)
+        self.edge_targets = array(_UINT32)
+        self.fail = array(_UINT32, [0])
+        self.output_offsets = array(_UINT32, [0, 0])
+        self.output_ids = array(_UINT32)
+        self.term_lengths = array(_UINT32)   # term id -> length in characters
+        self.term_concepts = array(_UINT32)  # term id -> concept index
+        self.concept_offsets = array(_UINT32, [0])
+        self.concept_text = b""
+        self._mmap = None
+        self._labels = None
+
+    @property
+    def num_states(self) -> int:
+        return len(self.fail)
+
+    # --- Construction ---
+
+    @classmethod
+    def from_terms(cls, entries):
+        """`entries` yields (term, concept_id, entity_group) tuples."""
+        matcher = cls()
+        concept_index = {}
+        concepts = []
+        goto = [{}]
+        pending_output = [[]]
+        seen = set()
+        for term, concept_id, group in entries:
+            term = " ".join(_normalize(term).split())
+            if not term or (term, concept_id) in seen:
+                continue
+            seen.add((term, concept_id))
+            if concept_id not in concept_index:
+                concept_index[concept_id] = len(concepts)
+                concepts.append((concept_id, term, group))
+
+            node = 0
+            for ch in term:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    pending_output.append([])
+                node = nxt
+            pending_output[node].append(len(matcher.term_lengths))
+            matcher.term_lengths.append(len(term))
+            matcher.term_concepts.append(concept_index[concept_id])
+
+        matcher._build_failure_links(goto, pending_output)
+        text = bytearray()
+        for fields in concepts:
+            for value in fields:
+                text += value.encode("utf-8")
+                matcher.concept_offsets.append(len(text))
+        matcher.concept_text = bytes(text)
+        return matcher
+
+    @classmethod
+    def from_vocabulary_file(cls, path: str, default_group: str = "KEYWORD"):
+        def entries():
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    if not line.strip() or line.lstrip().startswith("#"):
+                        continue
+                    parts = line.split("\t")
+                    term = parts[0]
+                    concept_id = parts[1] if len(parts) > 1 and parts[1] else term.strip().lower()
+                    group = parts[2] if len(parts) > 2 and parts[2] else default_group
+                    yield term, concept_id, group
+        return cls.from_terms(entries())
+
+    def _build_failure_links(self, goto, pending_output):
+        """Computes failure links over the dict trie, then flattens it into arrays."""
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        head = 0
+        while head < len(queue):
+            node = queue[head]
+            head += 1
+            for ch, child in goto[node].items():
+                queue.append(child)
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                target = goto[f].get(ch, 0)
+                fail[child] = target if target != child else 0
+                pending_output[child].extend(pending_output[fail[child]])
+
+        self.fail = array(_UINT32, fail)
+        self.edge_offsets = array(_UINT32, [0])
+        self.output_offsets = array(_UINT32, [0])
+        for node, edges in enumerate(goto):
+            for ch in sorted(edges):
+                self.edge_chars.append(ord(ch))
+                self.edge_targets.append(edges[ch])
+            self.edge_offsets.append(len(self.edge_chars))
+            self.output_ids.extend(pending_output[node])
+            self.output_offsets.append(len(self.output_ids))
+
+    # --- Serialization ---
+
+    def save(self, path: str):
+        """
+        Header, then each array as native-endian uint32, then the concept text.
+        `load` maps all of it straight out of the file without copying.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        header = _HEADER.pack(
+            _MAGIC, COMPILED_FORMAT_VERSION, self.num_states, len(self.edge_chars),
+            len(self.output_ids), len(self.term_lengths), len(self.concept_offsets) // 3,
+            len(self.concept_text),
+        )
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            for name in _ARRAYS:
+                getattr(self, name).tofile(f)
+            f.write(self.concept_text)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, states, edges, outputs, terms, concepts, text_len = _HEADER.unpack_from(mapped)
+        except struct.error:
+            mapped.close()
+            raise ValueError("Truncated compiled vocabulary")
+        if magic != _MAGIC or version != COMPILED_FORMAT_VERSION:
+            mapped.close()
+            raise ValueError(f"Unsupported compiled vocabulary format: {magic!r} v{version}")
+        lengths = {
+            "edge_offsets": states + 1, "edge_chars": edges, "edge_targets": edges,
+            "fail": states, "output_offsets": states + 1, "output_ids": outputs,
+            "term_lengths": terms, "term_concepts": terms, "concept_offsets": 3 * concepts + 1,
+        }
+        arrays_end = _HEADER.size + 4 * sum(lengths.values())
+        if len(mapped) != arrays_end + text_len:
+            mapped.close()
+            raise ValueError("Compiled vocabulary size does not match its header")
+
+        matcher = cls()
+        view = memoryview(mapped)
+        offset = _HEADER.size
+        for name in _ARRAYS:
+            end = offset + 4 * lengths[name]
+            setattr(matcher, name, view[offset:end].cast(_UINT32))
+            offset = end
+        matcher.concept_text = view[arrays_end:]
+        matcher._mmap = mapped
+        return matcher
+
+    # --- Matching ---
+
+    def concept(self, index: int) -> tuple:
+        """(concept_id, canonical_name, entity_group) of a concept index."""
+        offsets, text = self.concept_offsets, self.concept_text
+        start = 3 * index
+        return tuple(str(text[offsets[k]:offsets[k + 1]], "utf-8") for k in range(start, start + 3))
+
+    def _edge_labels(self):
+        """
+        edge_chars as one string, so each step is a C-level `str.find` within the
+        node's slice, plus the root's edges as a dict since most steps restart
+        there. Built once per process (4 bytes per edge at most); the arrays
+        themselves stay mapped.
+        """
+        if self._labels is None:
+            labels = str(self.edge_chars, _UTF32)
+            root = dict(zip(labels[:self.edge_offsets[1]], self.edge_targets))
+            self._labels = (labels, root)
+        return self._labels
+
+    def find(self, text: str) -> list:
+        """All entity spans in `text`, in order of appearance."""
+        normalized = _normalize(text)
+        labels, root = self._edge_labels()
+        find_edge = labels.find
+        edge_offsets, edge_targets = self.edge_offsets, self.edge_targets
+        fail, output_offsets, output_ids = self.fail, self.output_offsets, self.output_ids
+        candidates = []
+        node = 0
+        for i, ch in enumerate(normalized):
+            while node:
+                j = find_edge(ch, edge_offsets[node], edge_offsets[node + 1])
+                if j >= 0:
+                    node = edge_targets[j]
+                    break
+                node = fail[node]
+            else:
+                node = root.get(ch, 0)
+            first, last = output_offsets[node], output_offsets[node + 1]
+            if first == last:
+                continue
+            for term_id in output_ids[first:last]:
+                end = i + 1
+                start = end - self.term_lengths[term_id]
+                if (start == 0 or not normalized[start - 1].isalnum()) and (
+                    end == len(normalized) or not normalized[end].isalnum()
+                ):
+                    candidates.append((start, -end, term_id))
+
+        # Leftmost-longest, non-overlapping
+        spans = []
+        last_end = 0
+        for start, neg_end, term_id in sorted(candidates):
+            if start < last_end:
+                continue
+            end = -neg_end
+            concept_id, canonical, group = self.concept(self.term_concepts[term_id])
+            spans.append({
+                "entity_group": group,
+                "score": 1.0,
+                "word": canonical.capitalize(),
+                "concept_id": concept_id,
+                "start": start,
+                "end": end,
+                "text": text[start:end],
+            })
+            last_end = end
+        return spans
+
+    def find_batch(self, texts: list) -> list:
+        """`find` for many documents in one call; one span list per input text."""
+        return [self.find(text) for text in texts]
+
+    def __len__(self):
+        return len(self.term_lengths)
+
+
+def load_matcher(fallback_terms=()) -> MedicalEntityMatcher:
+    """
+    Loads the compiled automaton if it is newer than the vocabulary file, otherwise
+    builds it from the vocabulary and caches the compiled form. Falls back to
+    `fallback_terms` when no vocabulary file is present.
+    """
+    vocab_exists = os.path.exists(MEDICAL_VOCAB_PATH)
+    if os.path.exists(MEDICAL_VOCAB_COMPILED) and (
+        not vocab_exists or os.path.getmtime(MEDICAL_VOCAB_COMPILED) >= os.path.getmtime(MEDICAL_VOCAB_PATH)
+    ):
+        try:
+            return MedicalEntityMatcher.load(MEDICAL_VOCAB_COMPILED)
+        except (OSError, ValueError) as e:
+            logger.warning("Could not load compiled vocabulary (%s); rebuilding.", e)
+
+    if not vocab_exists:
+        logger.warning("MEDICAL_VOCAB_PATH not found. Using the built-in keyword list.")
+        return MedicalEntityMatcher.from_terms(
+            (term, term, "KEYWORD") for term in fallback_terms
+        )
+
+    matcher = MedicalEntityMatcher.from_vocabulary_file(MEDICAL_VOCAB_PATH)
+    try:
+        matcher.save(MEDICAL_VOCAB_COMPILED)
+    except OSError as e:
+        logger.warning("Could not write compiled vocabulary: %s", e)
+    return matcher
+
+
+if __name__ == "__main__":
+    # Precompile: python -m services.entity_matcher [vocab.tsv] [out.bin]
+    import sys
+    import time
+
+    src = sys.argv[1] if len(sys.argv) > 1 else MEDICAL_VOCAB_PATH
+    dst = sys.argv[2] if len(sys.argv) > 2 else MEDICAL_VOCAB_COMPILED
+    started = time.perf_counter()
+    compiled = MedicalEntityMatcher.from_vocabulary_file(src)
+    compiled.save(dst)
+    print(f"Compiled {len(compiled)} terms ({compiled.num_states} states) in {time.perf_counter() - started:.2f}s -> {dst}")
@@ -0,0 +1,300 @@
+import os
+import json
+import threading
+import numpy as np
+from dotenv import load_dotenv
+from core.config import DATA_DIR
+from feature_extractor import DESCRIPTOR_DIM
+
+try:
+    import fcntl  # cross-process append lock (POSIX)
+except ImportError:  # pragma: no cover - Windows dev boxes
+    fcntl = None
+
+load_dotenv()
+
+# --- Image Index Configuration ---
+IMAGE_INDEX_DIR = os.getenv("IMAGE_INDEX_DIR", os.path.join(DATA_DIR, "image_index"))
+IMAGE_INDEX_DTYPE = os.getenv("IMAGE_INDEX_DTYPE", "float32")  # 'float32' or 'uint8' (quantised)
+IMAGE_INDEX_NPROBE = int(os.getenv("IMAGE_INDEX_NPROBE", "8"))
+# Below this many rows a brute-force scan is faster than probing IVF lists.
+IMAGE_INDEX_IVF_MIN_ROWS = int(os.getenv("IMAGE_INDEX_IVF_MIN_ROWS", "50000"))
+# -----------------------------------
+
+INDEX_FORMAT_VERSION = 1
+SCAN_CHUNK_ROWS = 65536
+
+
+class ImageIndex:
+    """
+    Append-only nearest-neighbour index over unit-length image descriptors.
+
+    On disk (one directory):
+      meta.json      dim / dtype / version
+      vectors.bin    raw row-major matrix, float32 or uint8-quantised
+      items.jsonl    one metadata object per row (row number = internal id)
+      centroids.npy  optional IVF coarse quantiser (see `train_ivf`)
+      lists.i32      IVF list assignment per row, appended alongside vectors
+
+    The matrix is opened with `np.memmap(mode="r")`, so every worker process
+    shares the same page-cache pages instead of holding its own copy. Appends
+    take an exclusive file lock; readers pick up new rows on their next search.
+    """
+    def __init__(self, path: str, dim: int = DESCRIPTOR_DIM, dtype: str = IMAGE_INDEX_DTYPE):
+        self.path = path
+        self.dim = dim
+        self.dtype = dtype
+        self._vectors = None
+        self._rows = 0
+        self._metadata = []
+        self._metadata_offset = 0
+        self._centroids = None
+        self._lists = None
+        self._assigned_rows = 0
+        self._ivf_stamp = None  # (inode, mtime) of the centroids the lists were built from
+        self._refresh_lock = threading.Lock()
+
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            self.dim = meta["dim"]
+            self.dtype = meta["dtype"]
+        if self.dtype not in ("float32", "uint8"):
+            raise ValueError(f"Unsupported image index dtype: {self.dtype}")
+
+    # --- Paths / encoding ---
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @property
+    def _np_dtype(self):
+        return np.float32 if self.dtype == "float32" else np.uint8
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dtype == "float32":
+            return vectors
+        return np.clip(np.rint((vectors + 1.0) * 127.5), 0, 255).astype(np.uint8)
+
+    def _scores(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        if self.dtype == "float32":
+            return rows @ query
+        # x = (q8 - 127.5) / 127.5  =>  x . q = (q8 . q) / 127.5 - sum(q)
+        return (rows.astype(np.float32) @ query) / 127.5 - float(query.sum())
+
+    def __len__(self):
+        self._refresh()
+        return self._rows
+
+    # --- Reading ---
+
+    def _centroids_stamp(self):
+        try:
+            st = os.stat(self._file("centroids.npy"))
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def _refresh(self):
+        """
+        Maps rows appended since the last call (by this or another process), and
+        reloads the IVF lists when `train_ivf` replaced the centroids.
+        """
+        vectors_path = self._file("vectors.bin")
+        if not os.path.exists(vectors_path):
+            return
+        row_bytes = self.dim * np.dtype(self._np_dtype).itemsize
+        on_disk = os.path.getsize(vectors_path) // row_bytes
+        if on_disk == self._rows and self._centroids_stamp() == self._ivf_stamp:
+            return
+        with self._refresh_lock:
+            stamp = self._centroids_stamp()
+            if stamp != self._ivf_stamp:
+                self._centroids = None  # retrained (or removed): rebuild every list
+                self._ivf_stamp = stamp
+            if on_disk == self._rows:
+                self._refresh_ivf()
+                return
+            with open(self._file("items.jsonl"), "rb") as f:
+                f.seek(self._metadata_offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # writer mid-line; pick it up next time
+                    self._metadata.append(json.loads(line))
+                    self._metadata_offset += len(line)
+            rows = min(on_disk, len(self._metadata))
+            self._vectors = np.memmap(vectors_path, dtype=self._np_dtype, mode="r", shape=(rows, self.dim))
+            self._rows = rows
+            self._refresh_ivf()
+
+    def _refresh_ivf(self):
+        centroids_path = self._file("centroids.npy")
+        if not os.path.exists(centroids_path):
+            self._centroids = None
+            self._lists = None
+            return
+        if self._centroids is None:
+            self._ivf_stamp = self._centroids_stamp()
+            self._centroids = np.load(centroids_path)
+            self._lists = [np.empty(0, dtype=np.int64) for _ in range(len(self._centroids))]
+            self._assigned_rows = 0
+        assignments = np.fromfile(self._file("lists.i32"), dtype=np.int32)[self._assigned_rows:self._rows]
+        if len(assignments) == 0:
+            return
+        rows = np.arange(self._assigned_rows, self._assigned_rows + len(assignments))
+        order = np.argsort(assignments, kind="stable")
+        lists, starts = np.unique(assignments[order], return_index=True)
+        for list_id, chunk in zip(lists, np.split(rows[order], starts[1:])):
+            self._lists[list_id] = np.concatenate([self._lists[list_id], chunk])
+        self._assigned_rows += len(assignments)
+
+    def search(self, query: np.ndarray, k: int = 8, nprobe: int = IMAGE_INDEX_NPROBE) -> list:
+        """Top-k rows by dot product: [{"score": float, "row": int, **metadata}, ...]."""
+        self._refresh()
+        if self._rows == 0 or k <= 0:
+            return []
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        vectors = self._vectors
+
+        if self._lists is not None and self._rows >= IMAGE_INDEX_IVF_MIN_ROWS:
+            probe = np.argsort(self._centroids @ query)[::-1][:max(1, nprobe)]
+            candidates = np.sort(np.concatenate([self._lists[i] for i in probe]))
+            scores = self._scores(vectors[candidates], query)
+            keep = self._top_k(scores, k)
+            top, top_scores = candidates[keep], scores[keep]
+        else:
+            best_rows, best_scores = [], []
+            for start in range(0, self._rows, SCAN_CHUNK_ROWS):
+                chunk_scores = self._scores(vectors[start:start + SCAN_CHUNK_ROWS], query)
+                local = self._top_k(chunk_scores, k)
+                best_rows.append(local + start)
+                best_scores.append(chunk_scores[local])
+            rows = np.concatenate(best_rows)
+            scores = np.concatenate(best_scores)
+            keep = self._top_k(scores, k)
+            top, top_scores = rows[keep], scores[keep]
+
+        order = np.argsort(top_scores)[::-1]
+        return [
+            {"score": float(top_scores[i]), "row": int(top[i]), **self._metadata[int(top[i])]}
+            for i in order
+        ]
+
+    @staticmethod
+    def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+        if len(scores) <= k:
+            return np.arange(len(scores))
+        return np.argpartition(scores, -k)[-k:]
+
+    # --- Writing ---
+
+    def _locked(self):
+        os.makedirs(self.path, exist_ok=True)
+        lock_file = open(self._file(".lock"), "a+")
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def add(self, vectors: np.ndarray, metadata: list):
+        """Appends rows. Metadata is written before vectors so readers never see a row without it."""
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if vectors.shape != (len(metadata), self.dim):
+            raise ValueError(f"Expected {len(metadata)} vectors of dim {self.dim}, got {vectors.shape}.")
+
+        lock_file = self._locked()
+        try:
+            meta_path = self._file("meta.json")
+            if not os.path.exists(meta_path):
+                with open(meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim, "dtype": self.dtype, "version": INDEX_FORMAT_VERSION}, f)
+
+            with open(self._file("items.jsonl"), "a", encoding="utf-8") as f:
+                for item in metadata:
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+            centroids_path = self._file("centroids.npy")
+            if os.path.exists(centroids_path):
+                assignments = np.argmax(vectors @ np.load(centroids_path).T, axis=1).astype(np.int32)
+                with open(self._file("lists.i32"), "ab") as f:
+                    f.write(assignments.tobytes())
+
+            with open(self._file("vectors.bin"), "ab") as f:
+                f.write(self._encode(vectors).tobytes())
+        finally:
+            lock_file.close()
+        self._refresh()
+
+    def train_ivf(self, n_lists: int = 1024, iterations: int = 10, sample_size: int = 100_000, seed: int = 0):
+        """
+        Spherical k-means over a sample of rows, then assigns every row to its
+        nearest centroid. Searches probe only `nprobe` of `n_lists` lists.
+        """
+        self._refresh()
+        if self._rows < n_lists:
+            raise ValueError(f"Need at least {n_lists} rows to train {n_lists} lists (have {self._rows}).")
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(self._rows, size=min(sample_size, self._rows), replace=False))
+        sample = self._decode(self._vectors[sample_rows])
+
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            empty = norms[:, 0] == 0
+            centroids[~empty] = sums[~empty] / norms[~empty]
+
+        assignments = np.empty(self._rows, dtype=np.int32)
+        for start in range(0, self._rows, SCAN_CHUNK_ROWS):
+            chunk = self._decode(self._vectors[start:start + SCAN_CHUNK_ROWS])
+            assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+
+        lock_file = self._locked()
+        try:
+            assignments.tofile(self._file("lists.i32.tmp"))
+            os.replace(self._file("lists.i32.tmp"), self._file("lists.i32"))
+            np.save(self._file("centroids.tmp.npy"), centroids.astype(np.float32))
+            os.replace(self._file("centroids.tmp.npy"), self._file("centroids.npy"))
+        finally:
+            lock_file.close()
+        self._centroids = None
+        self._refresh_ivf()
+
+    def _decode(self, rows: np.ndarray) -> np.ndarray:
+        if self.dtype == "float32":
+            return np.asarray(rows, dtype=np.float32)
+        return (rows.astype(np.float32) - 127.5) / 127.5
+
+
+image_index = ImageIndex(IMAGE_INDEX_DIR)
+
+
+if __name__ == "__main__":
+    # python -m services.image_index add <image dir> <url prefix>
+    # python -m services.image_index train [n_lists]
+    import sys
+    import asyncio
+    from feature_extractor import feature_extractor
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "add" and len(sys.argv) == 4:
+        image_dir, url_prefix = sys.argv[2], sys.argv[3].rstrip("/")
+        names = sorted(n for n in os.listdir(image_dir) if not n.startswith("."))
+        for start in range(0, len(names), 1024):
+            batch = names[start:start + 1024]
+            result = asyncio.run(feature_extractor.extract_batch_async([os.path.join(image_dir, n) for n in batch]))
+            ok = [i for i, info in enumerate(result["info"]) if "error" not in info]
+            image_index.add(
+                result["descriptors"][ok],
+                [{"id": batch[i], "url": f"{url_prefix}/{batch[i]}"} for i in ok],
+            )
+            print(f"Indexed {start + len(batch)}/{len(names)}")
+        feature_extractor.shutdown()
+    elif command == "train":
+        image_index.train_ivf(int(sys.argv[2]) if len(sys.argv) > 2 else 1024)
+        print(f"Trained IVF over {len(image_index)} rows.")
+    else:
+        sys.exit("usage: python -m services.image_index add <image dir> <url prefix> | train [n_lists]")
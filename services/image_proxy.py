@@ -0,0 +1,269 @@
+import io
+import os
+import hmac
+import json
+import fcntl
+import socket
+import asyncio
+import hashlib
+import secrets
+import ipaddress
+from urllib.parse import urlencode, urljoin, urlsplit
+from dotenv import load_dotenv
+from core.config import DATA_DIR
+from core.http import http_pool
+from core.cache import CACHE_REGISTRY
+from core.metrics import instrumented
+from services.blob_store import render_webp
+
+load_dotenv()
+
+# --- Image Proxy Configuration ---
+IMAGE_PROXY_ENABLED = os.getenv("IMAGE_PROXY_ENABLED", "true").lower() in ("1", "true", "yes")
+IMAGE_PROXY_DIR = os.getenv("IMAGE_PROXY_DIR", os.path.join(DATA_DIR, "image_proxy"))
+IMAGE_PROXY_CACHE_BYTES = int(os.getenv("IMAGE_PROXY_CACHE_BYTES", str(512 * 1024 * 1024)))
+IMAGE_PROXY_MAX_SOURCE_BYTES = int(os.getenv("IMAGE_PROXY_MAX_SOURCE_BYTES", str(15 * 1024 * 1024)))
+IMAGE_PROXY_TIMEOUT = float(os.getenv("IMAGE_PROXY_TIMEOUT", "10"))
+IMAGE_PROXY_MAX_REDIRECTS = int(os.getenv("IMAGE_PROXY_MAX_REDIRECTS", "3"))
+# Allowed variant widths; anything else is rejected so the cache can't be flooded.
+IMAGE_PROXY_WIDTHS = tuple(int(w) for w in os.getenv("IMAGE_PROXY_WIDTHS", "256,512,1024").split(","))
+IMAGE_PROXY_DEFAULT_WIDTH = int(os.getenv("IMAGE_PROXY_DEFAULT_WIDTH", "512"))
+IMAGE_PROXY_QUALITY = int(os.getenv("IMAGE_PROXY_QUALITY", "78"))
+IMAGE_PROXY_MAX_AGE = int(os.getenv("IMAGE_PROXY_MAX_AGE", str(7 * 24 * 3600)))
+# Shared by all workers; if unset, a key is generated once and kept in IMAGE_PROXY_DIR.
+IMAGE_PROXY_SECRET = os.getenv("IMAGE_PROXY_SECRET", "")
+# -----------------------------------
+
+
+class ImageProxyError(Exception):
+    """The upstream image could not be fetched or decoded."""
+
+
+class ImageProxy:
+    """
+    Fetches third-party result images once, stores a size-bounded WebP variant per
+    (url, width) on disk and serves it from our origin. Proxy URLs are HMAC-signed,
+    so the endpoint only fetches URLs this server handed out (no open proxy).
+
+    The disk cache is bounded by total bytes with LRU eviction; recency is kept
+    in file mtimes so the order survives restarts. Its size is tracked in a
+    usage file updated under a file lock, so the bound holds for all server
+    workers together.
+    """
+    # Evict down to this share of max_bytes, so the directory is rescanned once
+    # per batch of evictions rather than on every new variant.
+    EVICT_TO = 0.9
+
+    def __init__(self, root: str = IMAGE_PROXY_DIR, max_bytes: int = IMAGE_PROXY_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._locks = {}
+        self.hits = 0
+        self.misses = 0
+        self._secret = IMAGE_PROXY_SECRET.encode() or None
+
+    # --- Signing ---
+
+    def _key_material(self) -> bytes:
+        if self._secret is None:
+            os.makedirs(self.root, exist_ok=True)
+            key_path = os.path.join(self.root, "secret.key")
+            try:
+                with open(key_path, "xb") as f:
+                    f.write(secrets.token_bytes(32))
+            except FileExistsError:
+                pass
+            with open(key_path, "rb") as f:
+                self._secret = f.read()
+        return self._secret
+
+    def sign(self, url: str, width: int) -> str:
+        return hmac.new(self._key_material(), f"{width}:{url}".encode(), hashlib.sha256).hexdigest()[:32]
+
+    def verify(self, url: str, width: int, signature: str) -> bool:
+        return hmac.compare_digest(self.sign(url, width), signature)
+
+    def url_for(self, url: str, width: int = IMAGE_PROXY_DEFAULT_WIDTH) -> str:
+        """Proxy URL for an http(s) image; anything else (e.g. data: placeholders) is returned as is."""
+        if not IMAGE_PROXY_ENABLED or not url.startswith(("http://", "https://")):
+            return url
+        return "/image-proxy?" + urlencode({"u": url, "w": width, "s": self.sign(url, width)})
+
+    # --- Disk cache ---
+
+    @staticmethod
+    def cache_key(url: str, width: int) -> str:
+        return hashlib.sha256(f"{width}:{url}".encode()).hexdigest()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key + ".webp")
+
+    def _scan(self) -> list:
+        """[(mtime, key, size)] of every cached variant, least recently used first."""
+        found = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith(".webp"):
+                    try:
+                        st = os.stat(os.path.join(dirpath, name))
+                    except OSError:
+                        continue  # evicted by another worker meanwhile
+                    found.append((st.st_mtime, name[:-5], st.st_size))
+        return sorted(found)
+
+    def _usage(self, update=None) -> dict:
+        """
+        {"bytes", "entries"} of the whole cache, shared by all workers through
+        <root>/usage.json. `update(usage)` runs under the file lock; the directory
+        is rescanned when the file is missing or the cache is over its bound.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, "usage.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            usage_path = os.path.join(self.root, "usage.json")
+            try:
+                with open(usage_path) as f:
+                    usage = json.load(f)
+            except (OSError, ValueError):
+                usage = None
+            if usage is None or update is not None:
+                if usage is None:
+                    found = self._scan()
+                    usage = {"bytes": sum(size for _, _, size in found), "entries": len(found)}
+                if update is not None:
+                    update(usage)
+                if usage["bytes"] > self.max_bytes:
+                    self._evict(usage)
+                tmp_path = f"{usage_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(usage, f)
+                os.replace(tmp_path, usage_path)
+            return usage
+
+    def _evict(self, usage: dict):
+        """Removes least recently used variants (rescanned from disk) down to EVICT_TO."""
+        found = self._scan()
+        usage["bytes"], usage["entries"] = sum(size for _, _, size in found), len(found)
+        for _, key, size in found[:-1]:
+            if usage["bytes"] <= self.max_bytes * self.EVICT_TO:
+                break
+            try:
+                os.remove(self.path_for(key))
+            except OSError:
+                continue
+            usage["bytes"] -= size
+            usage["entries"] -= 1
+
+    def _touch(self, key: str):
+        try:
+            os.utime(self.path_for(key))
+        except OSError:
+            pass
+
+    def _register(self, key: str):
+        size = os.path.getsize(self.path_for(key))
+
+        def add(usage: dict):
+            usage["bytes"] += size
+            usage["entries"] += 1
+
+        self._usage(add)
+
+    def stats(self) -> dict:
+        try:
+            with open(os.path.join(self.root, "usage.json")) as f:
+                usage = json.load(f)  # read only: no lock or rescan on the event loop
+        except (OSError, ValueError):
+            usage = {"bytes": 0, "entries": 0}
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": usage["entries"],
+            "bytes": usage["bytes"],
+            "max_bytes": self.max_bytes,
+        }
+
+    # --- Fetching ---
+
+    @staticmethod
+    async def _check_public(url: str):
+        """
+        Refuses URLs whose host resolves to a private, loopback, link-local or
+        otherwise internal address, so a result URL (or a redirect it sends us
+        to) can't make the proxy fetch from our own network.
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ImageProxyError("Only http(s) image URLs can be proxied.")
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise ImageProxyError(f"Could not resolve {parts.hostname}: {e}")
+        for info in infos:
+            address = ipaddress.ip_address(info[4][0].split("%", 1)[0])
+            if not address.is_global or address.is_multicast:
+                raise ImageProxyError(f"Refusing to fetch from internal address {address}.")
+
+    async def _download(self, url: str) -> bytes:
+        # Redirects are followed here, one checked hop at a time, not by the shared client.
+        for _ in range(IMAGE_PROXY_MAX_REDIRECTS + 1):
+            await self._check_public(url)
+            async with http_pool.client.stream(
+                "GET", url, timeout=IMAGE_PROXY_TIMEOUT, follow_redirects=False
+            ) as response:
+                if response.is_redirect:
+                    url = urljoin(url, response.headers["location"])
+                    continue
+                return await self._read_image(response)
+        raise ImageProxyError("Too many redirects.")
+
+    @staticmethod
+    async def _read_image(response) -> bytes:
+        response.raise_for_status()
+        content_type = response.headers.get("content-type", "")
+        if content_type and not content_type.startswith("image/"):
+            raise ImageProxyError(f"Upstream returned {content_type}, not an image.")
+        declared = int(response.headers.get("content-length") or 0)
+        if declared > IMAGE_PROXY_MAX_SOURCE_BYTES:
+            raise ImageProxyError("Upstream image is too large.")
+        body = bytearray()
+        async for chunk in response.aiter_bytes():
+            body += chunk
+            if len(body) > IMAGE_PROXY_MAX_SOURCE_BYTES:
+                raise ImageProxyError("Upstream image is too large.")
+        return bytes(body)
+
+    @instrumented("image_proxy")
+    async def fetch(self, url: str, width: int) -> tuple:
+        """
+        Returns (path, cache key) of the cached variant, fetching and resizing it on
+        first use. Concurrent requests for the same variant share one download.
+        """
+        key = self.cache_key(url, width)
+        path = self.path_for(key)
+        if os.path.exists(path):
+            self.hits += 1
+            self._touch(key)
+            return path, key
+        self.misses += 1
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        try:
+            async with lock:
+                if not os.path.exists(path):
+                    body = await self._download(url)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    try:
+                        await asyncio.to_thread(render_webp, io.BytesIO(body), path, width, IMAGE_PROXY_QUALITY)
+                    except Exception as e:
+                        raise ImageProxyError(f"Could not decode upstream image: {e}")
+                    await asyncio.to_thread(self._register, key)
+        finally:
+            if not lock.locked():
+                self._locks.pop(key, None)
+        return path, key
+
+
+image_proxy = ImageProxy()
+CACHE_REGISTRY["image_proxy"] = image_proxy  # reported by /cache/stats
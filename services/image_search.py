@@ -2,10 +2,21 @@ import os
 import requests
 from dotenv import load_dotenv
 from serpapi import GoogleSearch
-import base64
+import asyncio
+from core.http import http_pool
+from core.cache import search_cache, make_key
+from feature_extractor import feature_extractor
+from services.image_index import image_index
+from services.blob_store import blob_store
+from services.image_proxy import image_proxy
+from services.duplicate_index import duplicate_index, DUPLICATE_LOOKUP_ENABLED
+from core.metrics import instrumented
+from core.resilience import upstream
+from core.lifecycle import LazyService
 
 load_dotenv()
 SERPAPI_API_KEY = os.getenv("SERPAPI_API_KEY")
+SERPAPI_SEARCH_URL = os.getenv("SERPAPI_SEARCH_URL", "https://serpapi.com/search.json")
 HUGGINGFACE_API_KEY = os.getenv("HUGGINGFACE_API_KEY")
 # Any image-captioning model that works on the Inference API
 HUGGINGFACE_VISION_MODEL = os.getenv(
@@ -24,6 +35,79 @@ class ImageSearchService:
                 "WARNING: SERPAPI_API_KEY not found. "
                 "Image search will use a placeholder image."
             )
+        # Maps the vectors and reads item metadata now rather than on the first search.
+        print(f"Local image index: {len(image_index)} image(s).")
+
+    # Tiny transparent GIF placeholder (same as before)
+    PLACEHOLDER_IMAGE = (
+        "data:image/gif;base64,"
+        "R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7"
+    )
+
+    def _missing_key_response(self, query: str) -> dict:
+        return {
+            "status": "success",
+            "results": [self.PLACEHOLDER_IMAGE],
+            "message": (
+                f"Simulated web image retrieval for: {query}. "
+                "SERPAPI_API_KEY is missing; returning placeholder image."
+            ),
+        }
+
+    def _error_response(self, e: Exception) -> dict:
+        print(f"SerpApi Image Search Error: {e}")
+        return {
+            "status": "error",
+            "results": [self.PLACEHOLDER_IMAGE],
+            "message": (
+                f"Failed to fetch images from SerpApi: {e}. "
+                "Returning placeholder image."
+            ),
+        }
+
+    def _build_params(self, query: str, num_results: int) -> dict:
+        return {
+            "engine": "google",
+            "q": query,
+            "tbm": "isch",        # image search
+            "api_key": SERPAPI_API_KEY,
+            "num": num_results,
+        }
+
+    def _parse_results(self, results: dict, query: str) -> dict:
+        images = results.get("images_results", [])
+
+        # Prefer full-size 'original' URL, fall back to 'thumbnail'
+        urls = []
+        for img in images:
+            url = img.get("original") or img.get("thumbnail")
+            if url:
+                urls.append(url)
+
+        if not urls:
+            # No images found – return placeholder to keep UI stable
+            return {
+                "status": "success",
+                "results": [self.PLACEHOLDER_IMAGE],
+                "message": (
+                    f"No images found for '{query}' via SerpApi. "
+                    "Returning placeholder image."
+                ),
+            }
+
+        return {
+            "status": "success",
+            "results": urls,
+            "message": (
+                f"Web Image Search Complete via SerpApi. "
+                f"Retrieved {len(urls)} image(s) for: {query}."
+            ),
+        }
+
+    def _proxied(self, result: dict) -> dict:
+        # Point results at our resize-and-cache proxy instead of full-size third-party originals.
+        # Applied after the search cache, so cached entries keep the raw upstream URLs.
+        return {**result, "results": [image_proxy.url_for(url) for url in result.get("results", [])]}
 
     def retrieve_image_from_web(self, query: str, num_results: int = 4):
         """
@@ -32,91 +116,158 @@ class ImageSearchService:
         """
         print(f"Searching web for image: {query}")
 
-        # Tiny transparent GIF placeholder (same as before)
-        placeholder_base64 = (
-            "data:image/gif;base64,"
-            "R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7"
-        )
-
         # If no API key, stay in placeholder mode
         if not SERPAPI_API_KEY:
-            return {
-                "status": "success",
-                "results": [placeholder_base64],
-                "message": (
-                    f"Simulated web image retrieval for: {query}. "
-                    "SERPAPI_API_KEY is missing; returning placeholder image."
-                ),
-            }
+            return self._missing_key_response(query)
 
         try:
-            params = {
-                "engine": "google",
-                "q": query,
-                "tbm": "isch",        # image search
-                "api_key": SERPAPI_API_KEY,
-                "num": num_results,
-            }
+            search = GoogleSearch(self._build_params(query, num_results))
+            return self._proxied(self._parse_results(search.get_dict(), query))
 
-            search = GoogleSearch(params)
-            results = search.get_dict()
+        except Exception as e:
+            return self._error_response(e)
 
-            images = results.get("images_results", [])
+    async def _fetch_async(self, query: str, num_results: int) -> dict:
+        async def request(timeout: float) -> dict:
+            response = await http_pool.client.get(
+                SERPAPI_SEARCH_URL, params=self._build_params(query, num_results), timeout=timeout
+            )
+            response.raise_for_status()
+            return response.json()
 
-            # Prefer full-size 'original' URL, fall back to 'thumbnail'
-            urls = []
-            for img in images:
-                url = img.get("original") or img.get("thumbnail")
-                if url:
-                    urls.append(url)
+        return self._parse_results(await upstream("serpapi").call(request, hedge=True), query)
 
-            if not urls:
-                # No images found – return placeholder to keep UI stable
-                return {
-                    "status": "success",
-                    "results": [placeholder_base64],
-                    "message": (
-                        f"No images found for '{query}' via SerpApi. "
-                        "Returning placeholder image."
-                    ),
-                }
+    @instrumented("image_search")
+    async def retrieve_image_from_web_async(self, query: str, num_results: int = 4):
+        """
+        Non-blocking variant of `retrieve_image_from_web` using the shared connection pool.
+        Results are cached (memory + SQLite) and identical in-flight queries coalesced.
+        """
+        print(f"Searching web for image: {query}")
 
-            return {
-                "status": "success",
-                "results": urls,
-                "message": (
-                    f"Web Image Search Complete via SerpApi. "
-                    f"Retrieved {len(urls)} image(s) for: {query}."
-                ),
-            }
+        if not SERPAPI_API_KEY:
+            return self._missing_key_response(query)
+
+        key = make_key("images", query.strip().lower(), num_results)
+        try:
+            result = await search_cache.get_or_compute(
+                key, lambda: self._fetch_async(query, num_results)
+            )
+            return self._proxied(result)
 
         except Exception as e:
-            print(f"SerpApi Image Search Error: {e}")
-            return {
-                "status": "error",
-                "results": [placeholder_base64],
-                "message": (
-                    f"Failed to fetch images from SerpApi: {e}. "
-                    "Returning placeholder image."
-                ),
-            }
-    def handle_uploaded_image(self, file_bytes: bytes, content_type: str):
+            return self._error_response(e)
+
+    @instrumented("upload")
+    async def store_upload_async(self, upload) -> dict:
+        """Streams an UploadFile into the content-addressed blob store (raises UploadTooLarge)."""
+        return await blob_store.save_upload(upload)
+
+    @instrumented("preview")
+    async def handle_uploaded_image_async(self, blob: dict):
         """
-        Simple handler for uploaded images.
-        Returns a data URL so the frontend can preview the image.
-        Later you can plug in CNN/CLIP/etc here.
+        Handler for uploaded images stored in the blob store.
+        Returns a preview URL (downscaled WebP, rendered once and cached) instead of
+        inlining the image, so responses stay small regardless of upload size.
         """
-        base64_image = base64.b64encode(file_bytes).decode("utf-8")
-        data_url = f"data:{content_type};base64,{base64_image}"
-
+        digest = blob["digest"]
+        has_preview = await blob_store.ensure_preview(digest) is not None
         return {
             "status": "success",
-            "preview": data_url,
+            "preview": blob_store.preview_url_for(digest) if has_preview else blob_store.url_for(digest),
+            "url": blob_store.url_for(digest),
+            "digest": digest,
             "message": "Image uploaded successfully. (Model analysis can be added here.)",
         }
-    def describe_uploaded_image(self, file_bytes: bytes) -> str:
-        return "Image received successfully."
 
+    @instrumented("analyze")
+    async def analyze_uploaded_image_async(self, source) -> dict:
+        """
+        Local, CPU-only analysis on the feature-extractor process pool.
+        `source` is image bytes or a file path (preferred: only the path crosses processes).
+        Returns {"descriptor", "hash", "info"}; `info` has an `error` key if undecodable.
+        """
+        descriptor, dhash, info = await feature_extractor.extract_async(source)
+        return {"descriptor": descriptor, "hash": int(dhash), "info": info}
+
+    @instrumented("describe")
+    def describe_uploaded_image(self, analysis: dict | None = None) -> str:
+        if not analysis or "error" in analysis.get("info", {"error": None}):
+            return "Image received successfully."
+
+        info = analysis["info"]
+        tone = "grayscale" if info["grayscale"] else "colour"
+        brightness = info["mean_intensity"]
+        exposure = "dark" if brightness < 0.35 else "bright" if brightness > 0.65 else "mid-tone"
+        contrast = "high" if info["contrast"] > 0.25 else "low" if info["contrast"] < 0.1 else "moderate"
+        return (
+            f"Image received successfully: {info['width']}x{info['height']} {tone} "
+            f"{(info.get('format') or 'image').upper()}, predominantly {exposure} with {contrast} contrast."
+        )
+
+    @instrumented("similar_images")
+    async def find_similar_images_async(self, analysis: dict, fallback_query: str, k: int = 8) -> dict:
+        """
+        Image-to-image retrieval against the local embedding index, using the
+        upload's descriptor. Falls back to a SerpApi text search for
+        `fallback_query` when the index is empty or the image couldn't be decoded;
+        the response's `source` says which one answered.
+        """
+        if analysis and "error" not in analysis["info"]:
+            matches = await asyncio.to_thread(image_index.search, analysis["descriptor"], k)
+            urls = [m["url"] for m in matches if m.get("url")]
+            if urls:
+                return self._proxied({
+                    "status": "success",
+                    "source": "local_index",
+                    "results": urls,
+                    "scores": [m["score"] for m in matches if m.get("url")],
+                    "message": f"Retrieved {len(urls)} visually similar image(s) from the local index.",
+                })
+            reason = "the local image index is empty" if len(image_index) == 0 else "no local image matched"
+        else:
+            reason = "the image could not be decoded"
+        print(f"Similar images: {reason}; falling back to a web search for '{fallback_query}'.")
+        result = await self.retrieve_image_from_web_async(fallback_query)
+        message = f"Not visually matched ({reason}); web results for '{fallback_query}'."
+        return {**result, "source": "web_search", "message": f"{message} {result.get('message', '')}".strip()}
+
+    async def explain_upload_async(self, blob: dict, filename: str | None, cache_mode: str = "use") -> dict:
+        """
+        image_to_text: description, preview and visually similar images for an upload.
+        Re-uploads of the same or a near-identical image (re-saved, recompressed)
+        reuse the result computed for the earlier one: identical bytes are matched
+        by digest before decoding, near-duplicates by dHash + descriptor.
+        Returns {"answer", "images" (preview first), "message", "duplicate"}.
+        """
+        lookup = DUPLICATE_LOOKUP_ENABLED and cache_mode == "use"
+        analysis = None
+        result = duplicate_index.get(blob["digest"]) if lookup else None
+        if result is None:
+            analysis = await self.analyze_uploaded_image_async(blob["path"])
+            result = duplicate_index.search(analysis) if lookup else None
+        if result is not None:
+            return {
+                **result,
+                "message": "Image matches an earlier upload; reused its description and similar images.",
+                "duplicate": True,
+            }
+
+        # Filename is only a last-resort web query when the local index has nothing
+        filename_base = (filename or "medical image").rsplit(".", 1)[0]
+        preview_data, img_result = await asyncio.gather(
+            self.handle_uploaded_image_async(blob),
+            self.find_similar_images_async(analysis, filename_base),
+        )
+        preview = preview_data.get("preview")
+        result = {
+            "answer": self.describe_uploaded_image(analysis),
+            "images": ([preview] if preview else []) + img_result.get("results", []),
+            "message": f"Image uploaded and described. {img_result.get('message', '')}".strip(),
+        }
+        if DUPLICATE_LOOKUP_ENABLED and cache_mode != "bypass" and img_result.get("status") == "success":
+            duplicate_index.add(blob["digest"], analysis, result)
+        return {**result, "duplicate": False}
 
 
-image_service = ImageSearchService()
+image_service = LazyService("image_service", ImageSearchService)
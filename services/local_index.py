@@ -0,0 +1,351 @@
+import os
+import re
+import json
+import mmap
+import heapq
+import shutil
+import threading
+from collections import Counter
+import numpy as np
+from dotenv import load_dotenv
+from core.config import DATA_DIR
+
+load_dotenv()
+
+# --- Local Corpus Configuration ---
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", os.path.join(DATA_DIR, "local_index"))
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# Merge the smallest segments once there are more than this many.
+LOCAL_INDEX_MAX_SEGMENTS = int(os.getenv("LOCAL_INDEX_MAX_SEGMENTS", "8"))
+LOCAL_INDEX_MERGE_FACTOR = int(os.getenv("LOCAL_INDEX_MERGE_FACTOR", "4"))
+# -----------------------------------
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the to was were "
+    "what when where which who will with how does do can".split()
+)
+
+
+def tokenize(text: str) -> list:
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+class TermTable:
+    """
+    A segment's sorted term dictionary, memory-mapped like the postings:
+      terms.bin          UTF-8 terms back to back, in sorted order
+      term_bounds.npy    byte offset of each term in terms.bin (n + 1 entries)
+      term_postings.npy  first posting of each term (n + 1 entries; df = next - this)
+    Lookup is a binary search, so opening a segment reads nothing up front.
+    """
+    def __init__(self, path: str):
+        self._bytes = b""
+        with open(os.path.join(path, "terms.bin"), "rb") as f:
+            if os.fstat(f.fileno()).st_size:  # mmap refuses empty files (a segment without terms)
+                self._bytes = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Plain ndarray views of the maps: np.memmap's per-index overhead dominates a binary search.
+        self._bounds = np.load(os.path.join(path, "term_bounds.npy"), mmap_mode="r").view(np.ndarray)
+        self._postings = np.load(os.path.join(path, "term_postings.npy"), mmap_mode="r").view(np.ndarray)
+
+    def __len__(self):
+        return len(self._bounds) - 1
+
+    def _term(self, i: int) -> bytes:
+        return self._bytes[int(self._bounds[i]):int(self._bounds[i + 1])]
+
+    def _entry(self, i: int) -> tuple:
+        offset = int(self._postings[i])
+        return offset, int(self._postings[i + 1]) - offset
+
+    def get(self, term: str):
+        """(offset, df) of `term`'s postings, or None."""
+        key = term.encode("utf-8")
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._term(lo) == key:
+            return self._entry(lo)
+        return None
+
+    def items(self):
+        for i in range(len(self)):
+            yield self._term(i).decode("utf-8"), self._entry(i)
+
+    def close(self):
+        if isinstance(self._bytes, mmap.mmap):
+            self._bytes.close()
+
+    @staticmethod
+    def write(path: str, terms: list, dfs: list):
+        """`terms` sorted (str order = UTF-8 byte order, which the binary search relies on)."""
+        encoded = [t.encode("utf-8") for t in terms]
+        with open(os.path.join(path, "terms.bin"), "wb") as f:
+            for e in encoded:
+                f.write(e)
+        np.save(os.path.join(path, "term_bounds.npy"), np.concatenate([[0], np.cumsum([len(e) for e in encoded])]).astype(np.uint64))
+        np.save(os.path.join(path, "term_postings.npy"), np.concatenate([[0], np.cumsum(dfs)]).astype(np.uint64))
+
+
+class Segment:
+    """
+    Immutable on-disk slice of the index. Postings for a term are the contiguous
+    range [offset, offset + df) of two parallel arrays (local doc ids, term
+    frequencies); they and the term table are opened with mmap, so a segment
+    costs almost no heap.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.terms = TermTable(path)
+        self.postings_docs = np.load(os.path.join(path, "postings_docs.npy"), mmap_mode="r").view(np.ndarray)
+        self.postings_tf = np.load(os.path.join(path, "postings_tf.npy"), mmap_mode="r").view(np.ndarray)
+        self.doc_lengths = np.load(os.path.join(path, "doc_lengths.npy"), mmap_mode="r")
+        self.doc_offsets = np.load(os.path.join(path, "doc_offsets.npy"), mmap_mode="r")
+        self._text = open(os.path.join(path, "docs.txt"), "rb")
+        self._text_lock = threading.Lock()
+        self.norms = None  # BM25 length normalisation, filled by `prepare`
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.doc_lengths)
+
+    def prepare(self, avgdl: float, k1: float, b: float):
+        """Precomputes k1 * (1 - b + b * dl / avgdl) for every document."""
+        self.norms = (k1 * (1.0 - b + b * self.doc_lengths.astype(np.float32) / avgdl)).astype(np.float32)
+
+    def postings(self, term: str):
+        entry = self.terms.get(term)
+        if entry is None:
+            return None, None
+        return self.postings_at(*entry)
+
+    def postings_at(self, offset: int, df: int):
+        return self.postings_docs[offset:offset + df], self.postings_tf[offset:offset + df]
+
+    def document(self, doc: int) -> str:
+        start, end = int(self.doc_offsets[doc]), int(self.doc_offsets[doc + 1])
+        with self._text_lock:
+            self._text.seek(start)
+            return self._text.read(end - start).decode("utf-8")
+
+    def close(self):
+        self._text.close()
+        self.terms.close()
+
+    @staticmethod
+    def write(path: str, docs: list, postings: dict):
+        """`postings`: term -> (np.ndarray doc ids, np.ndarray tfs), doc ids ascending."""
+        os.makedirs(path, exist_ok=True)
+        terms = sorted(postings)
+        ordered = [postings[t] for t in terms]
+        doc_ids = np.concatenate([p[0] for p in ordered]) if ordered else np.empty(0)
+        tfs = np.concatenate([p[1] for p in ordered]) if ordered else np.empty(0)
+        np.save(os.path.join(path, "postings_docs.npy"), doc_ids.astype(np.uint32))
+        np.save(os.path.join(path, "postings_tf.npy"), np.minimum(tfs, 65535).astype(np.uint16))
+
+        encoded = [d["text"].encode("utf-8") for d in docs]
+        np.save(os.path.join(path, "doc_lengths.npy"), np.array([d["length"] for d in docs], dtype=np.uint32))
+        np.save(os.path.join(path, "doc_offsets.npy"), np.concatenate([[0], np.cumsum([len(e) for e in encoded])]).astype(np.uint64))
+        with open(os.path.join(path, "docs.txt"), "wb") as f:
+            for e in encoded:
+                f.write(e)
+        TermTable.write(path, terms, [len(p[0]) for p in ordered])
+
+
+class LocalIndex:
+    """
+    BM25 retrieval over a segmented inverted index. New documents land in a new
+    segment; small segments are merged as part of `add_documents`
+    (tiered merging), so ingest never rewrites the whole corpus.
+    """
+    def __init__(self, path: str = LOCAL_INDEX_DIR, k1: float = BM25_K1, b: float = BM25_B):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.segments = []
+        self._manifest_mtime = None
+        self._lock = threading.Lock()
+
+    # --- Manifest ---
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.path, "manifest.json")
+
+    def _read_manifest(self) -> dict:
+        if not os.path.exists(self._manifest_path()):
+            return {"segments": [], "next_segment": 0}
+        with open(self._manifest_path(), encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest: dict):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self._manifest_path() + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self._manifest_path())
+        self._manifest_mtime = None  # force this process to reopen on next search
+
+    def refresh(self):
+        """(Re)opens segments if the manifest changed, e.g. after another process merged."""
+        try:
+            mtime = os.stat(self._manifest_path()).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._manifest_mtime:
+            return
+        with self._lock:
+            manifest = self._read_manifest()
+            current = {os.path.basename(s.path): s for s in self.segments}
+            segments = [current.get(name) or Segment(os.path.join(self.path, name)) for name in manifest["segments"]]
+            total_docs = sum(s.num_docs for s in segments)
+            total_len = sum(float(s.doc_lengths.sum()) for s in segments)
+            avgdl = total_len / total_docs if total_docs else 1.0
+            for segment in segments:
+                segment.prepare(avgdl, self.k1, self.b)
+            self.segments = segments
+            self._manifest_mtime = mtime
+
+    def __len__(self):
+        self.refresh()
+        return sum(s.num_docs for s in self.segments)
+
+    # --- Search ---
+
+    def search(self, query: str, k: int = 3) -> list:
+        """Top-k passages as [{"score", "text"}], best first."""
+        self.refresh()
+        segments = self.segments
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not segments or not terms:
+            return []
+
+        total_docs = sum(s.num_docs for s in segments)
+        # One term-table lookup per (segment, term), shared by df and the postings read.
+        entries = [{term: s.terms.get(term) for term in terms} for s in segments]
+        idf = {}
+        for term in terms:
+            df = sum(e[term][1] for e in entries if e[term] is not None)
+            if df:
+                idf[term] = np.float32(np.log(1.0 + (total_docs - df + 0.5) / (df + 0.5)))
+
+        candidates = []
+        for seg_no, segment in enumerate(segments):
+            doc_parts, score_parts = [], []
+            for term, weight in idf.items():
+                entry = entries[seg_no][term]
+                if entry is None:
+                    continue
+                docs, tfs = segment.postings_at(*entry)
+                tf = tfs.astype(np.float32)
+                doc_parts.append(docs)
+                score_parts.append(weight * tf * (self.k1 + 1.0) / (tf + segment.norms[docs]))
+            if not doc_parts:
+                continue
+            # Accumulate over the touched documents only: cost follows the postings read,
+            # not the segment size.
+            doc_ids, slots = np.unique(np.concatenate(doc_parts), return_inverse=True)
+            scores = np.bincount(slots, weights=np.concatenate(score_parts))
+            top = np.argpartition(scores, -k)[-k:] if len(scores) > k else np.arange(len(scores))
+            candidates.extend((float(scores[i]), seg_no, int(doc_ids[i])) for i in top)
+
+        return [
+            {"score": score, "text": segments[seg_no].document(doc)}
+            for score, seg_no, doc in heapq.nlargest(k, candidates)
+        ]
+
+    # --- Ingest / merge ---
+
+    def add_documents(self, texts: list):
+        """Writes `texts` as one new segment, then merges if there are too many segments."""
+        docs, postings = [], {}
+        for doc_id, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            docs.append({"text": text, "length": sum(counts.values())})
+            for term, tf in counts.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(doc_id)
+                postings[term][1].append(tf)
+        postings = {t: (np.array(d), np.array(f)) for t, (d, f) in postings.items()}
+
+        manifest = self._read_manifest()
+        name = f"seg_{manifest['next_segment']:06d}"
+        Segment.write(os.path.join(self.path, name), docs, postings)
+        manifest["segments"].append(name)
+        manifest["next_segment"] += 1
+        self._write_manifest(manifest)
+        self.maybe_merge()
+
+    def maybe_merge(self):
+        manifest = self._read_manifest()
+        while len(manifest["segments"]) > LOCAL_INDEX_MAX_SEGMENTS:
+            sizes = {name: len(np.load(os.path.join(self.path, name, "doc_lengths.npy"), mmap_mode="r"))
+                     for name in manifest["segments"]}
+            victims = sorted(manifest["segments"], key=sizes.get)[:max(2, LOCAL_INDEX_MERGE_FACTOR)]
+            manifest = self._merge(manifest, victims)
+
+    def _merge(self, manifest: dict, names: list) -> dict:
+        sources = [Segment(os.path.join(self.path, n)) for n in names]
+        docs, postings = [], {}
+        base = 0
+        for segment in sources:
+            for doc in range(segment.num_docs):
+                docs.append({"text": segment.document(doc), "length": int(segment.doc_lengths[doc])})
+            for term, (offset, df) in segment.terms.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(segment.postings_docs[offset:offset + df].astype(np.int64) + base)
+                postings[term][1].append(np.asarray(segment.postings_tf[offset:offset + df]))
+            base += segment.num_docs
+        postings = {t: (np.concatenate(d), np.concatenate(f)) for t, (d, f) in postings.items()}
+
+        name = f"seg_{manifest['next_segment']:06d}"
+        Segment.write(os.path.join(self.path, name), docs, postings)
+        first = manifest["segments"].index(names[0])
+        remaining = [n for n in manifest["segments"] if n not in names]
+        remaining.insert(min(first, len(remaining)), name)
+        manifest = {"segments": remaining, "next_segment": manifest["next_segment"] + 1}
+        self._write_manifest(manifest)
+        for segment in sources:
+            segment.close()
+            # Open mmaps in other processes stay valid after unlink (POSIX).
+            shutil.rmtree(segment.path, ignore_errors=True)
+        return manifest
+
+
+local_index = LocalIndex()
+
+
+if __name__ == "__main__":
+    # python -m services.local_index add <corpus.jsonl|corpus.txt> [batch size]
+    # python -m services.local_index search "<query>"
+    import sys
+    import time
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "add" and len(sys.argv) >= 3:
+        batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 100_000
+        batch = []
+        with open(sys.argv[2], encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                batch.append(json.loads(line)["text"] if line.startswith("{") else line)
+                if len(batch) >= batch_size:
+                    local_index.add_documents(batch)
+                    batch = []
+        if batch:
+            local_index.add_documents(batch)
+        print(f"Local index now holds {len(local_index)} passages.")
+    elif command == "search" and len(sys.argv) >= 3:
+        started = time.perf_counter()
+        hits = local_index.search(sys.argv[2], 5)
+        print(f"{(time.perf_counter() - started) * 1000:.1f} ms")
+        for hit in hits:
+            print(f"{hit['score']:.3f}  {hit['text'][:120]}")
+    else:
+        sys.exit("usage: python -m services.local_index add <corpus> [batch size] | search <query>")
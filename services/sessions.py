@@ -0,0 +1,278 @@
+import os
+import logging
+import time
+import asyncio
+import secrets
+import sqlite3
+import weakref
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+from core.config import DATA_DIR
+from core.cache import TTLCache, SqliteCache, CACHE_REGISTRY, MISSING
+from core.metrics import Counter
+from core.speculation import speculative
+from services.local_index import tokenize
+from services.text_search import text_service
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# --- Conversation Session Configuration ---
+SESSIONS_ENABLED = os.getenv("SESSIONS_ENABLED", "true").lower() == "true"
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))  # idle seconds before a session expires
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "1000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(32 * 1024 * 1024)))
+# Shared by all workers and kept across restarts. Set to an empty string for
+# memory-only sessions (single worker only: other workers won't see them).
+SESSION_DB = os.getenv("SESSION_DB", os.path.join(DATA_DIR, "sessions.sqlite3"))
+# Longest a turn holds its session against turns in other workers; a crashed
+# worker's claim lapses after this.
+SESSION_TURN_TIMEOUT = float(os.getenv("SESSION_TURN_TIMEOUT", "120"))
+SESSION_MAX_DOCUMENTS = int(os.getenv("SESSION_MAX_DOCUMENTS", "24"))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "20"))
+# Compacted history sent to the LLM: the last N exchanges, answers clipped.
+SESSION_HISTORY_TURNS = int(os.getenv("SESSION_HISTORY_TURNS", "3"))
+SESSION_HISTORY_ANSWER_CHARS = int(os.getenv("SESSION_HISTORY_ANSWER_CHARS", "400"))
+# -----------------------------------
+
+SESSION_ID_MAX_LENGTH = 64
+SESSION_RETRIEVALS = Counter(
+    "session_retrievals_total",
+    "Conversation turns by retrieval decision (full, incremental, reused).",
+    ("decision",),
+)
+
+
+class SessionStore:
+    """
+    Conversation state keyed by session id: retrieved documents, entities and
+    prior turns. Memory LRU with idle TTL; with the SQLite tier (on by default)
+    the disk copy is authoritative, so every worker sees the latest turn.
+    """
+    def __init__(self, memory: TTLCache, disk: SqliteCache | None = None):
+        self.memory = memory
+        self.disk = disk
+        self.created = 0
+        self.disk_hits = 0
+        self._locks = weakref.WeakValueDictionary()
+        CACHE_REGISTRY["sessions"] = self
+
+    def new(self) -> dict:
+        self.created += 1
+        now = time.time()
+        return {
+            "id": secrets.token_urlsafe(16),
+            "created_at": now,
+            "updated_at": now,
+            "turns": [],        # [{"role": "user" | "assistant", "content": str}]
+            "documents": [],    # retrieved snippets, newest first
+            "queries": [],      # retrieval queries already run
+            "entities": [],     # {"concept_id", "word", "entity_group"} from user turns, newest last
+            "turn_entities": [],  # entity names per user turn, for follow-up topics
+        }
+
+    async def load(self, session_id: str) -> dict | None:
+        # ":" never occurs in generated ids; it marks turn leases in the same table.
+        if not session_id or len(session_id) > SESSION_ID_MAX_LENGTH or ":" in session_id:
+            return None
+        if self.disk is not None:
+            try:
+                session = await asyncio.to_thread(self.disk.get, session_id)
+                if session is not MISSING:
+                    self.disk_hits += 1
+                    self.memory.set(session_id, session)
+                    return session
+            except sqlite3.Error as e:
+                logger.warning("Session store disk read error: %s", e)
+        session = self.memory.get(session_id)
+        return None if session is MISSING else session
+
+    async def save(self, session: dict):
+        session["updated_at"] = time.time()
+        self.memory.set(session["id"], session)
+        if self.disk is not None:
+            try:
+                await asyncio.to_thread(self.disk.set, session["id"], session)
+            except sqlite3.Error as e:
+                logger.warning("Session store disk write error: %s", e)
+
+    async def delete(self, session_id: str):
+        if ":" in session_id:
+            return
+        self.memory.delete(session_id)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.delete, session_id)
+
+    @asynccontextmanager
+    async def _claim(self, session_id: str):
+        """
+        Holds a lease row in the SQLite tier for the turn, so a turn of the same
+        session in another worker waits (polling) until this one has saved.
+        """
+        if self.disk is None:
+            yield
+            return
+        key, token = f"turn:{session_id}", secrets.token_hex(8)
+        claimed = False
+        try:
+            while not await asyncio.to_thread(self.disk.add, key, token, SESSION_TURN_TIMEOUT):
+                await asyncio.sleep(0.05)
+            claimed = True
+        except sqlite3.Error as e:
+            logger.warning("Session store lease error: %s", e)
+        try:
+            yield
+        finally:
+            if claimed:
+                try:
+                    await asyncio.to_thread(self.disk.delete, key, token)
+                except sqlite3.Error as e:
+                    logger.warning("Session store lease error: %s", e)
+
+    @asynccontextmanager
+    async def turn(self, session_id: str | None):
+        """
+        Yields the session for one request (a new one if the id is missing, unknown
+        or expired) and saves it afterwards. Turns of one session run one at a
+        time: within a worker by a lock, across workers by a lease in the SQLite
+        tier (without one, sessions are not shared between workers at all).
+        Yields None when sessions are disabled.
+        """
+        if not SESSIONS_ENABLED:
+            yield None
+            return
+        if not session_id:
+            session = self.new()
+            yield session
+            await self.save(session)
+            return
+        lock = self._locks.setdefault(session_id, asyncio.Lock())
+        async with lock, self._claim(session_id):
+            session = await self.load(session_id) or self.new()
+            yield session
+            await self.save(session)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.memory.hits + self.disk_hits,
+            "memory_hits": self.memory.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.memory.misses,  # the memory tier is only read after a disk miss
+            "evictions": self.memory.evictions + (self.disk.evictions if self.disk else 0),
+            "expirations": self.memory.expirations,
+            "entries": len(self.memory),
+            "bytes": self.memory.size_bytes,
+            "created": self.created,
+            "persistent": self.disk is not None,
+        }
+
+
+session_store = SessionStore(
+    TTLCache(max_entries=SESSION_MAX_ENTRIES, max_bytes=SESSION_MAX_BYTES, ttl=SESSION_TTL),
+    SqliteCache(SESSION_DB, ttl=SESSION_TTL) if SESSION_DB else None,
+)
+
+# --- Turn Helpers ---
+
+def _known_terms(session: dict) -> set:
+    terms = set()
+    for text in session["documents"] + session["queries"]:
+        terms.update(tokenize(text))
+    return terms
+
+
+def _topic(session: dict, query: str) -> list:
+    """Names of the entities from the last user turn that mentioned any, absent from `query`."""
+    lowered = query.lower()
+    for turn_entities in reversed(session["turn_entities"]):
+        if turn_entities:
+            return [word for word in turn_entities if word.lower() not in lowered]
+    return []
+
+
+async def retrieve_for_turn(session: dict | None, query: str, query_entities: list) -> tuple:
+    """
+    Returns (documents, decision). The first turn retrieves as usual. A follow-up
+    whose terms are all covered by documents already in the session reuses them
+    and makes no search call. Otherwise only the new question is searched, with
+    the previous topic appended when the follow-up names none of its own
+    ("what about in children?"). The new hits are merged in front of the kept
+    documents, and context packing picks the relevant ones.
+    """
+    if session is None or not session["documents"]:
+        documents = await speculative("retrieve", query, lambda: text_service.retrieve_from_web_async(query))
+        decision = "full"
+    else:
+        new_terms = set(tokenize(query)) - _known_terms(session)
+        if not new_terms:
+            documents = list(session["documents"])
+            decision = "reused"
+        else:
+            topic = [] if query_entities else _topic(session, query)
+            retrieval_query = " ".join([query] + topic)
+            fresh = await speculative(
+                "retrieve", retrieval_query, lambda: text_service.retrieve_from_web_async(retrieval_query)
+            )
+            fresh = [d for d in fresh if not d.startswith("ERROR:")]
+            documents = list(dict.fromkeys(fresh + session["documents"]))
+            decision = "incremental"
+            query = retrieval_query
+    SESSION_RETRIEVALS.inc(decision=decision)
+
+    if session is not None and not (len(documents) == 1 and documents[0].startswith("ERROR:")):
+        if decision != "reused":
+            session["queries"].append(query)
+        session["documents"] = documents[:SESSION_MAX_DOCUMENTS]
+    return documents, decision
+
+
+def add_documents(session: dict | None, documents: list):
+    """Keeps documents retrieved by other modes (text-to-image, image+text) for follow-ups."""
+    if session is None or not documents:
+        return
+    session["documents"] = list(dict.fromkeys(documents + session["documents"]))[:SESSION_MAX_DOCUMENTS]
+
+
+def history_messages(session: dict | None) -> list:
+    """Compacted prior turns as chat messages: last N exchanges, long answers clipped."""
+    if session is None:
+        return []
+    messages = []
+    for message in session["turns"][-2 * SESSION_HISTORY_TURNS:]:
+        content = message["content"]
+        if message["role"] == "assistant" and len(content) > SESSION_HISTORY_ANSWER_CHARS:
+            content = content[:SESSION_HISTORY_ANSWER_CHARS].rsplit(" ", 1)[0] + " ..."
+        messages.append({"role": message["role"], "content": content})
+    return messages
+
+
+def record_turn(session: dict | None, question: str, answer: str | None, entities: list = ()):
+    if session is None:
+        return
+    session["turns"].append({"role": "user", "content": question})
+    if answer:
+        session["turns"].append({"role": "assistant", "content": answer})
+    session["turns"] = session["turns"][-2 * SESSION_MAX_TURNS:]
+    words = [e["word"] for e in entities if e.get("word")]
+    session["turn_entities"].append(words)
+    session["turn_entities"] = session["turn_entities"][-SESSION_MAX_TURNS:]
+    known = {e["concept_id"] for e in session["entities"]}
+    for e in entities:
+        if e.get("concept_id") and e["concept_id"] not in known:
+            known.add(e["concept_id"])
+            session["entities"].append(
+                {"concept_id": e["concept_id"], "word": e.get("word"), "entity_group": e.get("entity_group")}
+            )
+    session["entities"] = session["entities"][-SESSION_MAX_DOCUMENTS:]
+
+
+def public_view(session: dict) -> dict:
+    return {
+        "session_id": session["id"],
+        "created_at": session["created_at"],
+        "updated_at": session["updated_at"],
+        "turns": session["turns"],
+        "entities": session["entities"],
+        "documents": len(session["documents"]),
+    }
@@ -1,8 +1,19 @@
 import os
-import requests
+import httpx
 import re
+import hashlib
+import json
+import asyncio
 from dotenv import load_dotenv
 from serpapi import GoogleSearch # Library to fetch Google search results
+from core.http import http_pool
+from services.entity_matcher import load_matcher
+from services.local_index import local_index
+from services.context_packer import context_packer
+from core.cache import search_cache, answer_cache, make_key, MISSING
+from core.metrics import instrumented
+from core.resilience import upstream, UpstreamError
+from core.lifecycle import LazyService
 
 load_dotenv() 
 
@@ -12,19 +23,82 @@ HUGGINGFACE_RAG_MODEL = os.getenv(
     "HUGGINGFACE_RAG_MODEL",
     "HuggingFaceTB/SmolLM3-3B:hf-inference"  # default chat model via HF Inference
 )
-HUGGINGFACE_RAG_API_URL = "https://router.huggingface.co/v1/chat/completions"
+HUGGINGFACE_RAG_API_URL = os.getenv("HUGGINGFACE_RAG_API_URL", "https://router.huggingface.co/v1/chat/completions")
 HUGGINGFACE_NER_API_URL = "https://api-inference.huggingface.co/models/dslim/bert-base-NER"
 SERPAPI_API_KEY = os.getenv("SERPAPI_API_KEY")
+SERPAPI_SEARCH_URL = os.getenv("SERPAPI_SEARCH_URL", "https://serpapi.com/search.json")
 USE_SERPAPI = os.getenv("USE_SERPAPI","true").lower() == "true" 
+# 'serpapi' (web), 'local' (offline BM25 corpus) or 'hybrid' (local + web, merged)
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "serpapi").lower()
+# Results fetched per query. The prompt stays within CONTEXT_TOKEN_BUDGET regardless,
+# because snippets are deduplicated, ranked and packed before generation.
+RETRIEVAL_DEPTH = int(os.getenv("RETRIEVAL_DEPTH", "6"))
+# Returned while the LLM upstream is failing fast; the sources are still shown.
+DEGRADED_ANSWER = (
+    "Answer Generation Failed: the language model is temporarily unavailable. "
+    "The retrieved sources are shown instead."
+)
 # -----------------------------------
 
-# --- Define a simple local medical vocabulary for demonstration (NLP feature) ---
+# --- Fallback vocabulary when no MEDICAL_VOCAB_PATH file is available (NLP feature) ---
 MEDICAL_KEYWORDS = [
     "fever", "chills", "headache", "pain", "inflammation", 
     "antibiotics", "treatment", "diagnosis", "virus", "symptoms", "jaundice"
 ]
 # -----------------------------------------------------------------------------
 
+class ThinkFilter:
+    """
+    Incrementally removes <think>...</think> sections from a token stream.
+    Tags may be split across chunks, so a possible partial tag is held back
+    until the next chunk arrives. Leading whitespace of the answer is dropped,
+    matching the `.strip()` of the non-streaming path.
+    """
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self._buffer = ""
+        self._inside = False
+        self._emitted = False
+
+    @staticmethod
+    def _partial_tag_len(text: str, tag: str) -> int:
+        for k in range(min(len(tag) - 1, len(text)), 0, -1):
+            if text.endswith(tag[:k]):
+                return k
+        return 0
+
+    def _emit(self, text: str) -> str:
+        if not self._emitted:
+            text = text.lstrip()
+            self._emitted = bool(text)
+        return text
+
+    def feed(self, chunk: str) -> str:
+        self._buffer += chunk
+        out = []
+        while True:
+            tag = self.CLOSE_TAG if self._inside else self.OPEN_TAG
+            idx = self._buffer.find(tag)
+            if idx >= 0:
+                if not self._inside:
+                    out.append(self._buffer[:idx])
+                self._buffer = self._buffer[idx + len(tag):]
+                self._inside = not self._inside
+                continue
+            keep = self._partial_tag_len(self._buffer, tag)
+            if not self._inside:
+                out.append(self._buffer[:len(self._buffer) - keep])
+            self._buffer = self._buffer[len(self._buffer) - keep:]
+            return self._emit("".join(out))
+
+    def flush(self) -> str:
+        rest = "" if self._inside else self._buffer
+        self._buffer = ""
+        return self._emit(rest)
+
+
 class GoogleSearchClient:
     """Uses SerpApi to fetch real organic search results."""
     def __init__(self):
@@ -32,76 +106,193 @@ class GoogleSearchClient:
         if not self.api_key:
              print("FATAL WARNING: SERPAPI_API_KEY not found. Search will use placeholder data.")
 
+    def _use_placeholder(self) -> bool:
+        return not self.api_key or not USE_SERPAPI
+
+    def _placeholder_results(self, query: str) -> list:
+        return [
+            "Placeholder Context 1: **Web Retrieval is LIVE!** The internet source confirms that the symptoms of fever include elevated body temperature and chills.",
+            "Placeholder Context 2: **LLM Active!** The external LLM is now generating an answer based on this web-fetched context.",
+            f"Placeholder Context 3: All data is currently simulated for structure validation. Original query was: '{query}'."
+        ]
+
+    def _build_params(self, query: str, num_results: int) -> dict:
+        return {
+            "engine": "google",
+            "q": query,
+            "api_key": self.api_key,
+            "num": num_results
+        }
+
+    def _parse_results(self, results: dict, query: str) -> list:
+        # Extract snippets from organic results
+        snippets = [
+            item.get('snippet', 'No snippet available.') 
+            for item in results.get('organic_results', [])
+        ]
+        return snippets if snippets else [f"No web results found for '{query}'."]
+
     def search(self, query: str, num_results: int = 3) -> list:
-        if not self.api_key or not USE_SERPAPI:
-        # placeholder mode
-            return [
-                "Placeholder Context 1: **Web Retrieval is LIVE!** The internet source confirms that the symptoms of fever include elevated body temperature and chills.",
-                "Placeholder Context 2: **LLM Active!** The external LLM is now generating an answer based on this web-fetched context.",
-                f"Placeholder Context 3: All data is currently simulated for structure validation. Original query was: '{query}'."
-            ]
+        if self._use_placeholder():
+            return self._placeholder_results(query)
         try:
-            params = {
-                "engine": "google",
-                "q": query,
-                "api_key": self.api_key,
-                "num": num_results
-            }
-            search = GoogleSearch(params)
-            results = search.get_dict()
-            
-            # Extract snippets from organic results
-            snippets = [
-                item.get('snippet', 'No snippet available.') 
-                for item in results.get('organic_results', [])
-            ]
-            
-            return snippets if snippets else [f"No web results found for '{query}'."]
+            search = GoogleSearch(self._build_params(query, num_results))
+            return self._parse_results(search.get_dict(), query)
             
         except Exception as e:
             print(f"SerpApi Search Error: {e}")
             return [f"ERROR: Failed to connect to SerpApi. Check your key and network. Error: {str(e)}"]
 
+    async def _fetch_async(self, query: str, num_results: int) -> list:
+        async def request(timeout: float) -> dict:
+            response = await http_pool.client.get(
+                SERPAPI_SEARCH_URL, params=self._build_params(query, num_results), timeout=timeout
+            )
+            response.raise_for_status()
+            return response.json()
+
+        # Search is idempotent, so slow calls are hedged.
+        return self._parse_results(await upstream("serpapi").call(request, hedge=True), query)
+
+    async def search_async(self, query: str, num_results: int = 3) -> list:
+        """
+        Non-blocking variant of `search` using the shared connection pool.
+        Results are cached (memory + SQLite) and identical in-flight queries coalesced.
+        """
+        if self._use_placeholder():
+            return self._placeholder_results(query)
+        key = make_key("web", query.strip().lower(), num_results)
+        try:
+            return await search_cache.get_or_compute(
+                key, lambda: self._fetch_async(query, num_results)
+            )
+
+        except UpstreamError:
+            raise  # open circuit or spent deadline: the caller answers 503, not the LLM
+        except Exception as e:
+            print(f"SerpApi Search Error: {e}")
+            return [f"ERROR: Failed to connect to SerpApi. Check your key and network. Error: {str(e)}"]
+
+
+class LocalCorpusClient:
+    """Offline retrieval from the vetted local corpus (BM25); same interface as GoogleSearchClient."""
+    def __init__(self, index=local_index):
+        self.index = index
+        if len(self.index) == 0:
+            print(f"WARNING: Local corpus index at {self.index.path} is empty.")
+
+    def search(self, query: str, num_results: int = 3) -> list:
+        hits = self.index.search(query, num_results)
+        return [hit["text"] for hit in hits] or [f"No local corpus results found for '{query}'."]
+
+    async def search_async(self, query: str, num_results: int = 3) -> list:
+        # Scoring is vectorised NumPy over mmap'd postings; keep it off the event loop anyway.
+        return await asyncio.to_thread(self.search, query, num_results)
+
+
+class HybridSearchClient:
+    """Local corpus hits first, then web hits, de-duplicated, up to `num_results` of each."""
+    def __init__(self, local_client, web_client):
+        self.local_client = local_client
+        self.web_client = web_client
+
+    @staticmethod
+    def _merge(local_results: list, web_results: list) -> list:
+        local_hits = [r for r in local_results if not r.startswith("No local corpus results")]
+        merged = list(dict.fromkeys(local_hits + web_results))
+        return merged
+
+    def search(self, query: str, num_results: int = 3) -> list:
+        return self._merge(
+            self.local_client.search(query, num_results), self.web_client.search(query, num_results)
+        )
+
+    async def search_async(self, query: str, num_results: int = 3) -> list:
+        local_results, web_results = await asyncio.gather(
+            self.local_client.search_async(query, num_results),
+            self.web_client.search_async(query, num_results),
+            return_exceptions=True,
+        )
+        if isinstance(local_results, BaseException):
+            raise local_results
+        if isinstance(web_results, UpstreamError):
+            # Web search is unavailable; the local corpus alone still answers, if it has hits.
+            if not self._merge(local_results, []):
+                raise web_results
+            web_results = []
+        elif isinstance(web_results, BaseException):
+            raise web_results
+        return self._merge(local_results, web_results)
+
+
+def _build_search_client():
+    if SEARCH_BACKEND == "local":
+        return LocalCorpusClient()
+    if SEARCH_BACKEND == "hybrid":
+        return HybridSearchClient(LocalCorpusClient(), GoogleSearchClient())
+    return GoogleSearchClient()
+
 
 class TextSearchService:
     def __init__(self):
         print("Initializing Text Search Service (Live Web RAG)...")
-        self.search_client = GoogleSearchClient()
+        self.search_client = _build_search_client()
+        self.entity_matcher = load_matcher(MEDICAL_KEYWORDS)
 
-    def retrieve_from_web(self, query_text: str, n_results: int = 3) -> list:
-        """Retrieves context from the web (via SerpApi)."""
+    def retrieve_from_web(self, query_text: str, n_results: int = RETRIEVAL_DEPTH) -> list:
+        """Retrieves context from the configured backend (SerpApi, local corpus, or both)."""
         return self.search_client.search(query_text, n_results)
 
+    @instrumented("retrieve")
+    async def retrieve_from_web_async(self, query_text: str, n_results: int = RETRIEVAL_DEPTH) -> list:
+        """Non-blocking variant of `retrieve_from_web`."""
+        return await self.search_client.search_async(query_text, n_results)
+
+    @staticmethod
+    def _unique_concepts(spans: list) -> list:
+        seen = set()
+        unique = []
+        for span in spans:
+            if span["concept_id"] not in seen:
+                seen.add(span["concept_id"])
+                unique.append(span)
+        return unique
+
+    @instrumented("ner")
     def extract_medical_entities(self, text: str) -> list:
-        """Performs local keyword extraction using regex and a predefined vocabulary."""
-        found_entities = []
-        text_lower = text.lower()
-        
-        for keyword in MEDICAL_KEYWORDS:
-            if re.search(r'\b' + re.escape(keyword) + r'\b', text_lower):
-                found_entities.append({
-                    "entity_group": "KEYWORD",
-                    "score": 1.0, 
-                    "word": keyword.capitalize()
-                })
-        return found_entities
-
-    def generate_answer(self, query_text: str, context_docs: list) -> str:
-        """Uses Hugging Face Inference Providers (router API) for RAG generation based on context."""
+        """Single-pass vocabulary tagging; one entity per concept (first occurrence)."""
+        return self._unique_concepts(self.entity_matcher.find(text))
+
+    @instrumented("ner")
+    def extract_medical_entities_batch(self, docs: list) -> list:
+        """Tags every document in one call. Entities carry the `doc_index` they came from."""
+        entities = []
+        for doc_index, spans in enumerate(self.entity_matcher.find_batch(docs)):
+            for span in self._unique_concepts(spans):
+                span["doc_index"] = doc_index
+                entities.append(span)
+        return entities
+
+    def _prepare_generation(self, query_text: str, context_docs: list, history: list = None):
+        """
+        Returns (early_answer, request). Exactly one is set: either a short-circuit
+        answer (missing key, no context, placeholder) or the (headers, payload) to send.
+        `history` holds prior conversation turns as chat messages (already compacted).
+        """
         if not HUGGINGFACE_API_KEY:
-            return "Answer Generation Failed: HUGGINGFACE_API_KEY is missing."
+            return "Answer Generation Failed: HUGGINGFACE_API_KEY is missing.", None
 
         if not context_docs:
-            return "No web results were retrieved. Cannot generate an answer."
+            return "No web results were retrieved. Cannot generate an answer.", None
 
         # Check for placeholder to guide the user
         if "Placeholder Context 1" in context_docs[0]:
             return (
                 "Answer generated successfully! (Using placeholder web context. "
                 "Integrate a live search API for real information.)"
-            )
+            ), None
 
-        context = "\n---\n".join(context_docs)
+        context = "\n---\n".join(context_packer.pack(query_text, context_docs))
 
         # System + user messages for chat completion
         system_prompt = (
@@ -125,33 +316,142 @@ class TextSearchService:
             "model": HUGGINGFACE_RAG_MODEL,
             "messages": [
                 {"role": "system", "content": system_prompt},
+                *(history or []),
                 {"role": "user", "content": user_content},
             ],
             "max_tokens": 500,
             "temperature": 0.1,
         }
+        return None, (headers, payload)
 
-        try:
-            response = requests.post(
-                HUGGINGFACE_RAG_API_URL, headers=headers, json=payload, timeout=60
+    def _parse_completion(self, data) -> str:
+        # OpenAI-style response: choices[0].message.content
+        if (
+            isinstance(data, dict)
+            and "choices" in data
+            and len(data["choices"]) > 0
+            and "message" in data["choices"][0]
+            and "content" in data["choices"][0]["message"]
+        ):
+            content = data["choices"][0]["message"]["content"].strip()
+            content = re.sub(r"<think>.*?</think>", "", content, flags=re.DOTALL).strip()
+            return content
+        return f"LLM API returned an unexpected structure: {data}"
+
+    def _answer_cache_key(self, query_text: str, context_docs: list, history: list = None) -> str:
+        question = " ".join(query_text.lower().split())
+        context_hash = hashlib.sha256("\x1f".join(context_docs).encode("utf-8")).hexdigest()
+        if history:
+            # Follow-ups ("and in children?") mean different things in different conversations.
+            return make_key("answer", HUGGINGFACE_RAG_MODEL, question, context_hash, history)
+        return make_key("answer", HUGGINGFACE_RAG_MODEL, question, context_hash)
+
+    async def _complete_async(self, headers: dict, payload: dict) -> str:
+        async def request(timeout: float) -> dict:
+            response = await http_pool.client.post(
+                HUGGINGFACE_RAG_API_URL, headers=headers, json=payload, timeout=timeout
             )
             response.raise_for_status()
-            data = response.json()
-
-            # OpenAI-style response: choices[0].message.content
-            if (
-                isinstance(data, dict)
-                and "choices" in data
-                and len(data["choices"]) > 0
-                and "message" in data["choices"][0]
-                and "content" in data["choices"][0]["message"]
-            ):
-                content = data["choices"][0]["message"]["content"].strip()
-                content = re.sub(r"<think>.*?</think>", "", content, flags=re.DOTALL).strip()
-                return content
-            return f"LLM API returned an unexpected structure: {data}"
-
-        except requests.exceptions.RequestException as e:
+            return response.json()
+
+        return self._parse_completion(await upstream("huggingface").call(request))
+
+    @instrumented("generate")
+    async def generate_answer_async(
+        self, query_text: str, context_docs: list, cache_mode: str = "use", history: list = None
+    ) -> str:
+        """
+        RAG generation via Hugging Face Inference Providers (router API), through
+        the shared connection pool and the upstream's adaptive timeout and deadline.
+        Answers are cached by (model, normalised question, context hash).
+        `cache_mode`: 'use' (default), 'bypass' (no read/write) or 'refresh' (recompute and overwrite).
+        """
+        early_answer, request = self._prepare_generation(query_text, context_docs, history)
+        if early_answer is not None:
+            return early_answer
+        headers, payload = request
+
+        try:
+            if cache_mode == "bypass":
+                return await self._complete_async(headers, payload)
+
+            key = self._answer_cache_key(query_text, context_docs, history)
+            if cache_mode == "refresh":
+                await answer_cache.invalidate(key)
+            return await answer_cache.get_or_compute(
+                key,
+                lambda: self._complete_async(headers, payload),
+                should_cache=lambda answer: not answer.startswith("LLM API returned an unexpected structure"),
+            )
+
+        except UpstreamError as e:
+            print(f"LLM Upstream Unavailable: {e}")
+            return DEGRADED_ANSWER
+        except httpx.HTTPError as e:
             return f"Answer Generation Failed due to API connection error: {e}"
 
-text_service = TextSearchService()
\ No newline at end of file
+    @instrumented("generate_stream")
+    async def stream_answer_async(
+        self, query_text: str, context_docs: list, cache_mode: str = "use", history: list = None
+    ):
+        """
+        Streaming variant of `generate_answer_async`: yields answer text pieces as the
+        router emits them (OpenAI-style SSE), with <think> sections filtered on the fly.
+        Cached answers are yielded in one piece; completed streams populate the cache.
+        """
+        early_answer, request = self._prepare_generation(query_text, context_docs, history)
+        if early_answer is not None:
+            yield early_answer
+            return
+        headers, payload = request
+
+        key = self._answer_cache_key(query_text, context_docs, history)
+        if cache_mode == "use":
+            cached = await answer_cache.get(key)
+            if cached is not MISSING:
+                yield cached
+                return
+
+        think_filter = ThinkFilter()
+        pieces = []
+        try:
+            # The timeout bounds each read (time to first token, then gaps between tokens).
+            async with upstream("huggingface").guard(record_latency=False) as timeout, http_pool.client.stream(
+                "POST", HUGGINGFACE_RAG_API_URL, headers=headers,
+                json={**payload, "stream": True}, timeout=timeout,
+            ) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        choices = json.loads(data).get("choices") or [{}]
+                        delta = (choices[0].get("delta") or {}).get("content") or ""
+                    except (ValueError, AttributeError):
+                        continue
+                    text = think_filter.feed(delta)
+                    if text:
+                        pieces.append(text)
+                        yield text
+
+            tail = think_filter.flush().rstrip()
+            if tail:
+                pieces.append(tail)
+                yield tail
+
+        except UpstreamError as e:
+            print(f"LLM Upstream Unavailable: {e}")
+            yield DEGRADED_ANSWER
+            return
+        except httpx.HTTPError as e:
+            yield f"Answer Generation Failed due to API connection error: {e}"
+            return
+
+        answer = "".join(pieces).strip()
+        if answer and cache_mode != "bypass":
+            await answer_cache.set(key, answer)
+
+text_service = LazyService("text_service", TextSearchService)
\ No newline at end of file
@@ -0,0 +1,102 @@
+import asyncio
+import json
+
+import pytest
+
+from core.admission import AdmissionGate, AdmissionMiddleware, Overloaded, INTERACTIVE, BATCH
+
+
+def test_queue_full_is_shed():
+    async def main():
+        gate = AdmissionGate("test-queue", max_concurrency=1, max_queue=1)
+        await gate.acquire()
+        queued = asyncio.create_task(gate.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as shed:
+            await gate.acquire()
+        gate.release(0.1)
+        await queued
+        assert gate.active == 1
+        return shed.value
+
+    error = asyncio.run(main())
+    assert error.reason == "queue_full"
+    assert error.retry_after >= 1
+
+
+def test_caller_that_cannot_start_in_time_is_shed_up_front():
+    async def main():
+        gate = AdmissionGate("test-deadline", max_concurrency=1)
+        await gate.acquire()
+        gate.hold_time = 5.0  # observed: a slot is held for ~5s
+        with pytest.raises(Overloaded) as shed:
+            await gate.acquire(budget=1.0)
+        assert not gate._queue
+        return shed.value
+
+    error = asyncio.run(main())
+    assert error.reason == "deadline"
+    assert error.retry_after == 5
+
+
+def test_interactive_overtakes_queued_batch():
+    async def main():
+        gate = AdmissionGate("test-priority", max_concurrency=1)
+        await gate.acquire()
+        order = []
+
+        async def waiter(name, priority):
+            await gate.acquire(priority)
+            order.append(name)
+            gate.release()
+
+        tasks = [asyncio.create_task(waiter("batch", BATCH))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(waiter("interactive", INTERACTIVE)))
+        await asyncio.sleep(0)
+        gate.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(main()) == ["interactive", "batch"]
+
+
+async def _call(app, method="POST", path="/chat"):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app({"type": "http", "method": method, "path": path}, receive, send)
+    return messages
+
+
+def test_middleware_returns_503_with_retry_after():
+    async def main():
+        release = asyncio.Event()
+
+        async def app(scope, receive, send):
+            await release.wait()
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"ok"})
+
+        gate = AdmissionGate("test-middleware", max_concurrency=1)
+        middleware = AdmissionMiddleware(app, budget=lambda: 0.05, gate=gate)
+        first = asyncio.create_task(_call(middleware))
+        await asyncio.sleep(0)
+        shed = await _call(middleware)
+        bypass = asyncio.create_task(_call(middleware, method="GET", path="/metrics"))
+        release.set()
+        return await first, shed, await bypass, gate
+
+    first, shed, bypass, gate = asyncio.run(main())
+    assert first[0]["status"] == 200
+    assert bypass[0]["status"] == 200
+    assert shed[0]["status"] == 503
+    headers = dict(shed[0]["headers"])
+    assert int(headers[b"retry-after"]) >= 1
+    assert json.loads(shed[1]["body"])["retry_after"] >= 1
+    assert gate.active == 0
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from core.cache import TieredCache, TTLCache, SqliteCache, MISSING
+
+
+def _cache(name, disk=None):
+    return TieredCache(f"test-{name}", TTLCache(max_entries=16, ttl=60), disk)
+
+
+def test_get_or_compute_coalesces_concurrent_callers():
+    cache = _cache("coalesce")
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return {"answer": 42}
+
+    async def main():
+        results = await asyncio.gather(*(cache.get_or_compute("k", compute) for _ in range(10)))
+        again = await cache.get_or_compute("k", compute)
+        return results, again
+
+    results, again = asyncio.run(main())
+    assert calls == 1
+    assert results == [{"answer": 42}] * 10
+    assert again == {"answer": 42}
+    assert cache.coalesced == 9
+    assert cache.stats()["inflight"] == 0
+
+
+def test_get_or_compute_shares_errors_without_caching_them():
+    cache = _cache("errors")
+    calls = 0
+
+    async def failing():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.02)
+        raise RuntimeError("upstream down")
+
+    async def main():
+        results = await asyncio.gather(
+            *(cache.get_or_compute("k", failing) for _ in range(5)), return_exceptions=True
+        )
+        assert calls == 1
+        assert all(isinstance(r, RuntimeError) for r in results)
+        await asyncio.gather(cache.get_or_compute("k", failing), return_exceptions=True)
+
+    asyncio.run(main())
+    assert calls == 2
+    assert cache.memory.get("k") is MISSING
+
+
+def test_waiter_recomputes_when_leader_is_cancelled():
+    cache = _cache("cancel")
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return calls
+
+    async def main():
+        leader = asyncio.create_task(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await waiter
+
+    assert asyncio.run(main()) == 2
+
+
+def test_should_cache_and_disk_tier(tmp_path):
+    disk = SqliteCache(str(tmp_path / "cache.sqlite3"), ttl=60)
+    cache = _cache("disk", disk)
+
+    async def compute():
+        return {"status": "degraded"}
+
+    async def main():
+        await cache.get_or_compute("skip", compute, should_cache=lambda v: v["status"] == "ok")
+        await cache.get_or_compute("keep", compute)
+        # A fresh memory tier (another worker) finds the value on disk.
+        other = _cache("disk-other", disk)
+        return await other.get("skip"), await other.get("keep"), other.stats()
+
+    skipped, kept, stats = asyncio.run(main())
+    assert skipped is MISSING
+    assert kept == {"status": "degraded"}
+    assert stats["disk_hits"] == 1
@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+import pytest
+
+from core import jobs
+from core.cache import SqliteCache
+from core.jobs import JobManager, COMPLETED
+
+
+async def _wait_done(manager, job_id):
+    return [event async for event in manager.follow(job_id)][-1]
+
+
+def test_same_key_shares_one_job():
+    calls = 0
+
+    async def main():
+        manager = JobManager(workers=2)
+        await manager.startup()
+        release = asyncio.Event()
+
+        async def work(progress):
+            nonlocal calls
+            calls += 1
+            progress("stage", {"name": "search"})
+            await release.wait()
+            return {"answer": "ok"}
+
+        try:
+            first, coalesced_first = await manager.submit("chat", "key-1", work)
+            second, coalesced_second = await manager.submit("chat", "key-1", work)
+            other, _ = await manager.submit("chat", "key-2", work)
+            release.set()
+            done = await _wait_done(manager, first["id"])
+            await _wait_done(manager, other["id"])
+            # Finished jobs no longer absorb new submissions.
+            third, coalesced_third = await manager.submit("chat", "key-1", work)
+            await _wait_done(manager, third["id"])
+        finally:
+            await manager.shutdown()
+        return (first, coalesced_first, second, coalesced_second, other, done,
+                third, coalesced_third, manager.stats())
+
+    first, c1, second, c2, other, done, third, c3, stats = asyncio.run(main())
+    assert (c1, c2, c3) == (False, True, False)
+    assert second["id"] == first["id"]
+    assert other["id"] != first["id"] and third["id"] != first["id"]
+    assert calls == 3
+    assert done["data"] == {"status": COMPLETED, "result": {"answer": "ok"}, "error": None}
+    assert stats["coalesced"] == 1
+
+
+def test_coalescing_across_workers_through_the_store(tmp_path):
+    async def main():
+        store_path = str(tmp_path / "jobs.sqlite3")
+        a = JobManager(workers=1, store=SqliteCache(store_path, ttl=60))
+        b = JobManager(workers=1, store=SqliteCache(store_path, ttl=60))
+        await a.startup()
+        await b.startup()
+        release = asyncio.Event()
+
+        async def work(progress):
+            await release.wait()
+            return 7
+
+        try:
+            job, _ = await a.submit("chat", "shared", work)
+            joined, coalesced = await b.submit("chat", "shared", work)
+            release.set()
+            # b has no local copy: it polls the snapshots a writes to the store.
+            done = await asyncio.wait_for(_wait_done(b, job["id"]), 5)
+            seen_by_b = await b.get(job["id"])
+        finally:
+            await a.shutdown()
+            await b.shutdown()
+        return job, joined, coalesced, done, seen_by_b
+
+    job, joined, coalesced, done, seen_by_b = asyncio.run(main())
+    assert coalesced is True
+    assert joined["id"] == job["id"]
+    assert done["data"]["result"] == 7
+    assert seen_by_b["status"] == COMPLETED
+    assert seen_by_b["result"] == 7
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_finished_jobs_expire(tmp_path, monkeypatch, shared):
+    monkeypatch.setattr(jobs, "JOB_RESULT_TTL", 0.2)
+
+    async def main():
+        store = SqliteCache(str(tmp_path / "jobs.sqlite3"), ttl=0.2) if shared else None
+        manager = JobManager(workers=1, store=store)
+        await manager.startup()
+
+        async def work(progress):
+            return "done"
+
+        try:
+            job, _ = await manager.submit("chat", "ttl", work)
+            await _wait_done(manager, job["id"])
+            fresh = await manager.get(job["id"])
+            await asyncio.sleep(0.3)
+            expired = await manager.get(job["id"])
+        finally:
+            await manager.shutdown()
+        return fresh, expired
+
+    started = time.monotonic()
+    fresh, expired = asyncio.run(main())
+    assert fresh["result"] == "done"
+    assert expired is None
+    assert time.monotonic() - started < 5
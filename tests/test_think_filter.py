@@ -0,0 +1,41 @@
+import pytest
+
+from services.text_search import ThinkFilter
+
+RAW = "<think>Check the dose.\nMaybe 5 mg?</think>\n\n  Take 5 mg daily if x < 3 and y > 1."
+ANSWER = "Take 5 mg daily if x < 3 and y > 1."
+
+
+def _run(chunks):
+    think_filter = ThinkFilter()
+    return "".join(think_filter.feed(chunk) for chunk in chunks) + think_filter.flush()
+
+
+def test_whole_response():
+    assert _run([RAW]) == ANSWER
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 8])
+def test_tags_split_across_chunks(size):
+    assert _run([RAW[i:i + size] for i in range(0, len(RAW), size)]) == ANSWER
+
+
+def test_every_two_way_split():
+    for i in range(len(RAW) + 1):
+        assert _run([RAW[:i], RAW[i:]]) == ANSWER, i
+
+
+def test_partial_tag_is_held_back_until_resolved():
+    think_filter = ThinkFilter()
+    assert think_filter.feed("Use <thi") == "Use "
+    assert think_filter.feed("s one") == "<this one"
+    assert think_filter.feed(" </thi") == " </thi"
+    assert think_filter.flush() == ""
+
+
+def test_unterminated_think_drops_the_rest():
+    assert _run(["Answer. <think>never ", "closed"]) == "Answer. "
+
+
+def test_multiple_sections():
+    assert _run(["<think>a</thi", "nk>One <think>b</think>two"]) == "One two"